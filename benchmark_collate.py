@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Compare the bytes copied and the time per batch between the previous input path, where every fp16 sample is copied
+by torch.tensor(...), again by .float(), again by pad_sequence and a last time when the model makes the permuted
+batch contiguous, and PaddedCollate, which writes every sample once into a reused buffer in the layout of the model.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from datasets.transforms import predict_ToTensor
+from utils.general import PaddedCollate, predict_padded_permuted_collate
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the copies made to form a padded batch')
+    parser.add_argument('--batch_size', type=int, default=32, help='samples per batch')
+    parser.add_argument('--min_length', type=int, default=50, help='minimum synthetic sequence length')
+    parser.add_argument('--max_length', type=int, default=1000, help='maximum synthetic sequence length')
+    parser.add_argument('--embeddings_dim', type=int, default=1024, help='size of the per residue embeddings')
+    parser.add_argument('--batches', type=int, default=20, help='number of batches to time')
+    parser.add_argument('--seed', type=int, default=123, help='seed for the synthetic embeddings')
+    return parser.parse_args()
+
+
+def previous_path(samples: list, layout: str) -> tuple:
+    """Batch the samples like predict_ToTensor and predict_padded_permuted_collate did and count the copied bytes"""
+    transform = predict_ToTensor()
+    items = [(transform(sample), {'id': str(i), 'sequence': '', 'length': len(sample), 'frequencies': torch.zeros(25)})
+             for i, sample in enumerate(samples)]
+    padded, _ = predict_padded_permuted_collate(items)
+    if layout == 'BLD':  # biLSTM_TextCNN used to permute the [B, D, L] batch back
+        padded = padded.permute(0, 2, 1)
+    padded = padded.contiguous()  # the lstm and the convolutions need a contiguous input
+    residues = sum(len(sample) for sample in samples)
+    embeddings_dim = samples[0].shape[-1]
+    copied = residues * embeddings_dim * samples[0].itemsize  # torch.tensor copy in the on-disk dtype
+    copied += residues * embeddings_dim * 4  # .float()
+    copied += padded.numel() * 4  # pad_sequence
+    copied += padded.numel() * 4  # making the permuted batch contiguous
+    return padded, copied
+
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+    batches = []
+    for _ in range(args.batches):
+        lengths = rng.integers(args.min_length, args.max_length + 1, size=args.batch_size)
+        batches.append([rng.standard_normal((length, args.embeddings_dim), dtype=np.float32).astype(np.float16)
+                        for length in lengths])
+
+    print(f"{'layout':>6} {'path':>10} {'MB copied/batch':>16} {'ms/batch':>9}")
+    for layout in ['BDL', 'BLD']:
+        copied = 0
+        start = time.perf_counter()
+        for samples in batches:
+            padded, batch_copied = previous_path(samples, layout)
+            copied += batch_copied
+        previous_ms = (time.perf_counter() - start) * 1000 / args.batches
+        print(f"{layout:>6} {'previous':>10} {copied / args.batches / 2 ** 20:>16.1f} {previous_ms:>9.1f}")
+
+        collate = PaddedCollate(layout=layout, pin_memory=torch.cuda.is_available(), labelled=False)
+        transform = predict_ToTensor(dtype=None)
+        start = time.perf_counter()
+        for samples in batches:
+            items = [(transform(sample), {'id': str(i), 'sequence': '', 'length': len(sample),
+                                          'frequencies': torch.zeros(25)}) for i, sample in enumerate(samples)]
+            collated, _ = collate(items)
+        collate_ms = (time.perf_counter() - start) * 1000 / args.batches
+        assert torch.equal(collated, padded), 'PaddedCollate and the previous path produced different batches'
+        print(f"{layout:>6} {'collate':>10} {collate.bytes_copied / collate.batches / 2 ** 20:>16.1f} "
+              f"{collate_ms:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Benchmark how the loading throughput of Embeddings_predict_Dataset scales with the number of DataLoader workers.
+A synthetic h5 file with fp16 per residue embeddings and the matching remapped fasta file are written to a
+temporary directory, so the results do not depend on the datasets that are available on the machine.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+from torchvision.transforms import transforms
+
+from datasets.embeddings_dataset import Embeddings_predict_Dataset
+from datasets.transforms import Solubility_predict_ToInt, predict_ToTensor
+from solver import build_data_loader
+from utils.general import PaddedCollate
+
+AMINO_ACID_LETTERS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark DataLoader steps/s for different numbers of workers')
+    parser.add_argument('--num_sequences', type=int, default=2000, help='number of synthetic proteins')
+    parser.add_argument('--min_length', type=int, default=50, help='minimum synthetic sequence length')
+    parser.add_argument('--max_length', type=int, default=1000, help='maximum synthetic sequence length')
+    parser.add_argument('--embeddings_dim', type=int, default=1024, help='size of the per residue embeddings')
+    parser.add_argument('--batch_size', type=int, default=32, help='samples per batch')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4, 8],
+                        help='numbers of DataLoader workers to benchmark')
+    parser.add_argument('--epochs', type=int, default=2, help='passes over the dataset per worker count')
+    parser.add_argument('--seed', type=int, default=123, help='seed for the synthetic data')
+    return parser.parse_args()
+
+
+def write_synthetic_dataset(directory: str, args) -> tuple:
+    """Write an h5 file and a remapped fasta file with random embeddings and sequences."""
+    rng = np.random.default_rng(args.seed)
+    embeddings_path = os.path.join(directory, 'embeddings_file.h5')
+    remapping_path = os.path.join(directory, 'remapped_sequences_file.fasta')
+    lengths = rng.integers(args.min_length, args.max_length + 1, size=args.num_sequences)
+    with h5py.File(embeddings_path, 'w') as f, open(remapping_path, 'w') as fasta:
+        for i, length in enumerate(lengths):
+            seq_id = 'synthetic_{}'.format(i)
+            f.create_dataset(seq_id, data=rng.standard_normal((length, args.embeddings_dim), dtype=np.float32)
+                             .astype(np.float16))
+            sequence = ''.join(rng.choice(list(AMINO_ACID_LETTERS), size=length))
+            fasta.write('>{} synthetic_protein_{}\n{}\n'.format(seq_id, i, sequence))
+    return embeddings_path, remapping_path
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print(f"Writing {args.num_sequences} synthetic embeddings to {tmpdir}")
+        embeddings_path, remapping_path = write_synthetic_dataset(tmpdir, args)
+        transform = transforms.Compose([Solubility_predict_ToInt(), predict_ToTensor(dtype=None)])
+        data_set = Embeddings_predict_Dataset(embeddings_path, remapping_path, key_format='hash',
+                                              transform=transform)
+
+        print(f"{'workers':>8} {'steps/s':>10} {'samples/s':>10} {'speedup':>8}")
+        baseline = None
+        for num_workers in args.workers:
+            loader_args = argparse.Namespace(batch_size=args.batch_size, length_bucketing=False,
+                                             bucket_size_multiplier=100, num_workers=num_workers, pin_memory=False,
+                                             prefetch_factor=2, persistent_workers=num_workers > 0, seed=args.seed)
+            data_loader = build_data_loader(data_set, loader_args, collate_fn=PaddedCollate(labelled=False),
+                                            shuffle=True)
+            for _ in data_loader:  # warm up the workers and the page cache
+                break
+            steps = 0
+            start = time.perf_counter()
+            for _ in range(args.epochs):
+                for _ in data_loader:
+                    steps += 1
+            elapsed = time.perf_counter() - start
+            steps_per_second = steps / elapsed
+            baseline = baseline or steps_per_second
+            print(f"{num_workers:>8} {steps_per_second:>10.2f} {steps_per_second * args.batch_size:>10.1f} "
+                  f"{steps_per_second / baseline:>7.2f}x")
+            del data_loader
+
+
+if __name__ == "__main__":
+    main()
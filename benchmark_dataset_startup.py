@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Benchmark the construction of Embeddings_predict_Dataset, which parses the remapped fasta file and computes the
+lengths, amino acid frequencies and optionally one hot encodings of all sequences, against the previous
+implementation with Biopython SeqIO, 25 str.count calls per sequence and a Python loop over every residue.
+No embeddings are read during construction, so only a synthetic fasta file is written.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from Bio import SeqIO
+
+from datasets.embeddings_dataset import Embeddings_predict_Dataset
+from utils.general import AMINO_ACIDS
+
+AMINO_ACID_LETTERS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of the dataset classes')
+    parser.add_argument('--num_sequences', type=int, default=100000, help='number of synthetic sequences')
+    parser.add_argument('--min_length', type=int, default=50, help='minimum synthetic sequence length')
+    parser.add_argument('--max_length', type=int, default=1000, help='maximum synthetic sequence length')
+    parser.add_argument('--embedding_mode', type=str, default='lm', help='[lm, onehot]')
+    parser.add_argument('--seed', type=int, default=123, help='seed for the synthetic sequences')
+    return parser.parse_args()
+
+
+def write_synthetic_fasta(path: str, args):
+    rng = np.random.default_rng(args.seed)
+    letters = np.frombuffer(AMINO_ACID_LETTERS.encode(), dtype=np.uint8)
+    with open(path, 'w') as f:
+        for i, length in enumerate(rng.integers(args.min_length, args.max_length + 1, size=args.num_sequences)):
+            sequence = rng.choice(letters, size=length).tobytes().decode()
+            lines = '\n'.join(sequence[j:j + 60] for j in range(0, length, 60))
+            f.write('>synthetic_{} synthetic_protein_{}\n{}\n'.format(i, i, lines))
+
+
+def seqio_metadata(remapped_sequences: str, embedding_mode: str) -> list:
+    """The metadata construction of the dataset classes before the byte level fasta reader"""
+    metadata_list = []
+    one_hot_enc = []
+    for record in SeqIO.parse(open(remapped_sequences), 'fasta'):
+        if embedding_mode == 'onehot':
+            amino_acid_ids = []
+            for char in record.seq:
+                amino_acid_ids.append(AMINO_ACIDS[char])
+            one_hot_enc.append(F.one_hot(torch.tensor(amino_acid_ids), num_classes=len(AMINO_ACIDS)))
+        frequencies = torch.zeros(25)
+        for i, aa in enumerate(AMINO_ACIDS):
+            frequencies[i] = str(record.seq).count(aa)
+        frequencies /= len(record.seq)
+        metadata_list.append({'metadata': {'id': str(record.id), 'sequence': str(record.seq),
+                                           'length': len(record.seq), 'frequencies': frequencies}})
+    return metadata_list
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fasta_path = os.path.join(tmpdir, 'remapped_sequences_file.fasta')
+        print(f"Writing {args.num_sequences} synthetic sequences to {fasta_path}")
+        write_synthetic_fasta(fasta_path, args)
+
+        start = time.perf_counter()
+        reference = seqio_metadata(fasta_path, args.embedding_mode)
+        seqio_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        data_set = Embeddings_predict_Dataset(None, fasta_path, key_format='hash', embedding_mode=args.embedding_mode)
+        fast_seconds = time.perf_counter() - start
+
+        for i, expected in enumerate(reference):
+            assert expected['metadata']['id'] == data_set.metadata.id(i)
+            assert expected['metadata']['sequence'] == data_set.metadata.sequence(i)
+            assert expected['metadata']['length'] == data_set.metadata.lengths[i]
+            assert torch.allclose(expected['metadata']['frequencies'],
+                                  torch.from_numpy(data_set.metadata.frequencies[i]))
+
+    print(f"{'path':>12} {'seconds':>10} {'sequences/s':>12}")
+    print(f"{'SeqIO':>12} {seqio_seconds:>10.2f} {args.num_sequences / seqio_seconds:>12.0f}")
+    print(f"{'byte level':>12} {fast_seconds:>10.2f} {args.num_sequences / fast_seconds:>12.0f}")
+    print(f"speedup: {seqio_seconds / fast_seconds:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Benchmark the disk space and the read throughput of h5 embedding files for combinations of the storage dtype, the
+chunk size and the compression filter of generate_embeddings_memory_efficient.py. For every setting the embeddings
+are written to an h5 file in a temporary directory and read back through Embeddings_predict_Dataset and a
+DataLoader, once after the pages of the file were dropped from the page cache (cold) and once from the page cache
+(warm), which leaves only the decode cost. The embeddings of --embeddings are used if given, synthetic ones otherwise;
+random synthetic values compress worse than real embeddings.
+"""
+
+import argparse
+import itertools
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+from torchvision.transforms import transforms
+
+from datasets.embeddings_dataset import Embeddings_predict_Dataset
+from datasets.transforms import Solubility_predict_ToInt, predict_ToTensor
+from solver import build_data_loader
+from utils.general import PaddedCollate
+from utils.h5_storage import (COMPRESSIONS, STORAGE_DTYPE_ATTRIBUTE, STORAGE_DTYPES, dataset_options,
+                              decode_bfloat16, encode_embedding)
+
+AMINO_ACID_LETTERS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark h5 storage dtypes, chunks and compression filters')
+    parser.add_argument('--embeddings', type=str, default=None,
+                        help='h5 file whose embeddings are benchmarked, synthetic embeddings if not set')
+    parser.add_argument('--remapping', type=str, default=None, help='remapped fasta file of --embeddings')
+    parser.add_argument('--key_format', type=str, default='hash')
+    parser.add_argument('--num_sequences', type=int, default=500, help='number of synthetic proteins')
+    parser.add_argument('--min_length', type=int, default=50, help='minimum synthetic sequence length')
+    parser.add_argument('--max_length', type=int, default=1000, help='maximum synthetic sequence length')
+    parser.add_argument('--embeddings_dim', type=int, default=1024, help='size of the synthetic embeddings')
+    parser.add_argument('--dtypes', type=str, nargs='+', default=STORAGE_DTYPES,
+                        help='storage dtypes, {}'.format(STORAGE_DTYPES))
+    parser.add_argument('--compressions', type=str, nargs='+', default=COMPRESSIONS,
+                        help='compression filters, {}'.format(COMPRESSIONS))
+    parser.add_argument('--compression_level', type=int, default=4, help='gzip level')
+    parser.add_argument('--chunk_residues', type=int, nargs='+', default=[0],
+                        help='residues per chunk, 0 for contiguous datasets unless they are compressed')
+    parser.add_argument('--shuffle', action='store_true', help='apply the byte shuffle filter before compressing')
+    parser.add_argument('--batch_size', type=int, default=32, help='samples per batch')
+    parser.add_argument('--num_workers', type=int, default=0, help='DataLoader workers that read the embeddings')
+    parser.add_argument('--seed', type=int, default=123, help='seed for the synthetic data')
+    return parser.parse_args()
+
+
+def source_embeddings(args, directory: str):
+    """remapped fasta file and a function that yields the (id, float32 embedding) pairs of the benchmarked proteins"""
+    if args.embeddings:
+        data_set = Embeddings_predict_Dataset(args.embeddings, args.remapping, key_format=args.key_format)
+
+        def embeddings():
+            for i in range(len(data_set)):
+                yield data_set.metadata.id(i), np.asarray(data_set[i][0], dtype=np.float32)
+        return args.remapping, args.key_format, embeddings
+
+    rng = np.random.default_rng(args.seed)
+    lengths = rng.integers(args.min_length, args.max_length + 1, size=args.num_sequences)
+    remapping_path = os.path.join(directory, 'remapped_sequences_file.fasta')
+    with open(remapping_path, 'w') as fasta:
+        for i, length in enumerate(lengths):
+            sequence = ''.join(rng.choice(list(AMINO_ACID_LETTERS), size=length))
+            fasta.write('>synthetic_{} synthetic_protein_{}\n{}\n'.format(i, i, sequence))
+
+    def embeddings():
+        embeddings_rng = np.random.default_rng(args.seed)
+        for i, length in enumerate(lengths):
+            yield 'synthetic_{}'.format(i), embeddings_rng.standard_normal((length, args.embeddings_dim),
+                                                                           dtype=np.float32)
+    return remapping_path, 'hash', embeddings
+
+
+def write_h5(path: str, embeddings, storage_dtype: str, chunk_residues: int, compression: str, args) -> tuple:
+    """write the embeddings with the storage options and return the residues, seconds and largest absolute error"""
+    residues = 0
+    error = 0.0
+    start = time.perf_counter()
+    with h5py.File(path, 'w') as f:
+        f.attrs[STORAGE_DTYPE_ATTRIBUTE] = storage_dtype
+        for key, embedding in embeddings():
+            stored = encode_embedding(embedding, storage_dtype)
+            f.create_dataset(key, data=stored, **dataset_options(stored.shape, chunk_residues, compression,
+                                                                 args.compression_level, args.shuffle))
+            decoded = decode_bfloat16(stored) if storage_dtype == 'bfloat16' else stored.astype(np.float32)
+            error = max(error, float(np.abs(decoded - embedding).max()))
+            residues += len(embedding)
+    return residues, time.perf_counter() - start, error
+
+
+def drop_page_cache(path: str):
+    """ask the kernel to drop the cached pages of the file, so the next read comes from the disk"""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def read_seconds(path: str, remapping: str, key_format: str, args) -> float:
+    """seconds of one pass over the h5 file through Embeddings_predict_Dataset and a DataLoader"""
+    transform = transforms.Compose([Solubility_predict_ToInt(), predict_ToTensor(dtype=None)])
+    data_set = Embeddings_predict_Dataset(path, remapping, key_format=key_format, transform=transform)
+    loader_args = argparse.Namespace(batch_size=args.batch_size, length_bucketing=False, bucket_size_multiplier=100,
+                                     num_workers=args.num_workers, pin_memory=False, prefetch_factor=2,
+                                     persistent_workers=False, seed=args.seed)
+    data_loader = build_data_loader(data_set, loader_args, collate_fn=PaddedCollate(labelled=False))
+    start = time.perf_counter()
+    for _ in data_loader:
+        pass
+    return time.perf_counter() - start
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        remapping, key_format, embeddings = source_embeddings(args, tmpdir)
+        raw_bytes = None
+        print(f"{'dtype':>9} {'compression':>11} {'chunk':>6} {'MB':>9} {'bytes/res':>10} {'ratio':>6} "
+              f"{'write s':>8} {'cold res/s':>11} {'warm res/s':>11} {'max abs err':>12}")
+        for storage_dtype, compression, chunk_residues in itertools.product(args.dtypes, args.compressions,
+                                                                             args.chunk_residues):
+            path = os.path.join(tmpdir, 'embeddings_file.h5')
+            residues, write_seconds, error = write_h5(path, embeddings, storage_dtype, chunk_residues, compression,
+                                                      args)
+            size = os.path.getsize(path)
+            if raw_bytes is None:
+                # uncompressed float32 of the same embeddings, the reference of the compression ratio
+                raw_bytes = sum(embedding.nbytes for _, embedding in embeddings())
+            drop_page_cache(path)
+            cold = read_seconds(path, remapping, key_format, args)
+            warm = read_seconds(path, remapping, key_format, args)
+            compression_name = compression if compression != 'gzip' else 'gzip-{}'.format(args.compression_level)
+            print(f"{storage_dtype:>9} {compression_name:>11} {chunk_residues or '-':>6} {size / 1e6:>9.1f} "
+                  f"{size / residues:>10.1f} {raw_bytes / size:>6.2f} {write_seconds:>8.1f} "
+                  f"{residues / cold:>11.0f} {residues / warm:>11.0f} {error:>12.2e}")
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+Load generator for prediction_server.py. Sends the embeddings of an embeddings file from concurrent clients, each
+request with proteins_per_request proteins, and reports the throughput, the client side latency percentiles and the
+stats of the server. With --inference_config the same proteins are also predicted by one run of inference.py per
+request batch of the one-shot path, which pays for the process start and the checkpoint load every time.
+
+Usage:
+  python prediction_server.py --config ./configs/inference_Sol_biLSTM_TextCNN.yml --port 8000 &
+  python benchmark_prediction_server.py --port 8000 --embeddings embeddings_file.h5 --remapping remapped.fasta
+"""
+
+import argparse
+import base64
+import http.client
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import yaml
+
+from datasets.embeddings_dataset import Embeddings_predict_Dataset
+
+INFERENCE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'inference.py')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure the throughput of the prediction server')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address of the server')
+    parser.add_argument('--port', type=int, default=8000, help='port of the server')
+    parser.add_argument('--unix_socket', type=str, default=None, help='unix socket of the server instead of a port')
+    parser.add_argument('--embeddings', type=str, required=True, help='embeddings file of the proteins to send')
+    parser.add_argument('--remapping', type=str, required=True, help='fasta file of the embeddings file')
+    parser.add_argument('--key_format', type=str, default='hash', help='key format of the embeddings file')
+    parser.add_argument('--requests', type=int, default=1000, help='number of requests to send')
+    parser.add_argument('--concurrency', type=int, default=16, help='number of concurrent clients')
+    parser.add_argument('--proteins_per_request', type=int, default=1, help='number of proteins of a request')
+    parser.add_argument('--inference_config', type=str, default=None,
+                        help='also time inference.py with this config on one request worth of proteins')
+    parser.add_argument('--one_shot_runs', type=int, default=3, help='number of timed runs of inference.py')
+    return parser.parse_args()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def connect(args) -> http.client.HTTPConnection:
+    if args.unix_socket:
+        return UnixHTTPConnection(args.unix_socket)
+    return http.client.HTTPConnection(args.host, args.port)
+
+
+def request(connection: http.client.HTTPConnection, method: str, path: str, body: bytes = None) -> dict:
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    data = json.loads(response.read())
+    if response.status != 200:
+        raise RuntimeError('{} {} failed with {}: {}'.format(method, path, response.status, data))
+    return data
+
+
+def encode_embedding(embedding: np.ndarray) -> str:
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(embedding))
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def request_bodies(data_set: Embeddings_predict_Dataset, args) -> list:
+    """JSON bodies of all requests, the proteins of the dataset are sent in turn"""
+    encoded = {}
+    bodies = []
+    for i in range(args.requests):
+        proteins = [(i * args.proteins_per_request + j) % len(data_set) for j in range(args.proteins_per_request)]
+        for protein in proteins:
+            if protein not in encoded:
+                encoded[protein] = encode_embedding(data_set[protein][0])
+        bodies.append(json.dumps({'ids': [data_set.metadata.id(protein) for protein in proteins],
+                                  'sequences': [data_set.metadata.sequence(protein) for protein in proteins],
+                                  'embeddings': [encoded[protein] for protein in proteins]}).encode())
+    return bodies
+
+
+def run_clients(bodies: list, args) -> tuple:
+    latencies = np.zeros(len(bodies))
+    next_request = iter(range(len(bodies)))
+    lock = threading.Lock()
+    errors = []
+
+    def client():
+        connection = connect(args)
+        while True:
+            with lock:
+                i = next(next_request, None)
+            if i is None:
+                break
+            start = time.perf_counter()
+            try:
+                request(connection, 'POST', '/predict', bodies[i])
+            except Exception as e:
+                errors.append(e)
+                break
+            latencies[i] = time.perf_counter() - start
+        connection.close()
+
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return time.perf_counter() - start, latencies
+
+
+def time_one_shot(data_set: Embeddings_predict_Dataset, args) -> float:
+    """seconds of one inference.py run on the proteins of one request"""
+    with open(args.inference_config) as f:
+        config = yaml.safe_load(f)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fasta = os.path.join(tmpdir, 'remapped.fasta')
+        with open(fasta, 'w') as f:
+            for i in range(min(args.proteins_per_request, len(data_set))):
+                f.write('>{}\n{}\n'.format(data_set.metadata.id(i), data_set.metadata.sequence(i)))
+        config.update({'embeddings': os.path.abspath(args.embeddings), 'remapping': fasta,
+                       'key_format': args.key_format, 'output_files_name': os.path.join(tmpdir, 'one_shot'),
+                       'prediction_cache': None})
+        config_path = os.path.join(tmpdir, 'config.yml')
+        with open(config_path, 'w') as f:
+            yaml.safe_dump(config, f)
+        seconds = []
+        for _ in range(args.one_shot_runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, INFERENCE_SCRIPT, '--config', config_path], check=True,
+                           stdout=subprocess.DEVNULL)
+            seconds.append(time.perf_counter() - start)
+    return float(np.median(seconds))
+
+
+def main():
+    args = parse_args()
+    data_set = Embeddings_predict_Dataset(args.embeddings, args.remapping, key_format=args.key_format)
+    bodies = request_bodies(data_set, args)
+    connection = connect(args)
+    request(connection, 'GET', '/health')
+    before = request(connection, 'GET', '/stats')
+
+    seconds, latencies = run_clients(bodies, args)
+    stats = request(connection, 'GET', '/stats')
+    connection.close()
+    proteins = args.requests * args.proteins_per_request
+    print(f"Server: {args.requests} requests with {args.proteins_per_request} proteins from {args.concurrency} "
+          f"clients in {seconds:.2f}s")
+    print(f"  throughput {proteins / seconds:.1f} proteins/s, {args.requests / seconds:.1f} requests/s")
+    print("  client latency p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms".format(
+        *np.percentile(latencies * 1000, [50, 90, 99])))
+    batches = stats['batches'] - before['batches']
+    print(f"  server latency p50 {stats['latency_p50_ms']:.1f} ms, p99 {stats['latency_p99_ms']:.1f} ms, "
+          f"{batches} batches with {(stats['samples'] - before['samples']) / max(batches, 1):.1f} proteins on "
+          f"average, queue depth {stats['queue_depth']}")
+
+    if args.inference_config:
+        one_shot = time_one_shot(data_set, args)
+        print(f"One-shot inference.py: {one_shot:.2f}s per request of {args.proteins_per_request} proteins, "
+              f"{args.proteins_per_request / one_shot:.1f} proteins/s")
+
+
+if __name__ == '__main__':
+    main()
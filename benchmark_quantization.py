@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Report the latency, the memory and the accuracy of the int8 quantization modes of inference.py --quantization against
+the float32 model on a held-out labelled set. Every mode predicts the held-out embeddings on the cpu, the static mode
+is calibrated on a random sample of the calibration embeddings, which should not overlap the held-out set. For every
+mode the size of the weights, the seconds per batch, the proteins per second, the largest difference of the predicted
+probabilities to float32, the number of changed labels and the accuracy and AUC on the held-out labels are reported.
+
+Usage:
+  python benchmark_quantization.py --embeddings test_emb.h5 --remapping test_remapped.fasta \
+      --calibration_embeddings val_emb.h5 --calibration_remapping val_remapped.fasta
+"""
+
+import argparse
+import io
+import time
+
+import numpy as np
+import sklearn.metrics as metrics
+import torch
+import yaml
+from torchvision.transforms import transforms
+
+from datasets.embeddings_dataset import Embeddings_predict_Dataset, read_sequence_metadata
+from datasets.transforms import Solubility_predict_ToInt, predict_ToTensor
+from models import *
+from solver import Solver
+from utils.quantization import QUANTIZATION_MODES
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare the int8 quantization modes against the float32 model')
+    parser.add_argument('--embeddings', type=str, required=True, help='.h5 file of the held-out set')
+    parser.add_argument('--remapping', type=str, required=True,
+                        help='remapped fasta file of the held-out set with the solubility labels in the descriptions')
+    parser.add_argument('--key_format', type=str, default='hash')
+    parser.add_argument('--calibration_embeddings', type=str, default=None,
+                        help='.h5 file whose embeddings calibrate the static mode, the held-out set if not set')
+    parser.add_argument('--calibration_remapping', type=str, default=None)
+    parser.add_argument('--calibration_samples', type=int, default=64)
+    parser.add_argument('--train_arguments', type=str, default='model_param/train_arguments.yml',
+                        help='train arguments with the model_type and model_parameters of the checkpoint')
+    parser.add_argument('--checkpoint', type=str, default='model_param/model_param.t7')
+    parser.add_argument('--modes', type=str, nargs='+', default=QUANTIZATION_MODES,
+                        help='quantization modes to compare, {}'.format(QUANTIZATION_MODES))
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--repeats', type=int, default=3, help='number of timed predictions of the held-out set')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch threads on the cpu, 0 keeps the default')
+    return parser.parse_args()
+
+
+def weights_megabytes(model: torch.nn.Module) -> float:
+    """size of the serialized state dict, the packed int8 weights of the quantized layers included"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 1e6
+
+
+def main():
+    args = parse_args()
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    with open(args.train_arguments) as f:
+        train_arguments = yaml.load(f, Loader=yaml.FullLoader)
+
+    transform = transforms.Compose([Solubility_predict_ToInt(), predict_ToTensor(dtype=None)])
+    data_set = Embeddings_predict_Dataset(args.embeddings, args.remapping, key_format=args.key_format,
+                                          transform=transform)
+    calibration_set = data_set
+    if args.calibration_embeddings:
+        calibration_set = Embeddings_predict_Dataset(args.calibration_embeddings, args.calibration_remapping,
+                                                     key_format=args.key_format, transform=transform)
+    else:
+        print('no calibration set given, the static mode is calibrated on the held-out set')
+    labels = np.array(read_sequence_metadata(args.remapping, args.key_format, labelled=True).solubility)
+    known = labels != 'U'
+    labels = (labels[known] == '1').astype(np.int64)
+
+    model = globals()[train_arguments['model_type']](embeddings_dim=data_set.embeddings_dim,
+                                                      **train_arguments['model_parameters'])
+    model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+    solver_args = argparse.Namespace(batch_size=args.batch_size, optimizer_parameters={}, checkpoint=None,
+                                     length_bucketing=False, num_workers=0, pin_memory=False,
+                                     seed=train_arguments.get('seed', 123))
+
+    print(f"{len(data_set)} held-out proteins, {int(known.sum())} labelled, batch size {args.batch_size}, "
+          f"{torch.get_num_threads()} threads, quantized engine {torch.backends.quantized.engine}")
+    print(f"{'mode':>12} {'weights MB':>11} {'ms/batch':>9} {'proteins/s':>11} {'max abs diff':>13} "
+          f"{'changed labels':>15} {'accuracy':>9} {'AUC':>7}")
+    reference = None
+    for mode in ['float32'] + args.modes:
+        solver = Solver(model, solver_args, eval=True)
+        # the quantized models only run on the cpu, so float32 is timed on the cpu as well
+        solver.device = torch.device('cpu')
+        solver.model = model.cpu().eval()
+        if mode != 'float32':
+            solver.quantize(mode, calibration_set, args.calibration_samples)
+        seconds = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            predictions = solver.predict(data_set)['predict_result'].to_numpy(dtype='float32')
+            seconds.append(time.perf_counter() - start)
+        if reference is None:
+            reference = predictions
+        batches = int(np.ceil(len(data_set) / args.batch_size))
+        difference = np.abs(predictions - reference).max()
+        changed = int(((predictions >= 0.5) != (reference >= 0.5)).sum())
+        accuracy = metrics.accuracy_score(labels, predictions[known] >= 0.5)
+        auc = metrics.roc_auc_score(labels, predictions[known]) if len(set(labels)) > 1 else float('nan')
+        print(f"{mode:>12} {weights_megabytes(solver.model):>11.2f} {1000 * min(seconds) / batches:>9.1f} "
+              f"{len(data_set) / min(seconds):>11.1f} {difference:>13.2e} {changed:>15d} {accuracy:>9.4f} "
+              f"{auc:>7.4f}")
+
+
+if __name__ == "__main__":
+    main()
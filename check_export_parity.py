@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Check that the exported models predict the same solubility as the eager model and compare the throughput of the
+runtimes. The model is exported to TorchScript and ONNX in a temporary directory, the bundled test embeddings in
+plmsol_test/test_dataset_emb are predicted with the eager model and with every runtime that is installed, and the
+largest difference of the predicted probabilities, the number of changed labels and the proteins per second are
+reported for every runtime. The ONNX runtime is skipped if onnx or onnxruntime is not installed.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import torch
+import yaml
+from torchvision.transforms import transforms
+
+from datasets.embeddings_dataset import Embeddings_predict_Dataset
+from datasets.transforms import Solubility_predict_ToInt, predict_ToTensor
+from models import *
+from solver import Solver
+from utils.export import export_model, load_runtime_model
+
+TEST_DATASET = 'plmsol_test/test_dataset_emb'
+MODEL_TYPES = ['biLSTM_TextCNN', 'LightAttention', 'FFN']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare exported models against the eager model')
+    parser.add_argument('--embeddings', type=str, default=os.path.join(TEST_DATASET, 't5_embeddings',
+                                                                       'embeddings_file.h5'))
+    parser.add_argument('--remapping', type=str, default=os.path.join(TEST_DATASET,
+                                                                      'remapped_sequences_file.fasta'))
+    parser.add_argument('--key_format', type=str, default='hash')
+    parser.add_argument('--train_arguments', type=str, default='model_param/train_arguments.yml',
+                        help='train arguments with the model_type and model_parameters of the checkpoint')
+    parser.add_argument('--checkpoint', type=str, default='model_param/model_param.t7',
+                        help='model weights, randomly initialized weights are used if the file does not exist')
+    parser.add_argument('--model_types', type=str, nargs='+', default=None,
+                        help='models to check with random weights instead of the checkpoint, {}'.format(MODEL_TYPES))
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--repeats', type=int, default=3, help='number of timed predictions of the dataset')
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='largest accepted absolute difference of the predicted probabilities')
+    return parser.parse_args()
+
+
+def predict(model: torch.nn.Module, data_set: Embeddings_predict_Dataset, args) -> tuple:
+    """predictions of the dataset and the proteins per second of the fastest of args.repeats predictions"""
+    solver_args = argparse.Namespace(batch_size=args.batch_size, optimizer_parameters={}, checkpoint=None,
+                                     length_bucketing=False, num_workers=0, pin_memory=False)
+    solver = Solver(model, solver_args, eval=True)
+    seconds = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        predictions = solver.predict(data_set)['predict_result'].to_numpy(dtype='float32')
+        seconds.append(time.perf_counter() - start)
+    return torch.tensor(predictions), len(data_set) / min(seconds)
+
+
+def check_model(model: torch.nn.Module, data_set: Embeddings_predict_Dataset, args) -> bool:
+    model.eval()
+    embeddings_dim = data_set.embeddings_dim
+    reference, throughput = predict(model, data_set, args)
+    failed = False
+    print(f"{type(model).__name__}")
+    print(f"{'runtime':>12} {'max abs diff':>13} {'changed labels':>15} {'proteins/s':>11}")
+    print(f"{'torch':>12} {0:>13.2e} {0:>15d} {throughput:>11.1f}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for runtime, export_format, file in [('torchscript', 'torchscript', 'model.torchscript.pt'),
+                                             ('onnxruntime', 'onnx', 'model.onnx')]:
+            path = os.path.join(tmpdir, file)
+            try:
+                export_model(model, path, export_format, embeddings_dim)
+                runtime_model = load_runtime_model(runtime, path)
+            except ImportError as e:
+                print(f"{runtime:>12} skipped: {e}")
+                continue
+            predictions, throughput = predict(runtime_model, data_set, args)
+            difference = (predictions - reference).abs().max().item()
+            changed = int(((predictions >= 0.5) != (reference >= 0.5)).sum())
+            failed |= difference > args.tolerance or changed > 0
+            print(f"{runtime:>12} {difference:>13.2e} {changed:>15d} {throughput:>11.1f}")
+    return failed
+
+
+def main():
+    args = parse_args()
+    with open(args.train_arguments) as f:
+        train_arguments = yaml.load(f, Loader=yaml.FullLoader)
+
+    transform = transforms.Compose([Solubility_predict_ToInt(), predict_ToTensor(dtype=None)])
+    data_set = Embeddings_predict_Dataset(args.embeddings, args.remapping, key_format=args.key_format,
+                                          transform=transform)
+    embeddings_dim = data_set.embeddings_dim
+    torch.manual_seed(train_arguments.get('seed', 123))
+    if args.model_types:
+        models = [globals()[model_type](embeddings_dim=embeddings_dim, output_dim=1)
+                  for model_type in args.model_types]
+    else:
+        model = globals()[train_arguments['model_type']](embeddings_dim=embeddings_dim,
+                                                          **train_arguments['model_parameters'])
+        if os.path.exists(args.checkpoint):
+            model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+        else:
+            print(f"{args.checkpoint} does not exist, comparing randomly initialized weights")
+        models = [model]
+    failed = False
+    for model in models:
+        failed |= check_model(model, data_set, args)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
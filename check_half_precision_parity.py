@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Check that the half precision input path predicts the same solubility as the float32 path. The bundled test
+embeddings in plmsol_test/test_dataset_emb are predicted once with float32 batches and then with float16 and
+bfloat16 batches, with and without autocast, and the largest difference of the predicted probabilities and the
+number of changed labels are reported for every setting.
+"""
+
+import argparse
+import os
+import sys
+
+import torch
+import yaml
+from torchvision.transforms import transforms
+
+from datasets.embeddings_dataset import Embeddings_predict_Dataset
+from datasets.transforms import Solubility_predict_ToInt, predict_ToTensor
+from models import *
+from solver import Solver
+
+TEST_DATASET = 'plmsol_test/test_dataset_emb'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare half precision predictions against the float32 path')
+    parser.add_argument('--embeddings', type=str, default=os.path.join(TEST_DATASET, 't5_embeddings',
+                                                                       'embeddings_file.h5'))
+    parser.add_argument('--remapping', type=str, default=os.path.join(TEST_DATASET,
+                                                                      'remapped_sequences_file.fasta'))
+    parser.add_argument('--key_format', type=str, default='hash')
+    parser.add_argument('--train_arguments', type=str, default='model_param/train_arguments.yml',
+                        help='train arguments with the model_type and model_parameters of the checkpoint')
+    parser.add_argument('--checkpoint', type=str, default='model_param/model_param.t7',
+                        help='model weights, randomly initialized weights are used if the file does not exist')
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--tolerance', type=float, default=1e-2,
+                        help='largest accepted absolute difference of the predicted probabilities')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with open(args.train_arguments) as f:
+        train_arguments = yaml.load(f, Loader=yaml.FullLoader)
+
+    transform = transforms.Compose([Solubility_predict_ToInt(), predict_ToTensor(dtype=None)])
+    data_set = Embeddings_predict_Dataset(args.embeddings, args.remapping, key_format=args.key_format,
+                                          transform=transform)
+    torch.manual_seed(train_arguments.get('seed', 123))
+    model = globals()[train_arguments['model_type']](embeddings_dim=data_set.embeddings_dim,
+                                                      **train_arguments['model_parameters'])
+    if os.path.exists(args.checkpoint):
+        model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+    else:
+        print(f"{args.checkpoint} does not exist, comparing randomly initialized weights")
+
+    settings = [('float32', False), ('float16', False), ('bfloat16', False), ('float16', True), ('bfloat16', True)]
+    reference = None
+    failed = False
+    print(f"{'input_dtype':>12} {'autocast':>9} {'max abs diff':>13} {'changed labels':>15}")
+    for input_dtype, autocast in settings:
+        solver_args = argparse.Namespace(batch_size=args.batch_size, optimizer_parameters={}, checkpoint=None,
+                                         length_bucketing=False, num_workers=0, pin_memory=False,
+                                         input_dtype=input_dtype, autocast=autocast)
+        solver = Solver(model, solver_args, eval=True)
+        predictions = torch.tensor(solver.predict(data_set)['predict_result'].to_numpy(dtype='float32'))
+        if reference is None:
+            reference = predictions
+        difference = (predictions - reference).abs().max().item()
+        changed = int(((predictions >= 0.5) != (reference >= 0.5)).sum())
+        failed |= difference > args.tolerance or changed > 0
+        print(f"{input_dtype:>12} {str(autocast):>9} {difference:>13.2e} {changed:>15d}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
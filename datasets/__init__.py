@@ -1,4 +1,7 @@
 from .embeddings_dataset import *
+from .samplers import *
+from .sliding_windows import *
+from .subsets import *
 from .transforms import *
 
 
@@ -0,0 +1,95 @@
+import multiprocessing
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+
+class EmbeddingCache():
+    """
+    In-process least recently used cache for embeddings with a budget in bytes. The arrays are stored as they come
+    from the embeddings file, so fp16 embeddings take up half the space of their float32 version.
+
+    A cache that DataLoader worker processes fill would only hold the samples that each worker happens to load, which
+    differ from epoch to epoch when the samples are shuffled. For workers the cache is therefore filled in the main
+    process and frozen before they start, the forked workers share it and only read from it. The hit, miss and
+    eviction counters and the number of cached bytes live in shared memory, so they add up over all the worker
+    processes.
+    """
+
+    HITS, MISSES, EVICTIONS, BYTES = range(4)
+
+    def __init__(self, max_bytes: int):
+        """
+
+        Args:
+            max_bytes: maximum number of bytes of the cached arrays per process
+        """
+        self.max_bytes = int(max_bytes)
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.frozen = False
+        self.counters = multiprocessing.Array('q', 4)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        embedding = self.entries.get(key)
+        if embedding is None:
+            self._count(self.MISSES)
+            return None
+        if not self.frozen:
+            self.entries.move_to_end(key)
+        self._count(self.HITS)
+        return embedding
+
+    def put(self, key: str, embedding: np.ndarray):
+        if self.frozen or embedding.nbytes > self.max_bytes or key in self.entries:
+            return
+        while self.nbytes + embedding.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self._count(self.EVICTIONS)
+            self._count(self.BYTES, -evicted.nbytes)
+        self.entries[key] = embedding
+        self.nbytes += embedding.nbytes
+        self._count(self.BYTES, embedding.nbytes)
+
+    def freeze(self):
+        """Stop adding and evicting embeddings, the cached ones are only read from then on"""
+        self.frozen = True
+
+    def stats(self) -> dict:
+        with self.counters.get_lock():
+            hits, misses, evictions, nbytes = self.counters[:]
+        return {'hits': hits, 'misses': misses, 'evictions': evictions, 'bytes': nbytes}
+
+    def reset_stats(self):
+        """Reset the hit, miss and eviction counters, for instance at the end of every epoch"""
+        with self.counters.get_lock():
+            self.counters[self.HITS] = 0
+            self.counters[self.MISSES] = 0
+            self.counters[self.EVICTIONS] = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def _count(self, counter: int, value: int = 1):
+        with self.counters.get_lock():
+            self.counters[counter] += value
+
+
+def split_cache_budget(max_bytes: int, lengths: Sequence[np.ndarray]) -> List[int]:
+    """
+    Byte budgets of the caches of datasets that share one budget of max_bytes, in proportion to the number of residues
+    of every dataset, so each of them caches about the same share of its embeddings
+    Args:
+        max_bytes: budget of all caches together
+        lengths: sequence lengths of the samples of every dataset
+
+    Returns: budget of every dataset
+
+    """
+    residues = [int(np.sum(dataset_lengths, dtype=np.int64)) for dataset_lengths in lengths]
+    return [int(max_bytes) * dataset_residues // max(sum(residues), 1) for dataset_residues in residues]
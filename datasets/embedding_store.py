@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import List, Sequence
+
+import numpy as np
+
+STORE_INDEX = 'index.sqlite'
+NAMESPACE_FILE = 'namespace.json'
+
+
+def sequence_key(sequence: str) -> str:
+    return hashlib.sha256(sequence.encode()).hexdigest()
+
+
+def store_directory(path: str, protocol: str, precision: str = 'float32') -> str:
+    """namespace directory of the embeddings of protocol in precision in the EmbeddingStore at path, datasets read
+    the embeddings from there"""
+    return os.path.join(path, '{}-{}'.format(protocol, np.dtype(precision)))
+
+
+def is_embedding_store(path: str) -> bool:
+    return path is not None and os.path.isfile(os.path.join(path, NAMESPACE_FILE))
+
+
+class StoredEmbeddings():
+    """
+    Read only view of the embeddings of one embedder protocol and precision in an EmbeddingStore. The embeddings are
+    addressed by their sequence instead of a fasta id, store[sequence] returns the memory mapped embedding, so it
+    can be sliced like an h5py dataset without reading the residues outside of the slice.
+    """
+
+    def __init__(self, directory: str):
+        """
+
+        Args:
+            directory: namespace directory of an EmbeddingStore, see EmbeddingStore.directory
+        """
+        self.directory = directory
+        with open(os.path.join(directory, NAMESPACE_FILE)) as f:
+            self.meta = json.load(f)
+
+    def file(self, sequence: str) -> str:
+        key = sequence_key(sequence)
+        return os.path.join(self.directory, key[:2], key + '.npy')
+
+    def __getitem__(self, sequence: str) -> np.ndarray:
+        return np.load(self.file(sequence), mmap_mode='r')
+
+    def __contains__(self, sequence: str) -> bool:
+        return os.path.exists(self.file(sequence))
+
+    def close(self):
+        pass
+
+
+class EmbeddingStore():
+    """
+    Persistent content addressed store of embeddings that is shared across runs, so a sequence is only embedded
+    once. Every embedding is an npy file named by the sha256 of its sequence, in a namespace directory per embedder
+    protocol and precision. An SQLite index in the root directory records the size and the last lookup of every
+    embedding. If max_bytes is set, the least recently looked up embeddings are evicted when the store grows beyond
+    it. Embeddings that were looked up or added through this instance are never evicted by it, the run still needs
+    them.
+    """
+
+    def __init__(self, path: str, protocol: str, precision: str = 'float32', max_bytes: int = 0):
+        """
+
+        Args:
+            path: root directory of the store, it is created if it does not exist
+            protocol: name of the embedder that produced the embeddings, like prottrans_t5_xl_u50
+            precision: dtype the embeddings are stored in, float16 or float32
+            max_bytes: size cap of all namespaces of the store together, 0 disables eviction
+        """
+        self.path = path
+        self.protocol = protocol
+        self.precision = str(np.dtype(precision))
+        self.max_bytes = max_bytes
+        self.directory = store_directory(path, protocol, precision)
+        self.namespace = os.path.basename(self.directory)
+        os.makedirs(self.directory, exist_ok=True)
+        if not is_embedding_store(self.directory):
+            with open(os.path.join(self.directory, NAMESPACE_FILE), 'w') as f:
+                json.dump({'protocol': protocol, 'precision': self.precision}, f, indent=2)
+        self.embeddings = StoredEmbeddings(self.directory)
+        self.in_use = set()
+        # the store may be filled by a writer thread, it is used by one thread at a time
+        self.connection = sqlite3.connect(os.path.join(path, STORE_INDEX), check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS embeddings (namespace TEXT NOT NULL, key TEXT NOT NULL, '
+                                'nbytes INTEGER NOT NULL, last_access REAL NOT NULL, PRIMARY KEY (namespace, key))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)')
+        self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(nbytes), 0) FROM embeddings').fetchone()[0]
+
+    def lookup(self, sequences: Sequence[str]) -> List[bool]:
+        """
+        Check which sequences are in the store and mark them as recently used
+        Args:
+            sequences: amino acid sequences
+
+        Returns: for every sequence whether its embedding is in the store
+
+        """
+        keys = [sequence_key(sequence) for sequence in sequences]
+        found = set()
+        unique = list(set(keys))
+        for start in range(0, len(unique), 500):  # stay below the limit of variables in a SQLite statement
+            chunk = unique[start:start + 500]
+            rows = self.connection.execute('SELECT key FROM embeddings WHERE namespace = ? AND key IN ({})'.format(
+                ','.join('?' * len(chunk))), [self.namespace] + chunk)
+            found.update(key for key, in rows)
+        self.in_use.update(found)
+        with self.connection:
+            self.connection.executemany('UPDATE embeddings SET last_access = ? WHERE namespace = ? AND key = ?',
+                                        [(time.time(), self.namespace, key) for key in found])
+        return [key in found for key in keys]
+
+    def put(self, sequence: str, embedding: np.ndarray):
+        """
+        Add the embedding of a sequence and evict the least recently used embeddings if the store is too big
+        Args:
+            sequence: amino acid sequence
+            embedding: [length, embeddings_dim] per residue or [embeddings_dim] reduced embedding
+
+        Returns:
+
+        """
+        key = sequence_key(sequence)
+        file = self.embeddings.file(sequence)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file + '.tmp', 'wb') as f:  # readers never see a partly written file
+            np.save(f, np.asarray(embedding, dtype=self.precision))
+        os.replace(file + '.tmp', file)
+        nbytes = os.path.getsize(file)
+        self.in_use.add(key)
+        with self.connection:
+            row = self.connection.execute('SELECT nbytes FROM embeddings WHERE namespace = ? AND key = ?',
+                                          (self.namespace, key)).fetchone()
+            self.total_bytes += nbytes - (row[0] if row else 0)
+            self.connection.execute('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)',
+                                    (self.namespace, key, nbytes, time.time()))
+        if self.max_bytes > 0 and self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """delete the least recently used embeddings of all namespaces until the store is smaller than max_bytes"""
+        evicted = []
+        excess = self.total_bytes - self.max_bytes
+        for namespace, key, nbytes in self.connection.execute('SELECT namespace, key, nbytes FROM embeddings '
+                                                              'ORDER BY last_access'):
+            if excess <= 0:
+                break
+            if namespace == self.namespace and key in self.in_use:
+                continue
+            evicted.append((namespace, key))
+            excess -= nbytes
+        with self.connection:
+            for namespace, key in evicted:
+                file = os.path.join(self.path, namespace, key[:2], key + '.npy')
+                if os.path.exists(file):
+                    os.remove(file)
+                self.connection.execute('DELETE FROM embeddings WHERE namespace = ? AND key = ?', (namespace, key))
+        self.total_bytes = self.max_bytes + excess
+
+    def close(self):
+        self.connection.close()
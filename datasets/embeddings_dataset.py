@@ -1,76 +1,176 @@
-from typing import Tuple
+import os
+from typing import Tuple, Union
 
 import h5py
+import numpy as np
 import torch
-from Bio import SeqIO
 from torch.utils.data import Dataset
 import torch.nn.functional as F
 
+from datasets.embedding_cache import EmbeddingCache
+from datasets.embedding_store import StoredEmbeddings, is_embedding_store
+from datasets.packed_store import PackedEmbeddings, is_packed_embeddings
+from datasets.pooled_embeddings import PooledEmbeddings, is_pooled_embeddings
+from utils.fasta import UNKNOWN_AMINO_ACID, amino_acid_composition, encode_sequences, fasta_key, read_fasta
 from utils.general import AMINO_ACIDS
+from utils.h5_storage import STORAGE_DTYPE_ATTRIBUTE, check_virtual_sources
+from utils.metadata import MetadataRow, SequenceMetadata
 
 
-class EmbeddingsDataset(Dataset):
+def one_hot_encoding(sequence: np.ndarray) -> torch.Tensor:
+    """[length_of_sequence, len(AMINO_ACIDS)] one hot encoding of a sequence given as uint8 ascii codes"""
+    amino_acid_ids = encode_sequences(sequence)
+    if (amino_acid_ids == UNKNOWN_AMINO_ACID).any():
+        raise KeyError('sequence contains letters that are not in AMINO_ACIDS')
+    return F.one_hot(torch.from_numpy(amino_acid_ids.astype(np.int64)), num_classes=len(AMINO_ACIDS))
+
+
+def read_sequence_metadata(remapped_sequences: str, key_format: str = 'hash', max_length: int = float('inf'),
+                           labelled: bool = False, unknown_solubility: bool = True) -> SequenceMetadata:
+    """
+    Read the columnar metadata of the sequences in a remapped fasta file
+    Args:
+        remapped_sequences: remapped_sequences_file.fasta as generated by bio_embeddings
+        key_format: the formatting of the keys in the h5 file [fasta_descriptor_old, fasta_descriptor, hash]
+        max_length: bigger sequences are left out
+        labelled: whether the descriptions contain the solubility label
+        unknown_solubility: whether or not to include sequences with unknown solubility if labelled
+
+    Returns: the SequenceMetadata of the included sequences
+
+    """
+    descriptions, residues, offsets = read_fasta(remapped_sequences)
+    lengths = np.diff(offsets)
+    selected = []
+    ids = []
+    solubility = []
+    for i, description in enumerate(descriptions):
+        if lengths[i] > max_length:
+            continue
+        if labelled:
+            if key_format == 'fasta_descriptor_old':
+                label = description.split(' ')[1].split('-')[-1]
+            else:
+                label = description.split(' ')[2].split('-')[-1]
+            # if unknown solubility is false only the sequences with known solubility are included
+            if not unknown_solubility and label == 'U':
+                continue
+            solubility.append(label)
+        selected.append(i)
+        ids.append(fasta_key(description, key_format))
+    selected = np.array(selected, dtype=np.int64)
+    frequencies = amino_acid_composition(encode_sequences(residues), offsets)
+    return SequenceMetadata(ids, residues, offsets[selected], lengths[selected], frequencies[selected],
+                            solubility if labelled else None)
+
+
+class H5EmbeddingsDataset(Dataset):
+    """
+    Base class for datasets that read from an h5 file, a PackedEmbeddings directory written by pack_embeddings.py, a
+    namespace directory of an EmbeddingStore, whose embeddings are keyed by their sequence instead of the id, or a
+    pooled embeddings file written by pool_embeddings.py, which holds one [2 * embeddings_dim] vector per protein.
+    h5py file handles can not be shared between the processes of DataLoader workers, so the file is opened lazily on
+    first access, once per process.
+    """
+
+    def __init__(self, embeddings_path: str = None) -> None:
+        super().__init__()
+        self.embeddings_path = embeddings_path
+        self._embeddings_file = None
+        self._embeddings_pid = None
+        self.keyed_by_sequence = is_embedding_store(embeddings_path)
+        self.pooled = is_pooled_embeddings(embeddings_path)
+        self.bfloat16 = False  # whether the h5 file stores bfloat16 embeddings as uint16
+
+    @property
+    def embeddings_file(self) -> Union[h5py.File, PackedEmbeddings, StoredEmbeddings, PooledEmbeddings]:
+        if self._embeddings_file is None or self._embeddings_pid != os.getpid():
+            if is_packed_embeddings(self.embeddings_path):
+                self._embeddings_file = PackedEmbeddings(self.embeddings_path)
+            elif self.pooled:
+                self._embeddings_file = PooledEmbeddings(self.embeddings_path)
+            elif self.keyed_by_sequence:
+                self._embeddings_file = StoredEmbeddings(self.embeddings_path)
+            else:
+                self._embeddings_file = h5py.File(self.embeddings_path, 'r')
+                check_virtual_sources(self._embeddings_file)
+                self.bfloat16 = self._embeddings_file.attrs.get(STORAGE_DTYPE_ATTRIBUTE) == 'bfloat16'
+            self._embeddings_pid = os.getpid()
+        return self._embeddings_file
+
+    @property
+    def embeddings_dim(self) -> int:
+        """size of the per residue embeddings that a model of the dataset is built for, pooled vectors hold the mean and
+        the max of them and are twice as wide. The width is taken from the shape of the first stored embedding, which is
+        not read, so neither a read nor the embedding cache is involved"""
+        embedding_mode = getattr(self, 'embedding_mode', 'lm')
+        if embedding_mode == 'onehot':
+            return len(AMINO_ACIDS)
+        if self.pooled:
+            return self.embeddings_file.vectors.shape[-1] // 2
+        metadata = self.metadata[0]
+        key = self.embedding_key(metadata) if embedding_mode == 'lm' else metadata['sequence']
+        return self.embeddings_file[key].shape[-1]
+
+    def read(self, key: str, residues: slice = slice(None)) -> np.ndarray:
+        """read the residues in the slice residues of the embedding stored under key in its on-disk dtype, bfloat16
+        embeddings stay uint16, see as_embedding"""
+        return self.embeddings_file[key][residues]
+
+    def as_embedding(self, embedding: np.ndarray) -> Union[np.ndarray, torch.Tensor]:
+        """embedding returned by read in a dtype that torch can batch, bfloat16 embeddings that are stored as uint16
+        become a bfloat16 tensor that shares their memory, so they keep their two bytes per value until the batch is
+        cast on the device"""
+        if not self.bfloat16:
+            return embedding
+        return torch.from_numpy(np.ascontiguousarray(embedding).view(np.int16)).view(torch.bfloat16)
+
+    def embedding_key(self, metadata: MetadataRow) -> str:
+        """key of the language model embedding of a sample in the embeddings file"""
+        return metadata['sequence'] if self.keyed_by_sequence else metadata['id']
+
+    def __getstate__(self) -> dict:
+        # workers that are spawned instead of forked get a pickled copy of the dataset without the open handle
+        state = self.__dict__.copy()
+        state['_embeddings_file'] = None
+        state['_embeddings_pid'] = None
+        return state
+
+
+class EmbeddingsDataset(H5EmbeddingsDataset):
     def __init__(self, embeddings_path: str, remapped_sequences: str, unknown_solubility: bool = True,
                  key_format:str = 'hash',
                  max_length: int = float('inf'),
                  embedding_mode: str = 'lm',
-                 transform=lambda x: x) -> None:
+                 transform=lambda x: x,
+                 cache_bytes: int = 0) -> None:
         """Create dataset.
         Args:
             embeddings_path:  path to .hdf5 .h5 file with embeddings as generated by the bio_embeddings pipeline, or the profiles (pssms) in an h5 file, or None if embedding_mode is 'onehot'
                 https://github.com/sacdallago/bio_embeddings. Can either be a file of reduced fixed length embeddings or of
-                variable length embeddings.
+                variable length embeddings. A directory written by pack_embeddings.py can be used instead of the h5 file.
             remapped_sequences: remapped_sequences_file.fasta as generated by bio_embeddings where the ids in the
                 annotations are the keys for the .h5 file in the embeddings path
             unknown_solubility: Whether or not to include sequences with unknown solubility in the dataset
             transform: Pytorch torchvision transforms that should be applied to each sample
             max_length: bigger sequences wont be taken into the dataset
             embedding_mode: ['lm', 'onehot', 'profiles'] what type of protein encoding to return (lm stands for language model) the embeddings_file needs to be either the lm embeddings or the profiles or none if embedding_mode is 'onehot'
+            cache_bytes: byte budget of the least recently used cache of embeddings read from the embeddings file, 0 disables the cache
         """
-        super().__init__()
+        super().__init__(embeddings_path)
         self.transform = transform
         self.embedding_mode = embedding_mode
-        if self.embedding_mode == 'lm' or self.embedding_mode == 'profiles':
-            self.embeddings_file = h5py.File(embeddings_path, 'r')
-        self.solubility_metadata_list = []
+        self.cache = EmbeddingCache(cache_bytes) if cache_bytes > 0 else None
+        self.metadata = read_sequence_metadata(remapped_sequences, key_format, max_length, labelled=True,
+                                               unknown_solubility=unknown_solubility)
         # self.class_weights = torch.zeros(10)
         self.one_hot_enc = []
-        for record in SeqIO.parse(open(remapped_sequences), 'fasta'):
-            if key_format == 'hash':
-                solubility = record.description.split(' ')[2].split('-')[-1]
-                id = str(record.id)
-            elif key_format == 'fasta_descriptor':
-                solubility = record.description.split(' ')[2].split('-')[-1]
-                id = str(record.description.split(' ')[0]).replace('.','_').replace('/','_')
-            elif key_format == 'fasta_descriptor_old':
-                solubility = record.description.split(' ')[1].split('-')[-1]
-                id = str(record.description)
-            else:
-                raise Exception('Unknown key_format: ', key_format)
-            if len(record.seq) <= max_length:
-                if self.embedding_mode == 'onehot':
-                    amino_acid_ids = []
-                    for char in record.seq:
-                        amino_acid_ids.append(AMINO_ACIDS[char])
-                    one_hot_enc = F.one_hot(torch.tensor(amino_acid_ids), num_classes=len(AMINO_ACIDS))
-                    self.one_hot_enc.append(one_hot_enc)
-                frequencies = torch.zeros(25)
-                for i, aa in enumerate(AMINO_ACIDS):
-                    frequencies[i] = str(record.seq).count(aa)
-                frequencies /= len(record.seq)
-                metadata = {'id': id,
-                            'sequence': str(record.seq),
-                            'length': len(record.seq),
-                            'frequencies': frequencies,
-                            'solubility_known': not (solubility == 'U')}
-
-                # if unknown solubility is false only the sequences with known solubility are included
-                if unknown_solubility or not (solubility == 'U'):
-                    self.solubility_metadata_list.append(
-                        {'solubility': solubility, 'metadata': metadata})
-
-
-    def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, dict]:
+        if self.embedding_mode == 'onehot':
+            self.one_hot_enc = [one_hot_encoding(self.metadata.residues[start:start + length])
+                                for start, length in zip(self.metadata.starts, self.metadata.lengths)]
+
+
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, MetadataRow]:
         """retrieve single sample from the dataset
 
         Args:
@@ -82,68 +182,90 @@ class EmbeddingsDataset(Dataset):
             localization: localization in the format specified by the given transform.
             solubility: solubility as specified by a transform.
         """
-        solubility_metadata = self.solubility_metadata_list[index]
+        metadata = self.metadata[index]
         if self.embedding_mode == 'lm':
-            embedding = self.embeddings_file[solubility_metadata['metadata']['id']][:]
+            embedding = self.as_embedding(self.read_embedding(self.embedding_key(metadata)))
         elif self.embedding_mode == 'profiles':
-            embedding = self.embeddings_file[solubility_metadata['metadata']['sequence']][:]
+            embedding = self.as_embedding(self.read_embedding(metadata['sequence']))
         elif self.embedding_mode == 'onehot':
             embedding = self.one_hot_enc[index]
         else:
             raise Exception('embedding_mode {} not supported'.format(self.embedding_mode))
 
         embedding, solubility = self.transform(
-            (embedding,solubility_metadata['solubility']))
+            (embedding, str(self.metadata.solubility[index])))
+
+        return embedding, solubility, metadata
+
+    def read_embedding(self, key: str) -> np.ndarray:
+        """read the embedding stored under key in its on-disk dtype, from the cache if it is enabled"""
+        if self.cache is None:
+            return self.read(key)
+        embedding = self.cache.get(key)
+        if embedding is None:
+            embedding = self.read(key)
+            self.cache.put(key, embedding)
+        return embedding
 
-        return embedding, solubility, solubility_metadata['metadata']
+    def fill_cache(self):
+        """
+        Read the embeddings in the order of the samples into the cache until its byte budget is full and freeze it.
+        This is done in the main process before the DataLoader workers start, so every worker reads the same cached
+        embeddings in every epoch instead of filling a cache of its own.
+        """
+        if self.cache is None or self.cache.frozen or self.embedding_mode == 'onehot':
+            return
+        row_bytes = None  # bytes per residue, or per protein for reduced embeddings, known after the first read
+        per_residue = True
+        for index in range(len(self)):
+            metadata = self.metadata[index]
+            key = self.embedding_key(metadata) if self.embedding_mode == 'lm' else metadata['sequence']
+            if key in self.cache:
+                continue
+            # the size follows from the length in the metadata, so an embedding that does not fit is never read
+            if row_bytes is not None and self.cache.nbytes + row_bytes * (
+                    int(self.metadata.lengths[index]) if per_residue else 1) > self.cache.max_bytes:
+                break
+            embedding = self.read(key)
+            if row_bytes is None:
+                per_residue = embedding.ndim > 1
+                row_bytes = embedding.nbytes // (len(embedding) if per_residue else 1)
+            if self.cache.nbytes + embedding.nbytes > self.cache.max_bytes:
+                break
+            self.cache.put(key, embedding)
+        self.cache.freeze()
+        self.cache.reset_stats()  # the misses of filling the cache are no misses of the first epoch
+        print('embedding cache filled with {} of {} embeddings, {:.1f} MB'.format(
+            len(self.cache), len(self), self.cache.nbytes / 2 ** 20))
 
     def __len__(self) -> int:
-        return len(self.solubility_metadata_list)
+        return len(self.metadata)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """sequence length of every sample, used for length bucketing of the batches"""
+        return self.metadata.lengths
 
     
-class Embeddings_predict_Dataset(Dataset):
+class Embeddings_predict_Dataset(H5EmbeddingsDataset):
     def __init__(self, embeddings_path: str, remapped_sequences: str,
                  key_format:str = 'hash',
                  max_length: int = float('inf'),
                  embedding_mode: str = 'lm',
                  transform=lambda x: x) -> None:
         
-        super().__init__()
+        super().__init__(embeddings_path)
         self.transform = transform
         self.embedding_mode = embedding_mode
-        if self.embedding_mode == 'lm' or self.embedding_mode == 'profiles':
-            self.embeddings_file = h5py.File(embeddings_path, 'r')
-        self.solubility_metadata_list = []
+        self.metadata = read_sequence_metadata(remapped_sequences, key_format, max_length)
         # self.class_weights = torch.zeros(10)
         self.one_hot_enc = []
-        for record in SeqIO.parse(open(remapped_sequences), 'fasta'):
-            if key_format == 'hash':
-                id = str(record.id)
-            elif key_format == 'fasta_descriptor':
-                id = str(record.description.split(' ')[0]).replace('.','_').replace('/','_')
-            elif key_format == 'fasta_descriptor_old':
-                id = str(record.description)
-            else:
-                raise Exception('Unknown key_format: ', key_format)
-            if len(record.seq) <= max_length:
-                if self.embedding_mode == 'onehot':
-                    amino_acid_ids = []
-                    for char in record.seq:
-                        amino_acid_ids.append(AMINO_ACIDS[char])
-                    one_hot_enc = F.one_hot(torch.tensor(amino_acid_ids), num_classes=len(AMINO_ACIDS))
-                    self.one_hot_enc.append(one_hot_enc)
-                frequencies = torch.zeros(25)
-                for i, aa in enumerate(AMINO_ACIDS):
-                    frequencies[i] = str(record.seq).count(aa)
-                frequencies /= len(record.seq)
-                metadata = {'id': id,
-                            'sequence': str(record.seq),
-                            'length': len(record.seq),
-                            'frequencies': frequencies}
-                self.solubility_metadata_list.append({'metadata': metadata})
+        if self.embedding_mode == 'onehot':
+            self.one_hot_enc = [one_hot_encoding(self.metadata.residues[start:start + length])
+                                for start, length in zip(self.metadata.starts, self.metadata.lengths)]
                 
 
-    def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, dict]:
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, MetadataRow]:
         """retrieve single sample from the dataset
 
         Args:
@@ -155,20 +277,31 @@ class Embeddings_predict_Dataset(Dataset):
             localization: localization in the format specified by the given transform.
             solubility: solubility as specified by a transform.
         """
-        solubility_metadata = self.solubility_metadata_list[index]
-        # print(solubility_metadata)
+        return self.get_sample(index)
+
+    def get_sample(self, index: int, residues: slice = slice(None)) -> Tuple[torch.Tensor, MetadataRow]:
+        """retrieve the residues in the slice residues of the per residue embedding of a sample, only these residues
+        are read from the embeddings file"""
+        metadata = self.metadata[index]
+        if self.pooled and residues != slice(None):
+            raise ValueError('pooled embeddings have no residues that could be split into windows')
         if self.embedding_mode == 'lm':
-            embedding = self.embeddings_file[solubility_metadata['metadata']['id']][:]
+            embedding = self.as_embedding(self.read(self.embedding_key(metadata), residues))
         elif self.embedding_mode == 'profiles':
-            embedding = self.embeddings_file[solubility_metadata['metadata']['sequence']][:]
+            embedding = self.as_embedding(self.read(metadata['sequence'], residues))
         elif self.embedding_mode == 'onehot':
-            embedding = self.one_hot_enc[index]
+            embedding = self.one_hot_enc[index][residues]
         else:
             raise Exception('embedding_mode {} not supported'.format(self.embedding_mode))
 
         embedding = self.transform(embedding)
 
-        return embedding, solubility_metadata['metadata']
+        return embedding, metadata
 
     def __len__(self) -> int:
-        return len(self.solubility_metadata_list)
+        return len(self.metadata)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """sequence length of every sample, used for length bucketing of the batches"""
+        return self.metadata.lengths
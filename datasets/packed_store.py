@@ -0,0 +1,114 @@
+import json
+import os
+from typing import Iterator
+
+import h5py
+import numpy as np
+
+from utils.fasta import fasta_key, read_fasta
+from utils.h5_storage import STORAGE_DTYPE_ATTRIBUTE, check_virtual_sources, decode_bfloat16
+
+EMBEDDINGS_FILE = 'embeddings.npy'
+OFFSETS_FILE = 'offsets.npy'
+LENGTHS_FILE = 'lengths.npy'
+IDS_FILE = 'ids.npy'
+META_FILE = 'meta.json'
+
+
+class PackedEmbeddings():
+    """
+    Read only store of embeddings that are packed into one contiguous [total_residues, embeddings_dim] matrix with an
+    offsets/lengths index and an id table, as written by pack_embeddings. The matrix is memory mapped, so a sample
+    is a zero-copy slice and DataLoader workers share the pages through the OS page cache.
+
+    It can be indexed like an h5py.File, store[id][:] returns the [length, embeddings_dim] embedding of id.
+    """
+
+    def __init__(self, path: str):
+        """
+
+        Args:
+            path: directory written by pack_embeddings
+        """
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.embeddings = np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE))
+        self.lengths = np.load(os.path.join(path, LENGTHS_FILE))
+        self.index = {key.decode(): i for i, key in enumerate(np.load(os.path.join(path, IDS_FILE)))}
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        i = self.index[key]
+        if self.meta['reduced']:  # per protein embeddings are stored as rows of length one
+            return self.embeddings[self.offsets[i]]
+        return self.embeddings[self.offsets[i]:self.offsets[i] + self.lengths[i]]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def close(self):
+        self.embeddings = None
+
+
+def is_packed_embeddings(path: str) -> bool:
+    return path is not None and os.path.isfile(os.path.join(path, META_FILE))
+
+
+def pack_embeddings(embeddings_path: str, remapped_sequences: str, output_path: str, key_format: str = 'hash',
+                    dtype: str = 'float16') -> int:
+    """
+    Pack the per protein datasets of an h5 file written by bio_embeddings into a PackedEmbeddings directory.
+    Args:
+        embeddings_path: h5 file with one dataset per protein
+        remapped_sequences: remapped fasta file that determines the order of the proteins in the packed matrix
+        output_path: directory to write the packed store to
+        key_format: formatting of the keys in the h5 file [fasta_descriptor_old, fasta_descriptor, hash]
+        dtype: dtype of the packed matrix
+
+    Returns: number of packed proteins
+
+    """
+    os.makedirs(output_path, exist_ok=True)
+    with h5py.File(embeddings_path, 'r') as f:
+        check_virtual_sources(f)
+        keys = []
+        descriptions, _, _ = read_fasta(remapped_sequences)
+        for key in [fasta_key(description, key_format) for description in descriptions]:
+            if key in f:
+                keys.append(key)
+            else:
+                print(f"Skipping {key}, it is in the fasta file but not in {embeddings_path}")
+        if not keys:
+            raise ValueError('none of the fasta records of {} are in {}'.format(remapped_sequences, embeddings_path))
+        reduced = f[keys[0]].ndim == 1
+        lengths = np.array([1 if reduced else f[key].shape[0] for key in keys], dtype=np.int64)
+        offsets = np.zeros(len(keys), dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)[:-1]
+        embeddings_dim = f[keys[0]].shape[-1]
+
+        embeddings = np.lib.format.open_memmap(os.path.join(output_path, EMBEDDINGS_FILE), mode='w+',
+                                               dtype=np.dtype(dtype), shape=(int(lengths.sum()), embeddings_dim))
+        bfloat16 = f.attrs.get(STORAGE_DTYPE_ATTRIBUTE) == 'bfloat16'
+        for key, offset, length in zip(keys, offsets, lengths):
+            embedding = decode_bfloat16(f[key][:]) if bfloat16 else f[key][:]
+            embeddings[offset:offset + length] = embedding.reshape(length, embeddings_dim)
+        embeddings.flush()
+        del embeddings
+
+    np.save(os.path.join(output_path, OFFSETS_FILE), offsets)
+    np.save(os.path.join(output_path, LENGTHS_FILE), lengths)
+    np.save(os.path.join(output_path, IDS_FILE), np.array([key.encode() for key in keys]))
+    with open(os.path.join(output_path, META_FILE), 'w') as f:
+        json.dump({'dtype': str(np.dtype(dtype)), 'embeddings_dim': int(embeddings_dim), 'reduced': reduced,
+                   'source': os.path.abspath(embeddings_path)}, f, indent=2)
+    return len(keys)
@@ -0,0 +1,157 @@
+import os
+from typing import Iterator, Sequence
+
+import h5py
+import numpy as np
+
+from utils.h5_storage import STORAGE_DTYPE_ATTRIBUTE, check_virtual_sources, decode_bfloat16
+
+POOLING = 'mean,max'
+VECTORS_DATASET = 'vectors'
+IDS_DATASET = 'ids'
+
+
+def pool_embedding(embedding: np.ndarray) -> np.ndarray:
+    """
+    Mean and max over the residues of a [length, embeddings_dim] per residue embedding, like the AvgMaxPool transform.
+    Only the residues of the protein are pooled, never the padding of a batch.
+    Args:
+        embedding: per residue embedding of one protein
+
+    Returns: [2 * embeddings_dim] float32 vector, the mean followed by the max
+
+    """
+    embedding = np.asarray(embedding, dtype=np.float32)
+    return np.concatenate([embedding.mean(axis=0), embedding.max(axis=0)])
+
+
+def is_pooled_embeddings(path: str) -> bool:
+    if path is None or not os.path.isfile(path) or not h5py.is_hdf5(path):
+        return False
+    with h5py.File(path, 'r') as f:
+        return f.attrs.get('pooling') == POOLING
+
+
+class PooledEmbeddings():
+    """
+    Read only view of a pooled embeddings file written by PooledEmbeddingsWriter, one [2 * embeddings_dim] row of mean
+    and max pooled residues per protein in an [N, 2 * embeddings_dim] dataset with an id table. A model that only
+    uses the pooled form reads about 1/length of the data of the per residue embeddings.
+
+    It can be indexed like an h5py.File, pooled[id] returns the pooled vector of id.
+    """
+
+    def __init__(self, path: str):
+        """
+
+        Args:
+            path: h5 file written by PooledEmbeddingsWriter
+        """
+        self.file = h5py.File(path, 'r')
+        rows = int(self.file.attrs.get('rows', 0))
+        self.vectors = self.file[VECTORS_DATASET]
+        self.index = {key: i for i, key in enumerate(self.file[IDS_DATASET].asstr()[:rows])}
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        return self.vectors[self.index[key]]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def close(self):
+        self.file.close()
+
+
+class PooledEmbeddingsWriter():
+    """
+    Appends pooled vectors to a pooled embeddings file. The rows attribute counts the complete rows and is only
+    updated after the vectors and ids of a batch are flushed, so rows after an interruption are dropped when the file
+    is opened again and the proteins in ids are the ones that are already pooled.
+    """
+
+    def __init__(self, path: str, dtype: str = 'float32'):
+        """
+
+        Args:
+            path: pooled embeddings file, an existing file is continued
+            dtype: dtype of the pooled vectors in a new file
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = h5py.File(path, 'a')
+        self.dtype = dtype
+        self.rows = int(self.file.attrs.get('rows', 0))
+        self.ids = set()
+        if IDS_DATASET in self.file:
+            self.ids = set(self.file[IDS_DATASET].asstr()[:self.rows])
+            for name in [VECTORS_DATASET, IDS_DATASET]:
+                self.file[name].resize(self.rows, axis=0)
+
+    def add(self, ids: Sequence[str], embeddings: Sequence[np.ndarray]):
+        """
+        Pool per residue embeddings and append them, ids that are already in the file are skipped
+        Args:
+            ids: protein ids
+            embeddings: [length, embeddings_dim] per residue embeddings of the proteins
+
+        Returns:
+
+        """
+        new = [(key, embedding) for key, embedding in zip(ids, embeddings) if key not in self.ids]
+        if not new:
+            return
+        vectors = np.stack([pool_embedding(embedding) for _, embedding in new])
+        if VECTORS_DATASET not in self.file:
+            self.file.create_dataset(VECTORS_DATASET, shape=(0, vectors.shape[1]), maxshape=(None, vectors.shape[1]),
+                                     dtype=self.dtype, chunks=(256, vectors.shape[1]))
+            self.file.create_dataset(IDS_DATASET, shape=(0,), maxshape=(None,), dtype=h5py.string_dtype())
+            self.file.attrs['pooling'] = POOLING
+        end = self.rows + len(new)
+        for name in [VECTORS_DATASET, IDS_DATASET]:
+            self.file[name].resize(end, axis=0)
+        self.file[VECTORS_DATASET][self.rows:end] = vectors
+        self.file[IDS_DATASET][self.rows:end] = [key for key, _ in new]
+        self.file.flush()
+        self.rows = end
+        self.file.attrs['rows'] = self.rows
+        self.file.flush()
+        self.ids.update(key for key, _ in new)
+
+    def close(self):
+        self.file.close()
+
+
+def pool_h5_file(embeddings_path: str, pooled_path: str, dtype: str = 'float32', chunk_size: int = 1000) -> int:
+    """
+    Add the pooled vectors of the per residue embeddings in an h5 file that are not in the pooled embeddings file yet
+    Args:
+        embeddings_path: h5 file with one [length, embeddings_dim] dataset per protein
+        pooled_path: pooled embeddings file to create or continue
+        dtype: dtype of the pooled vectors in a new file
+        chunk_size: number of proteins that are read and pooled at once
+
+    Returns: number of pooled proteins that were added
+
+    """
+    writer = PooledEmbeddingsWriter(pooled_path, dtype)
+    added = 0
+    with h5py.File(embeddings_path, 'r') as f:
+        check_virtual_sources(f)
+        # groups, like the staging group of an interrupted batch, hold no complete embeddings
+        bfloat16 = f.attrs.get(STORAGE_DTYPE_ATTRIBUTE) == 'bfloat16'
+        missing = [key for key in f.keys() if key not in writer.ids and isinstance(f[key], h5py.Dataset)]
+        for start in range(0, len(missing), chunk_size):
+            keys = missing[start:start + chunk_size]
+            writer.add(keys, [decode_bfloat16(f[key][:]) if bfloat16 else f[key][:] for key in keys])
+            added += len(keys)
+    writer.close()
+    return added
@@ -0,0 +1,96 @@
+import collections
+from typing import Iterator, List, Sequence
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler that groups proteins of similar length so that a batch is only padded to the length of its
+    longest member instead of the longest protein that happened to be drawn with it.
+
+    The indices are split into buckets of batch_size * bucket_size_multiplier consecutive (or, when shuffling,
+    randomly permuted) samples. Every bucket is sorted by length and cut into batches. When shuffling, the batches
+    of all buckets are shuffled as well, so the order in which length ranges are seen still changes every epoch.
+    Without shuffling no global sort takes place and the batches are formed one bucket at a time, which means a
+    consumer only has to hold one bucket to restore the original order of the dataset. With shuffling the batches
+    of an epoch are kept as one int64 array of indices and the offsets of the batches.
+
+    If record_batches is set, every yielded batch is appended to the deque yielded_batches, from which a consumer
+    that needs the dataset indices of the batches it gets from a DataLoader takes them with popleft. The DataLoader
+    keeps the order of the sampler, so the deque only holds the batches that are prefetched.
+    """
+
+    def __init__(self, lengths: Sequence[int], batch_size: int, bucket_size_multiplier: int = 100,
+                 shuffle: bool = True, drop_last: bool = False, seed: int = None, record_batches: bool = False):
+        """
+
+        Args:
+            lengths: sequence length of every sample in the dataset
+            batch_size: number of samples per batch
+            bucket_size_multiplier: number of batches that are formed out of one sorted bucket
+            shuffle: whether to shuffle the samples before bucketing and the batches after bucketing
+            drop_last: drop the batches that end up smaller than batch_size
+            seed: seed of the random generator that is used for shuffling
+            record_batches: append every yielded batch to yielded_batches
+        """
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * max(1, bucket_size_multiplier)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = np.random.default_rng(seed)
+        self.record_batches = record_batches
+        self.yielded_batches = collections.deque()
+
+    def __iter__(self) -> Iterator[List[int]]:
+        self.yielded_batches.clear()
+        if self.shuffle:
+            batches = self.shuffled_batches()
+        else:
+            batches = (batch for start in range(0, len(self.lengths), self.bucket_size)
+                       for batch in self.bucket_batches(np.arange(start, min(start + self.bucket_size,
+                                                                             len(self.lengths)))))
+        for batch in batches:
+            batch = batch.tolist()
+            if self.record_batches:
+                self.yielded_batches.append(batch)
+            yield batch
+
+    def sorted_bucket(self, bucket: np.ndarray) -> np.ndarray:
+        """the bucket sorted by length, without the samples of an incomplete last batch if drop_last is set"""
+        bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+        if self.drop_last:
+            bucket = bucket[:len(bucket) - len(bucket) % self.batch_size]
+        return bucket
+
+    def bucket_batches(self, bucket: np.ndarray) -> Iterator[np.ndarray]:
+        """the batches of one bucket"""
+        bucket = self.sorted_bucket(bucket)
+        for start in range(0, len(bucket), self.batch_size):
+            yield bucket[start:start + self.batch_size]
+
+    def shuffled_batches(self) -> Iterator[np.ndarray]:
+        """the batches of all buckets of a random permutation of the samples, in random order"""
+        indices = self.generator.permutation(len(self.lengths))
+        order = np.empty(len(indices), dtype=np.int64)
+        offsets = []  # start of every batch in order, the batches of a bucket follow each other
+        size = 0
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = self.sorted_bucket(indices[start:start + self.bucket_size])
+            order[size:size + len(bucket)] = bucket
+            offsets.append(np.arange(size, size + len(bucket), self.batch_size, dtype=np.int64))
+            size += len(bucket)
+        offsets = np.concatenate(offsets + [np.array([size], dtype=np.int64)])
+        for batch in self.generator.permutation(len(offsets) - 1):
+            yield order[offsets[batch]:offsets[batch + 1]]
+
+    def __len__(self) -> int:
+        # every bucket except for the last one has a multiple of batch_size samples
+        full_buckets, remainder = divmod(len(self.lengths), self.bucket_size)
+        batches_per_bucket = self.bucket_size // self.batch_size
+        if self.drop_last:
+            return full_buckets * batches_per_bucket + remainder // self.batch_size
+        return full_buckets * batches_per_bucket + -(-remainder // self.batch_size)
+
@@ -0,0 +1,76 @@
+from typing import Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from utils.metadata import MetadataRow
+
+WINDOW_AGGREGATIONS = ['mean', 'max']
+
+
+class SlidingWindowDataset(Dataset):
+    """
+    Splits the per residue embeddings of an Embeddings_predict_Dataset that are longer than window_size into
+    overlapping windows of window_size residues, so that the windows of long proteins are batched like short
+    proteins and neither the peak memory nor the time of a batch depends on the longest protein of the input.
+    Proteins that fit into one window are a single window. The last window of a protein ends at its last residue.
+
+    The windows of a protein are consecutive samples, aggregate combines the predictions of all windows, given in
+    the order of the samples, into one prediction per protein.
+    """
+
+    def __init__(self, dataset: Dataset, window_size: int, window_overlap: int = 0):
+        """
+
+        Args:
+            dataset: dataset with a lengths attribute and a get_sample(index, residues) method like
+                Embeddings_predict_Dataset
+            window_size: maximum number of residues of a window
+            window_overlap: number of residues that consecutive windows of a protein share
+        """
+        if not 0 <= window_overlap < window_size:
+            raise ValueError('window_overlap {} has to be smaller than window_size {}'.format(window_overlap,
+                                                                                            window_size))
+        self.dataset = dataset
+        lengths = np.asarray(dataset.lengths, dtype=np.int64)
+        stride = window_size - window_overlap
+        self.window_counts = np.where(lengths > window_size, -(-(lengths - window_size) // stride) + 1, 1)
+        self.first_windows = np.cumsum(self.window_counts) - self.window_counts
+        self.proteins = np.repeat(np.arange(len(lengths)), self.window_counts)
+        positions = np.arange(len(self.proteins)) - self.first_windows[self.proteins]
+        self.starts = np.minimum(positions * stride, np.maximum(lengths - window_size, 0)[self.proteins])
+        self.ends = np.minimum(self.starts + window_size, lengths[self.proteins])
+
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, MetadataRow]:
+        return self.dataset.get_sample(int(self.proteins[index]), slice(int(self.starts[index]),
+                                                                        int(self.ends[index])))
+
+    def __len__(self) -> int:
+        return len(self.proteins)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """number of residues of every window, used for length bucketing of the batches"""
+        return self.ends - self.starts
+
+    def aggregate(self, predictions: np.ndarray, aggregation: str = 'mean', proteins: slice = slice(None)) -> np.ndarray:
+        """
+        Combine the predictions of the windows into one prediction per protein
+        Args:
+            predictions: [number of windows, ...] predictions of all windows of proteins in the order of the windows
+            aggregation: 'mean' or 'max' of the predictions of the windows of a protein
+            proteins: consecutive proteins whose windows are predictions, all proteins by default
+
+        Returns: [number of proteins, ...] predictions in the order of the proteins of the dataset
+
+        """
+        counts = self.window_counts[proteins]
+        first_windows = self.first_windows[proteins] - self.first_windows[proteins][:1]
+        if aggregation == 'mean':
+            counts = counts.reshape((-1,) + (1,) * (predictions.ndim - 1))
+            return (np.add.reduceat(predictions, first_windows, axis=0) / counts).astype(predictions.dtype)
+        elif aggregation == 'max':
+            return np.maximum.reduceat(predictions, first_windows, axis=0)
+        raise ValueError('window aggregation {} not supported, use one of {}'.format(aggregation,
+                                                                                     WINDOW_AGGREGATIONS))
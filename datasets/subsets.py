@@ -0,0 +1,23 @@
+from typing import Sequence
+
+import numpy as np
+from torch.utils.data import Dataset, Subset
+
+
+class LengthSubset(Subset):
+    """
+    Subset of a dataset that keeps the lengths attribute of the dataset, so it can be batched by the
+    LengthBucketBatchSampler, and its get_sample method, so it can be split by the SlidingWindowDataset. Index i of
+    the subset is sample indices[i] of the dataset.
+    """
+
+    def __init__(self, dataset: Dataset, indices: Sequence[int]):
+        super().__init__(dataset, indices)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """sequence length of every sample of the subset, used for length bucketing of the batches"""
+        return np.asarray(self.dataset.lengths)[np.asarray(self.indices, dtype=np.int64)]
+
+    def get_sample(self, index: int, residues: slice = slice(None)):
+        return self.dataset.get_sample(self.indices[index], residues)
@@ -3,7 +3,7 @@ from typing import Tuple, Union
 import torch
 import numpy as np
 
-from utils.general import SOLUBILITY
+from utils.general import SOLUBILITY, as_tensor
 
 
 class ToTensor():
@@ -11,12 +11,21 @@ class ToTensor():
     Turn np.array into torch.Tensor.
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, dtype: torch.dtype = torch.float32):
+        """
+
+        Args:
+            dtype: dtype of the embedding tensor. If None, the array is wrapped without a copy in its on-disk dtype and
+                the conversion is left to the collate function, see PaddedCollate in utils/general.py
+        """
+        self.dtype = dtype
 
     def __call__(self, sample: Tuple[np.ndarray, int, int]) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         embedding, solubility = sample
-        embedding = torch.tensor(embedding).float()
+        if self.dtype is None:
+            embedding = as_tensor(embedding)
+        else:
+            embedding = torch.tensor(embedding).to(self.dtype)
     
         solubility = torch.tensor(solubility).long()
         return embedding, solubility
@@ -27,16 +36,48 @@ class predict_ToTensor():
     Turn np.array into torch.Tensor.
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, dtype: torch.dtype = torch.float32):
+        """
+
+        Args:
+            dtype: dtype of the embedding tensor. If None, the array is wrapped without a copy in its on-disk dtype and
+                the conversion is left to the collate function, see PaddedCollate in utils/general.py
+        """
+        self.dtype = dtype
 
     def __call__(self, sample: Tuple[np.ndarray, int, int]) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         embedding= sample
-        embedding = torch.tensor(embedding).float()
+        if self.dtype is None:
+            embedding = as_tensor(embedding)
+        else:
+            embedding = torch.tensor(embedding).to(self.dtype)
     
         return embedding
 
 
+class RandomCrop():
+    """
+    Crop per residue embeddings that are longer than window to a randomly placed window of window residues, so that
+    a few very long proteins do not dominate the memory and the time of their training batches.
+    """
+
+    def __init__(self, window: int = 1000):
+        """
+
+        Args:
+            window: maximum number of residues of a cropped embedding
+        """
+        self.window = window
+
+    def __call__(self, sample: Tuple[np.ndarray, int]) -> Tuple[np.ndarray, int]:
+        embedding, solubility = sample
+        if embedding.ndim < 2 or embedding.shape[0] <= self.window:  # reduced embeddings and short proteins
+            return embedding, solubility
+        # torch instead of numpy random numbers, DataLoader workers get different torch seeds
+        start = int(torch.randint(embedding.shape[0] - self.window + 1, (1,)))
+        return embedding[start:start + self.window], solubility
+
+
 class AvgMaxPool():
     """
     Pools embeddings along dim and concatenates max and avg pool
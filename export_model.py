@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Export the checkpoint of an inference config to TorchScript and/or ONNX with dynamic batch and sequence length axes,
+so inference.py can run it with --runtime torchscript or --runtime onnxruntime and --exported_model <file>.
+
+Usage:
+  python export_model.py --config ./configs/inference_Sol_biLSTM_TextCNN.yml --output ./model_param/model_param
+"""
+
+import argparse
+
+import torch
+import torch.nn as nn
+
+from inference import add_train_arguments, parse_arguments
+from models import *  # For loading classes specified in config
+from utils.export import EXPORT_FORMATS, export_model
+from utils.general import AMINO_ACIDS
+
+EXPORT_SUFFIXES = {'torchscript': '.torchscript.pt', 'onnx': '.onnx'}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export a checkpoint to TorchScript and ONNX')
+    parser.add_argument('--config', type=str, required=True,
+                        help='inference config with the checkpoint, its train arguments are read from model_param')
+    parser.add_argument('--output', type=str, required=True,
+                        help='path without suffix, the exports are written to <output>.torchscript.pt and '
+                             '<output>.onnx')
+    parser.add_argument('--formats', type=str, nargs='+', default=EXPORT_FORMATS,
+                        help='export formats, {}'.format(EXPORT_FORMATS))
+    parser.add_argument('--embeddings_dim', type=int, default=1024,
+                        help='size of the language model embeddings the checkpoint was trained on')
+    parser.add_argument('--opset_version', type=int, default=17, help='ONNX opset of the export')
+    return parser.parse_args()
+
+
+def main():
+    export_args = parse_args()
+    args = add_train_arguments(parse_arguments(['--config', export_args.config]))
+    checkpoint = args.checkpoints_list[0]
+    embeddings_dim = len(AMINO_ACIDS) if args.embedding_mode == 'onehot' else export_args.embeddings_dim
+    model: nn.Module = globals()[args.model_type](embeddings_dim=embeddings_dim, **args.model_parameters)
+    model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+    for export_format in export_args.formats:
+        path = export_args.output + EXPORT_SUFFIXES[export_format]
+        export_model(model, path, export_format, embeddings_dim, export_args.opset_version)
+        print(f"Exported {args.model_type} from {checkpoint} to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,19 @@
 """
 Memory-efficient script to generate embeddings using ProtTransT5XLU50Embedder.
 This script processes sequences one by one to minimize memory usage.
+An interrupted run is resumed by running it again, the ids that are already in the h5 file are skipped.
+With --num_processes the sequences are embedded in length balanced shards by several processes, which suits cpu only
+nodes where a single process uses the cores poorly, and the h5 files of the shards are copied into the h5 file.
 """
 
+import contextlib
 import os
+import glob
+import queue
+import subprocess
 import sys
+import threading
+import time
 import h5py
 import torch
 import numpy as np
@@ -14,15 +23,405 @@ from Bio import SeqIO
 import argparse
 import yaml
 
+from datasets.embedding_store import EmbeddingStore
+from datasets.pooled_embeddings import PooledEmbeddingsWriter, pool_h5_file
+from utils.h5_storage import (COMPRESSIONS, STORAGE_DTYPE_ATTRIBUTE, STORAGE_DTYPES, VIRTUAL_SOURCES_ATTRIBUTE,
+                              check_virtual_sources, dataset_options, encode_embedding)
+
+# embedder protocol recorded in the embedding store, embeddings of other embedders are never mixed with these
+EMBEDDER_PROTOCOL = 'prottrans_t5_xl_u50'
+# group of the h5 file that holds the embeddings of a batch until the batch is completely written
+STAGING_GROUP = '_incomplete_batch'
+MERGE_MODES = ['virtual', 'copy']
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Generate embeddings with memory efficiency')
     parser.add_argument('--config', type=str, required=True, 
                         help='Path to the embedding configuration YAML file')
     parser.add_argument('--batch_size', type=int, default=1,
                         help='Batch size for embedding generation (default: 1)')
+    parser.add_argument('--max_residues', type=int, default=0,
+                        help='Sort the sequences by length and batch them by a budget of padded residues instead of '
+                             'batch_size, longer sequences are embedded alone (default: 0, batches of batch_size '
+                             'in file order)')
+    parser.add_argument('--queue_size', type=int, default=4,
+                        help='Number of batches that are formed ahead of the model and that wait to be written '
+                             '(default: 4)')
     parser.add_argument('--half_precision', action='store_true',
                         help='Use half precision (fp16) to reduce memory usage')
-    return parser.parse_args()
+    parser.add_argument('--storage_dtype', type=str, default=None,
+                        help=f'Dtype of the embeddings in the h5 file, {STORAGE_DTYPES} (default: the dtype of the '
+                             f'embedder output)')
+    parser.add_argument('--chunk_residues', type=int, default=0,
+                        help='Residues per HDF5 chunk of an embedding (default: 0, contiguous unless compressed)')
+    parser.add_argument('--compression', type=str, default='none',
+                        help=f'HDF5 compression filter of the embeddings, {COMPRESSIONS} (default: none)')
+    parser.add_argument('--compression_level', type=int, default=4, help='Level of the gzip compression (default: 4)')
+    parser.add_argument('--shuffle', action='store_true',
+                        help='Apply the HDF5 byte shuffle filter before the compression')
+    parser.add_argument('--pooled', action='store_true',
+                        help='Also write the mean and max pooled vector of every protein to pooled_embeddings.h5 '
+                             'next to the h5 file, for models that only use the pooled form')
+    parser.add_argument('--embedding_store', type=str, default=None,
+                        help='Persistent embedding store directory, only sequences that are not in the store are '
+                             'embedded and the new embeddings are added to the store instead of an h5 file')
+    parser.add_argument('--store_max_bytes', type=int, default=0,
+                        help='Size cap of the embedding store, the least recently used embeddings are evicted '
+                             'beyond it (default: 0, no cap)')
+    parser.add_argument('--num_processes', type=int, default=1,
+                        help='Number of embedder processes, the sequences are split in length balanced shards that '
+                             'every process writes to its own h5 file under t5_embeddings/shards, and the shards are '
+                             'merged into embeddings_file.h5 at the end (default: 1)')
+    parser.add_argument('--threads_per_process', type=int, default=0,
+                        help='Torch threads of every embedder process, the processes are pinned to their own cores '
+                             'if there are enough (default: 0, the cores divided by num_processes)')
+    parser.add_argument('--merge', type=str, default='copy',
+                        help=f'How the shards are merged, {MERGE_MODES}. copy copies the embeddings and removes the '
+                             f'shard files, virtual adds an HDF5 virtual dataset per protein that reads from the shard '
+                             f'files, which have to stay next to the h5 file (default: copy)')
+    args = parser.parse_args()
+    if args.embedding_store and (args.storage_dtype or args.chunk_residues or args.compression != 'none'):
+        parser.error('--storage_dtype, --chunk_residues and --compression are options of the h5 file, the embedding '
+                     'store keeps uncompressed npy files')
+    if args.pooled and args.embedding_store:
+        parser.error('--pooled writes the pooled vectors next to the h5 file and can not be used with an embedding '
+                     'store, pool an h5 file with pool_embeddings.py instead')
+    if args.num_processes > 1 and args.embedding_store:
+        parser.error('--num_processes merges the h5 files of the shards and can not be used with an embedding store')
+    if args.merge not in MERGE_MODES:
+        parser.error(f'--merge has to be one of {MERGE_MODES}')
+    return args
+
+
+def token_budget_batches(records, max_residues):
+    """
+    Batches of the records sorted by decreasing length, a batch takes records as long as the batch padded to its
+    longest sequence has at most max_residues residues. The longest sequences come first, so a budget that does not
+    fit in memory fails early, and sequences longer than the budget are embedded alone.
+    """
+    batch = []
+    for record in sorted(records, key=lambda record: len(record.seq), reverse=True):
+        if batch and (len(batch) + 1) * len(batch[0].seq) > max_residues:
+            yield batch
+            batch = []
+        batch.append(record)
+    if batch:
+        yield batch
+
+
+def reset_peak_rss() -> bool:
+    """
+    Start a new peak of peak_rss_megabytes, Linux resets the peak resident memory (VmHWM) of the process when 5 is
+    written to clear_refs. The lifetime peak of getrusage never goes down, so it can not tell the batches apart.
+    Returns whether the peak was reset.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_megabytes(since_reset: bool = True) -> float:
+    """
+    Peak resident memory since reset_peak_rss, or the current resident memory if the peak could not be reset. Without
+    /proc the current resident memory is read with psutil, nan if it is not installed.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(status['VmHWM' if since_reset else 'VmRSS'].split()[0]) / 1e3
+    except (OSError, KeyError, ValueError):
+        try:
+            import psutil
+        except ImportError:
+            return float('nan')
+        return psutil.Process().memory_info().rss / 1e6
+
+
+def load_embedder(args):
+    """import and create the ProtT5 embedder, only when there are sequences to embed"""
+    # Import the embedder here to avoid loading the model until necessary
+    print("Importing ProtTransT5XLU50Embedder...")
+    try:
+        from bio_embeddings.embed import ProtTransT5XLU50Embedder
+    except ImportError as e:
+        print(f"Error importing ProtTransT5XLU50Embedder: {e}")
+        sys.exit(1)
+    
+    # Create embedder with memory-efficient settings
+    print("Creating embedder (this will load the model, which may take time)...")
+    return ProtTransT5XLU50Embedder(
+        half_precision_model=args.half_precision,
+        half_precision=args.half_precision
+    )
+
+
+def embed_with_retries(embedder, records, failures):
+    """
+    Embeddings of a batch of records as (record, embedding) pairs. A batch that fails, for example because it does not
+    fit in memory, is split in halves that are retried, a record that fails alone is appended to failures with its
+    error and skipped.
+    """
+    try:
+        return list(zip(records, embedder.embed_many([str(record.seq) for record in records])))
+    except Exception as e:
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        if len(records) == 1:
+            print(f"Error generating the embedding of {records[0].id}: {e}")
+            failures.append((records[0], e))
+            return []
+        print(f"Error generating embeddings for a batch of {len(records)} sequences, retrying in halves: {e}")
+        middle = len(records) // 2
+        return (embed_with_retries(embedder, records[:middle], failures) +
+                embed_with_retries(embedder, records[middle:], failures))
+
+
+def log_failures(path, failures):
+    """append the time, id, length and error of the records that could not be embedded to the failures log"""
+    if not failures:
+        return
+    with open(path, 'a') as log:
+        for record, error in failures:
+            message = ' '.join(str(error).split())
+            log.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')}\t{record.id}\t{len(record.seq)}\t"
+                      f"{type(error).__name__}: {message}\n")
+
+
+def read_batches(batches, batch_queue, timings):
+    """reader thread that forms the batches ahead of the model, a None in the queue ends them"""
+    try:
+        start = time.time()
+        for batch_records in batches:
+            timings['read'] += time.time() - start
+            batch_queue.put(batch_records)
+            start = time.time()
+    finally:
+        batch_queue.put(None)
+
+
+def write_batches(write_queue, f, store, pooled_writer, args, timings, write_errors):
+    """
+    Writer thread that adds the embedded batches from the queue to the h5 file or the embedding store, and their
+    pooled vectors to the pooled embeddings file if there is a pooled_writer, until it gets None. After an error it
+    keeps taking batches from the queue without writing them, so the model never waits for it, and the main thread
+    raises the error.
+    """
+    while True:
+        embedded = write_queue.get()
+        if embedded is None:
+            return
+        if write_errors:
+            continue
+        start = time.time()
+        try:
+            if store is not None:
+                for record, embedding in embedded:
+                    store.put(str(record.seq), embedding)
+            else:
+                write_batch(f, embedded, args)
+            if pooled_writer is not None:
+                pooled_writer.add([record.id for record, _ in embedded], [embedding for _, embedding in embedded])
+        except Exception as e:
+            write_errors.append(e)
+        timings['write'] += time.time() - start
+
+
+def check_storage_dtype(f, storage_dtype):
+    """record the storage dtype in a new h5 file, a resumed file has to be continued in the dtype it was started with"""
+    stored = f.attrs.get(STORAGE_DTYPE_ATTRIBUTE)
+    if stored is None and len(f.keys()) == 0:
+        if storage_dtype:
+            f.attrs[STORAGE_DTYPE_ATTRIBUTE] = storage_dtype
+    elif (stored or None) != (storage_dtype or None):
+        raise ValueError(f"{f.filename} stores the embeddings as {stored or 'the embedder output'}, resume it with "
+                         f"the same --storage_dtype")
+
+
+def present_ids(embeddings_file):
+    """ids of the complete embeddings in the h5 file of an earlier run, the staging group of an interrupted batch is
+    removed"""
+    if not os.path.exists(embeddings_file):
+        return set()
+    with h5py.File(embeddings_file, 'a') as f:
+        if STAGING_GROUP in f:
+            del f[STAGING_GROUP]
+        return set(f.keys())
+
+
+def write_batch(f, embedded, args):
+    """
+    Write the embeddings of a batch to the h5 file in the storage dtype, chunks and compression of args. They are
+    written to the staging group and flushed before they are moved to their ids, so after an interruption every id in
+    the file has its complete embedding.
+    """
+    if not embedded:
+        return
+    staging = f.require_group(STAGING_GROUP)
+    for record, embedding in embedded:
+        if args.storage_dtype:
+            embedding = encode_embedding(embedding, args.storage_dtype)
+        staging.create_dataset(record.id, data=embedding,
+                               **dataset_options(np.shape(embedding), args.chunk_residues, args.compression,
+                                                 args.compression_level, args.shuffle))
+    f.flush()
+    for record, _ in embedded:
+        f.move(f"{STAGING_GROUP}/{record.id}", record.id)
+    f.flush()
+
+
+def length_balanced_shards(records, num_shards):
+    """
+    The records split in at most num_shards shards with about the same number of residues. The longest records are
+    assigned first, each to the shard with the fewest residues so far.
+    """
+    shards = [[] for _ in range(num_shards)]
+    residues = [0] * num_shards
+    for record in sorted(records, key=lambda record: len(record.seq), reverse=True):
+        rank = residues.index(min(residues))
+        shards[rank].append(record)
+        residues[rank] += len(record.seq)
+    return [shard for shard in shards if shard]
+
+
+def shard_files(shards_dir):
+    """h5 files written by the processes of a sharded run"""
+    return sorted(glob.glob(os.path.join(shards_dir, 'shard_*', 't5_embeddings', 'embeddings_file.h5')))
+
+
+def shard_arguments(args, threads):
+    """arguments of this script for a shard process, the embedding and storage options of args"""
+    arguments = ['--batch_size', str(args.batch_size), '--max_residues', str(args.max_residues),
+                 '--queue_size', str(args.queue_size), '--chunk_residues', str(args.chunk_residues),
+                 '--compression', args.compression, '--compression_level', str(args.compression_level),
+                 '--threads_per_process', str(threads)]
+    if args.storage_dtype:
+        arguments += ['--storage_dtype', args.storage_dtype]
+    if args.half_precision:
+        arguments.append('--half_precision')
+    if args.shuffle:
+        arguments.append('--shuffle')
+    return arguments
+
+
+def embed_shards(args, records, shards_dir, failures_log):
+    """
+    Embed the records in length balanced shards by args.num_processes processes of this script with
+    args.threads_per_process torch threads each. Every process embeds the remapped fasta file of its shard directory
+    into the h5 file of the directory, so an interrupted shard is resumed like a single process run, and writes its
+    output to generate.log there. The failures of the shards are appended to failures_log.
+
+    Returns: number of shards whose process did not embed all its sequences
+
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    threads = args.threads_per_process or max(1, len(cores) // args.num_processes)
+    pin = hasattr(os, 'sched_setaffinity') and threads * args.num_processes <= len(cores)
+    shards = length_balanced_shards(records, args.num_processes)
+    processes = []
+    for rank, shard in enumerate(shards):
+        shard_dir = os.path.join(shards_dir, f'shard_{rank}')
+        os.makedirs(shard_dir, exist_ok=True)
+        shard_fasta = os.path.join(shard_dir, 'remapped_sequences_file.fasta')
+        SeqIO.write(shard, shard_fasta, 'fasta')
+        shard_config = os.path.join(shard_dir, 'embed_config.yml')
+        with open(shard_config, 'w') as f:
+            yaml.safe_dump({'global': {'sequences_file': shard_fasta, 'prefix': shard_dir}}, f)
+        # the thread pools of the libraries below torch are limited as well
+        env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+        shard_cores = cores[rank * threads:(rank + 1) * threads] if pin else None
+        with open(os.path.join(shard_dir, 'generate.log'), 'a') as log:
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), '--config', shard_config] + shard_arguments(args, threads),
+                stdout=log, stderr=subprocess.STDOUT, env=env,
+                preexec_fn=(lambda shard_cores=shard_cores: os.sched_setaffinity(0, shard_cores)) if pin else None))
+        print(f"Shard {rank}: {len(shard)} sequences, {sum(len(record.seq) for record in shard)} residues, "
+              f"{threads} threads, log {os.path.join(shard_dir, 'generate.log')}")
+
+    started = time.time()
+    seconds = [None] * len(processes)
+    try:
+        while None in seconds:
+            time.sleep(1)
+            for rank, process in enumerate(processes):
+                if seconds[rank] is None and process.poll() is not None:
+                    seconds[rank] = time.time() - started
+                    residues = sum(len(record.seq) for record in shards[rank])
+                    print(f"Shard {rank} finished with exit code {process.returncode} in {seconds[rank]:.1f}s, "
+                          f"{residues / max(seconds[rank], 1e-9):.0f} residues/s")
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+    total = sum(len(record.seq) for record in records)
+    print(f"{len(processes)} processes: {len(records)} sequences, {total} residues in {max(seconds):.1f}s, "
+          f"{total / max(max(seconds), 1e-9):.0f} residues/s")
+
+    for rank in range(len(processes)):
+        shard_failures = os.path.join(shards_dir, f'shard_{rank}', 't5_embeddings', 'failures.log')
+        if os.path.exists(shard_failures):
+            with open(shard_failures) as log, open(failures_log, 'a') as merged_log:
+                merged_log.write(log.read())
+            os.remove(shard_failures)
+    return sum(process.returncode != 0 for process in processes)
+
+
+def merge_shards(embeddings_file, files, merge='copy'):
+    """
+    Add the embeddings of the shard h5 files that are not in the h5 file yet. copy copies the embeddings with their
+    chunks and filters and removes the shard files. virtual adds an HDF5 virtual dataset per protein that maps its
+    whole embedding in the shard file by a path relative to the h5 file, so nothing is copied. HDF5 reads a virtual
+    dataset whose shard file is missing as zeros, so the shard files are recorded in the file attribute
+    VIRTUAL_SOURCES_ATTRIBUTE and the readers of the h5 file fail if one of them is missing.
+
+    Returns: number of embeddings that were added
+
+    """
+    added = 0
+    with h5py.File(embeddings_file, 'a') as f:
+        check_virtual_sources(f)
+        for shard_file in files:
+            present_ids(shard_file)  # removes the staging group of an interrupted shard
+            sources = [str(source) for source in f.attrs.get(VIRTUAL_SOURCES_ATTRIBUTE, [])]
+            with h5py.File(shard_file, 'r') as shard:
+                check_storage_dtype(f, shard.attrs.get(STORAGE_DTYPE_ATTRIBUTE))
+                source_path = os.path.relpath(shard_file, os.path.dirname(os.path.abspath(embeddings_file)))
+                if merge == 'copy' and source_path in sources:
+                    # the virtual datasets of an earlier virtual merge, duplicate links included, are replaced by
+                    # copies before their shard file is removed
+                    for key in list(f.keys()):
+                        dataset = f[key]
+                        if isinstance(dataset, h5py.Dataset) and dataset.is_virtual:
+                            virtual_source = dataset.virtual_sources()[0]
+                            if virtual_source.file_name == source_path:
+                                del f[key]
+                                shard.copy(shard[virtual_source.dset_name], f, name=key)
+                    sources.remove(source_path)
+                for key in shard.keys():
+                    if key in f:
+                        continue
+                    source = shard[key]
+                    if merge == 'copy':
+                        shard.copy(source, f, name=key)
+                    else:
+                        layout = h5py.VirtualLayout(shape=source.shape, dtype=source.dtype)
+                        layout[...] = h5py.VirtualSource(source_path, key, shape=source.shape)
+                        f.create_virtual_dataset(key, layout)
+                        if source_path not in sources:
+                            sources.append(source_path)
+                    added += 1
+            if sources:
+                f.attrs[VIRTUAL_SOURCES_ATTRIBUTE] = sources
+            elif VIRTUAL_SOURCES_ATTRIBUTE in f.attrs:
+                del f.attrs[VIRTUAL_SOURCES_ATTRIBUTE]
+            f.flush()
+            if merge == 'copy':
+                os.remove(shard_file)
+    return added
+
 
 def main():
     args = parse_args()
@@ -42,6 +441,11 @@ def main():
     
     # Output paths
     embeddings_file = os.path.join(embeddings_dir, 'embeddings_file.h5')
+    pooled_file = os.path.join(embeddings_dir, 'pooled_embeddings.h5')
+    shards_dir = os.path.join(embeddings_dir, 'shards')
+    failures_log = os.path.join(embeddings_dir, 'failures.log')
+    if args.threads_per_process:
+        torch.set_num_threads(args.threads_per_process)
     
     # Check if remapped sequences file exists, otherwise use the original
     remapped_file = os.path.join(output_prefix, 'remapped_sequences_file.fasta')
@@ -51,69 +455,191 @@ def main():
     else:
         sequences_to_embed = sequences_file
         print(f"Using original sequences from {sequences_file}")
-    
-    # Import the embedder here to avoid loading the model until necessary
-    print("Importing ProtTransT5XLU50Embedder...")
-    try:
-        from bio_embeddings.embed import ProtTransT5XLU50Embedder
-    except ImportError as e:
-        print(f"Error importing ProtTransT5XLU50Embedder: {e}")
-        sys.exit(1)
-    
-    # Create embedder with memory-efficient settings
-    print("Creating embedder (this will load the model, which may take time)...")
-    embedder = ProtTransT5XLU50Embedder(
-        half_precision_model=args.half_precision,
-        half_precision=args.half_precision
-    )
+
+    # Embed every sequence only once, records with a sequence that occurred before are linked to its embedding
+    records = []
+    duplicates = []  # (id, id of the first record with the same sequence)
+    first_ids = {}
+    total_count = 0
+    total_residues = 0
+    for record in SeqIO.parse(sequences_to_embed, "fasta"):
+        total_count += 1
+        total_residues += len(record.seq)
+        sequence = str(record.seq)
+        if sequence in first_ids:
+            duplicates.append((record.id, first_ids[sequence]))
+        else:
+            first_ids[sequence] = record.id
+            records.append(record)
+    unique_residues = sum(len(record.seq) for record in records)
+    print(f"Deduplication: {total_count} sequences, {len(records)} unique, "
+          f"dedup ratio {total_count / max(len(records), 1):.2f}")
+
+    store = None
+    if args.embedding_store:
+        store = EmbeddingStore(args.embedding_store, EMBEDDER_PROTOCOL,
+                               'float16' if args.half_precision else 'float32', args.store_max_bytes)
+        hits = store.lookup([str(record.seq) for record in records])
+        print(f"Found {sum(hits)}/{len(records)} sequences in the embedding store {store.directory}")
+        records = [record for record, hit in zip(records, hits) if not hit]
+        if not records:
+            print(f"All embeddings are in the store, run inference with embeddings: {store.directory}")
+            store.close()
+            return
+    else:
+        # The shards of an interrupted sharded run are merged first, so their embeddings are not embedded again
+        if shard_files(shards_dir):
+            added = merge_shards(embeddings_file, shard_files(shards_dir), args.merge)
+            print(f"Merged {added} embeddings of earlier shards into {embeddings_file}")
+        # An interrupted run is resumed, the sequences whose ids are in the h5 file are not embedded again
+        present = present_ids(embeddings_file)
+        if present:
+            print(f"Resuming {embeddings_file}, {len(present)} embeddings are already present")
+            records = [record for record in records if record.id not in present]
+
+    # The shards are embedded by other processes and merged, this process only links the duplicates and pools
+    failed_shards = 0
+    if args.num_processes > 1 and records:
+        print(f"Embedding {len(records)} sequences in {args.num_processes} processes...")
+        failed_shards = embed_shards(args, records, shards_dir, failures_log)
+        added = merge_shards(embeddings_file, shard_files(shards_dir), args.merge)
+        print(f"Merged {added} embeddings of the shards into {embeddings_file} ({args.merge})")
+        records = []
     
     # Count sequences for progress reporting
-    sequence_count = 0
-    with open(sequences_to_embed, 'r') as f:
-        for line in f:
-            if line.startswith('>'):
-                sequence_count += 1
+    sequence_count = len(records)
     
     print(f"Found {sequence_count} sequences to embed")
+    embedder = load_embedder(args) if records else None
     
     # Process sequences and generate embeddings
-    print(f"Generating embeddings with batch size {args.batch_size}...")
+    if args.max_residues > 0:
+        print(f"Generating embeddings in length sorted batches of at most {args.max_residues} padded residues...")
+        batches = token_budget_batches(records, args.max_residues)
+    else:
+        print(f"Generating embeddings with batch size {args.batch_size}...")
+        batches = (records[i:i + args.batch_size] for i in range(0, sequence_count, args.batch_size))
+    
+    # Sequences that could not be embedded, even alone, are logged and skipped
+    failures = []
     
-    # Create h5py file for storing embeddings
-    with h5py.File(embeddings_file, 'w') as f:
+    # Open the h5py file for storing embeddings in append mode, unless they are added to the embedding store
+    with h5py.File(embeddings_file, 'a') if store is None else contextlib.nullcontext() as f:
+        if store is None:
+            check_storage_dtype(f, args.storage_dtype)
+        # The batches are formed ahead by a reader thread and written behind by a writer thread, so the model in the
+        # main thread does not wait for either of them unless it is faster than they are
+        timings = {'read': 0.0, 'embed': 0.0, 'write': 0.0, 'wait for batches': 0.0, 'wait for writer': 0.0}
+        batch_queue = queue.Queue(maxsize=args.queue_size)
+        write_queue = queue.Queue(maxsize=args.queue_size)
+        write_errors = []
+        reader = threading.Thread(target=read_batches, args=(batches, batch_queue, timings), daemon=True)
+        pooled_writer = PooledEmbeddingsWriter(pooled_file) if args.pooled else None
+        writer = threading.Thread(target=write_batches,
+                                  args=(write_queue, f, store, pooled_writer, args, timings, write_errors),
+                                  daemon=True)
+        reader.start()
+        writer.start()
+        
         # Process sequences in batches to save memory
-        batch = []
-        batch_ids = []
         processed = 0
+        embedded_residues = 0
+        embedding_time = 0
+        batch_stats = {}  # [batches, residues, seconds, peak RSS MB, peak GPU MB] by the number of sequences
         
-        for record in SeqIO.parse(sequences_to_embed, "fasta"):
-            batch.append(str(record.seq))
-            batch_ids.append(record.id)
-            
-            if len(batch) >= args.batch_size or processed + len(batch) == sequence_count:
-                # Generate embeddings for the batch
-                try:
-                    embeddings = embedder.embed_many(batch)
-                    
-                    # Store embeddings in h5 file
-                    for i, (seq_id, embedding) in enumerate(zip(batch_ids, embeddings)):
-                        f.create_dataset(seq_id, data=embedding)
-                    
-                    processed += len(batch)
-                    print(f"Processed {processed}/{sequence_count} sequences")
-                    
-                    # Clear batch
-                    batch = []
-                    batch_ids = []
-                    
-                    # Force garbage collection to free memory
-                    if args.half_precision:
-                        torch.cuda.empty_cache()
-                        
-                except Exception as e:
-                    print(f"Error generating embeddings for batch: {e}")
-                    sys.exit(1)
+        try:
+            while True:
+                wait_start = time.time()
+                batch_records = batch_queue.get()
+                timings['wait for batches'] += time.time() - wait_start
+                if batch_records is None:
+                    break
+                batch_start = time.time()
+                peak_reset = reset_peak_rss()
+                if torch.cuda.is_available():
+                    torch.cuda.reset_peak_memory_stats()
+                # Generate embeddings for the batch, a failing batch is retried in smaller batches
+                failed = len(failures)
+                embedded = embed_with_retries(embedder, batch_records, failures)
+                log_failures(failures_log, failures[failed:])
+                batch_time = time.time() - batch_start
+                timings['embed'] += batch_time
+                
+                # Store embeddings in h5 file or in the embedding store by their sequence, in the writer thread
+                if write_errors:
+                    raise write_errors[0]
+                wait_start = time.time()
+                write_queue.put(embedded)
+                timings['wait for writer'] += time.time() - wait_start
+                batch_residues = sum(len(record.seq) for record, _ in embedded)
+                embedding_time += batch_time
+                embedded_residues += batch_residues
+                stats = batch_stats.setdefault(len(batch_records), [0, 0, 0.0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += batch_residues
+                stats[2] += batch_time
+                stats[3] = max(stats[3], peak_rss_megabytes(peak_reset))
+                if torch.cuda.is_available():
+                    stats[4] = max(stats[4], torch.cuda.max_memory_allocated() / 1e6)
+                
+                processed += len(batch_records)
+                print(f"Processed {processed}/{sequence_count} sequences, "
+                      f"{batch_residues / max(batch_time, 1e-9):.0f} residues/s")
+                
+                # Force garbage collection to free memory
+                if args.half_precision:
+                    torch.cuda.empty_cache()
+        finally:
+            # The embedded batches that are still queued are written before the file is closed
+            write_queue.put(None)
+            writer.join()
+            if pooled_writer is not None:
+                pooled_writer.close()
+        if write_errors:
+            raise write_errors[0]
+
+        # The embedding store is keyed by sequence, an h5 file gets a hard link per duplicate id
+        if store is None:
+            for seq_id, first_id in duplicates:
+                if seq_id not in f and first_id in f:
+                    f[seq_id] = f[first_id]
+            if STAGING_GROUP in f:
+                del f[STAGING_GROUP]
+
+    # Proteins embedded by an earlier run and the duplicate ids are pooled from the h5 file
+    if args.pooled:
+        added = pool_h5_file(embeddings_file, pooled_file)
+        print(f"Pooled vectors written to {pooled_file}, {added} of them pooled from the h5 file")
+
+    if batch_stats:
+        print("Stage timing: " + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in timings.items()))
+        slowest = max(['read', 'embed', 'write'], key=timings.get)
+        print(f"The slowest stage is {slowest}")
+        print(f"{'batch size':>10} {'batches':>8} {'residues/s':>11} {'peak RSS MB':>12} {'peak GPU MB':>12}")
+        for size, (count, residues, seconds, rss, gpu) in sorted(batch_stats.items()):
+            print(f"{size:>10} {count:>8} {residues / max(seconds, 1e-9):>11.0f} {rss:>12.0f} {gpu:>12.0f}")
+        print(f"Embedded {embedded_residues} residues in {embedding_time:.1f}s, "
+              f"{embedded_residues / max(embedding_time, 1e-9):.0f} residues/s")
+
+        saved = embedding_time / max(embedded_residues, 1) * (total_residues - unique_residues)
+        print(f"Deduplication: skipped {len(duplicates)} duplicate sequences, saved about {saved:.0f}s of embedding")
+    else:
+        print(f"Deduplication: skipped {len(duplicates)} duplicate sequences")
     
+    if store is not None:
+        store.close()
+    if failed_shards:
+        print(f"{failed_shards} shards did not embed all their sequences, see the logs in {shards_dir} and "
+              f"{failures_log}, run the script again to retry them")
+        sys.exit(1)
+    if failures:
+        print(f"{len(failures)} sequences could not be embedded and were logged to {failures_log}, "
+              f"run the script again to retry them")
+        sys.exit(1)
+    if store is not None:
+        print(f"Embeddings successfully generated and saved to the embedding store {store.directory}")
+        print(f"Run inference with embeddings: {store.directory}")
+        return
     print(f"Embeddings successfully generated and saved to {embeddings_file}")
     print(f"You can now run inference with:")
     print(f"python inference.py --config {os.path.dirname(args.config)}/test_inference_config.yml")
@@ -1,8 +1,5 @@
 import copy
 
-from models import *  # For loading classes specified in config
-# from models.legacy import *  # For loading classes specified in config
-from torch.optim import *  # For loading optimizer class that was used in the checkpoint
 import os
 import argparse
 import yaml
@@ -11,25 +8,64 @@ from torchvision.transforms import transforms
 from datasets.embeddings_dataset import Embeddings_predict_Dataset
 from datasets.transforms import *
 from solver import Solver
-from models.biLSTM_TextCNN import biLSTM_TextCNN
+from utils.export import load_runtime_model
+
+
+def eager_model_classes(args) -> tuple:
+    """
+    Model and optimizer classes of the config. The model code is only imported here, so the runtimes of exported models
+    run without loading it.
+    """
+    import torch.optim
+    import models
+    return getattr(models, args.model_type), getattr(torch.optim, args.optimizer)
 
 
 def inference(args):
-    transform = transforms.Compose([Solubility_predict_ToInt(), predict_ToTensor()])
+    # the embeddings keep their on-disk dtype until the collate function copies them into the padded batch
+    transform = transforms.Compose([Solubility_predict_ToInt(), predict_ToTensor(dtype=None)])
 
     data_set = Embeddings_predict_Dataset(args.embeddings, args.remapping,
                                              key_format=args.key_format,
                                              embedding_mode=args.embedding_mode,
                                              transform=transform)
-    
-    model: nn.Module = globals()[args.model_type](embeddings_dim=data_set[0][0].shape[-1], **args.model_parameters)
 
-    # Needs "from torch.optim import *" and "from models import *" to work
-    solver = Solver(model, args, globals()[args.optimizer])
+    if getattr(args, 'runtime', 'torch') != 'torch':
+        if getattr(args, 'num_processes', 1) > 1:
+            raise ValueError('exported models can not be copied to worker processes, use num_processes 1')
+        # the exported model holds the weights, the checkpoint is not loaded
+        solver = Solver(load_runtime_model(args.runtime, args.exported_model), args, eval=True)
+        return solver.predict_evaluation(data_set)
+
+    model_class, optimizer_class = eager_model_classes(args)
+    model: nn.Module = model_class(embeddings_dim=data_set.embeddings_dim, **args.model_parameters)
+
+    solver = Solver(model, args, optimizer_class)
+    if getattr(args, 'quantization', None):
+        solver.quantize(args.quantization, data_set, args.calibration_samples)
     return solver.predict_evaluation(data_set)
 
 
-def parse_arguments():
+def ensemble_inference(args):
+    if getattr(args, 'runtime', 'torch') != 'torch':
+        raise ValueError('ensembles load the weights of every checkpoint and only run with the torch runtime')
+    if getattr(args, 'quantization', None):
+        raise ValueError('ensembles are not quantized, predict with one checkpoint at a time for quantization')
+    transform = transforms.Compose([Solubility_predict_ToInt(), predict_ToTensor(dtype=None)])
+
+    data_set = Embeddings_predict_Dataset(args.embeddings, args.remapping,
+                                             key_format=args.key_format,
+                                             embedding_mode=args.embedding_mode,
+                                             transform=transform)
+
+    model_class, optimizer_class = eager_model_classes(args)
+    model: nn.Module = model_class(embeddings_dim=data_set.embeddings_dim, **args.model_parameters)
+
+    solver = Solver(model, args, optimizer_class, eval=True)
+    return solver.predict_evaluation(data_set, models=solver.ensemble_models(args.checkpoints_list))
+
+
+def parse_arguments(argv: list = None):
     p = argparse.ArgumentParser()
     p.add_argument('--config', type=argparse.FileType(mode='r'), default='configs/inference.yaml')
     p.add_argument('--checkpoints_list', default=[],
@@ -44,9 +80,72 @@ def parse_arguments():
                    help='cutoff similarity for when to do lookup and when to use denovo predictions. If negative, denovo predictions will always be used.')
     p.add_argument('--key_format', type=str, default='hash',
                    help='the formatting of the keys in the h5 file [fasta_descriptor_old, fasta_descriptor, hash]')
+    p.add_argument('--length_bucketing', type=bool, default=False,
+                   help='batch sequences of similar length together, the predictions are written in the fasta order')
+    p.add_argument('--bucket_size_multiplier', type=int, default=100,
+                   help='number of batches per length sorted bucket when using length_bucketing')
+    p.add_argument('--num_workers', type=int, default=0,
+                   help='number of DataLoader worker processes that read the embeddings (0 loads in the main process)')
+    p.add_argument('--pin_memory', type=bool, default=False,
+                   help='copy batches into page locked memory for faster transfers to the gpu')
+    p.add_argument('--prefetch_factor', type=int, default=2,
+                   help='number of batches loaded in advance by each worker')
+    p.add_argument('--ensemble', type=bool, default=False,
+                   help='predict every batch with all checkpoints of checkpoints_list and write one file with a column '
+                        'per checkpoint and the ensemble mean and standard deviation')
+    p.add_argument('--output_files_name', type=str, default='protTrans',
+                   help='the predictions are written to <output_files_name>_prediction_result.csv or .parquet')
+    p.add_argument('--output_format', type=str, default='csv', help='[csv, parquet] format of the predictions file')
+    p.add_argument('--write_sequences', type=bool, default=True,
+                   help='whether to write the sequence column to the predictions file')
+    p.add_argument('--write_chunk_size', type=int, default=10000,
+                   help='number of predictions that are buffered before they are written to the predictions file')
+    p.add_argument('--resume', type=bool, default=False,
+                   help='continue an interrupted run from the .progress file next to the csv predictions file')
+    p.add_argument('--verify_predictions', type=bool, default=True,
+                   help='check that the predictions file has one row for every protein of the fasta file')
+    p.add_argument('--runtime', type=str, default='torch',
+                   help='[torch, torchscript, onnxruntime] run the eager model or exported_model written by '
+                        'export_model.py')
+    p.add_argument('--exported_model', type=str, default=None,
+                   help='TorchScript or ONNX file of the checkpoint for the torchscript and onnxruntime runtimes')
+    p.add_argument('--quantization', type=str, default=None,
+                   help='[dynamic, weight_only, static] predict on the cpu with int8 LSTM and Linear layers, '
+                        'weight_only also stores the convolution weights in int8 and static runs the convolutions in '
+                        'int8 (float32 model if not set)')
+    p.add_argument('--calibration_samples', type=int, default=64,
+                   help='number of randomly chosen proteins of the dataset that calibrate the static quantization')
+    p.add_argument('--num_processes', type=int, default=1,
+                   help='number of worker processes that predict shards of the proteins on the cpu, their predictions '
+                        'are written in the fasta order')
+    p.add_argument('--threads_per_process', type=int, default=0,
+                   help='torch threads of every worker process (0 divides the cores among the processes)')
+    p.add_argument('--pin_processes', type=bool, default=True,
+                   help='pin every worker process to its own cores if there are enough for all threads')
+    p.add_argument('--deduplicate', type=bool, default=False,
+                   help='predict every sequence only once and repeat the prediction for all ids with that sequence, '
+                        'keeps the hash of every sequence in memory (about 150 bytes per protein)')
+    p.add_argument('--prediction_cache', type=str, default=None,
+                   help='SQLite file with the predictions of earlier runs by sequence and checkpoint fingerprint, '
+                        'only the proteins that are not in it are predicted (no cache if not set)')
+    p.add_argument('--window_size', type=int, default=0,
+                   help='predict proteins longer than this many residues in overlapping windows (0 disables windows)')
+    p.add_argument('--window_overlap', type=int, default=100,
+                   help='number of residues that consecutive windows of a protein share')
+    p.add_argument('--window_aggregation', type=str, default='mean',
+                   help='[mean, max] how the predictions of the windows of a protein are combined')
+    p.add_argument('--input_dtype', type=str, default='stored',
+                   help='[stored, float32, float16, bfloat16] dtype of the padded batches on the host and during the '
+                        'transfer to the device, stored keeps the dtype of the embeddings file, half precision batches '
+                        'are cast to float32 in the model step')
+    p.add_argument('--autocast', type=bool, default=False,
+                   help='run the model under torch.autocast (float16 on cuda, bfloat16 on the cpu) instead of casting '
+                        'the batches to float32')
+    p.add_argument('--persistent_workers', type=bool, default=False,
+                   help='keep the worker processes and their open h5 files alive between epochs')
 
 
-    args = p.parse_args()
+    args = p.parse_args(argv)
     arg_dict = args.__dict__
     if args.config:
         data = yaml.load(args.config, Loader=yaml.FullLoader)
@@ -59,22 +158,32 @@ def parse_arguments():
     return args
 
 
+def add_train_arguments(args):
+    # get the arguments from the yaml config file that is saved in the runs checkpoint
+    arg_dict = args.__dict__
+    data = yaml.load(open(os.path.join('./model_param/train_arguments.yml'), 'r'), Loader=yaml.FullLoader)
+    for key, value in data.items():
+        if key not in args.__dict__.keys():
+            if isinstance(value, list):
+                for v in value:
+                    arg_dict[key].append(v)
+            else:
+                arg_dict[key] = value
+    return args
+
+
 if __name__ == '__main__':
     original_args = copy.copy(parse_arguments())
-    
-    for checkpoint in original_args.checkpoints_list:
-        args = copy.copy(original_args)
-        arg_dict = args.__dict__
-        arg_dict['checkpoint'] = checkpoint
-        # get the arguments from the yaml config file that is saved in the runs checkpoint
-        data = yaml.load(open(os.path.join('./model_param/train_arguments.yml'), 'r'), Loader=yaml.FullLoader)
-        for key, value in data.items():
-            if key not in args.__dict__.keys():
-                if isinstance(value, list):
-                    for v in value:
-                        arg_dict[key].append(v)
-                else:
-                    arg_dict[key] = value
-        # call teh actual inference
-        inference(args)
-   
+
+    if original_args.ensemble:
+        # read the dataset once and predict every batch with all checkpoints
+        args = add_train_arguments(copy.copy(original_args))
+        args.checkpoint = None
+        ensemble_inference(args)
+    else:
+        for checkpoint in original_args.checkpoints_list:
+            args = copy.copy(original_args)
+            args.checkpoint = checkpoint
+            add_train_arguments(args)
+            # call teh actual inference
+            inference(args)
@@ -3,6 +3,8 @@ import torch.nn as nn
 
 
 class biLSTM_TextCNN(nn.Module):
+    input_layout = 'BLD'  # the lstm runs over [batch_size, sequence_length, embeddings_dim] batches
+
     def __init__(self, embeddings_dim=1024, output_dim=1, dropout=0.25, kernel_size = 9 ,conv_dropout: float = 0.25):
         super(biLSTM_TextCNN, self).__init__()
         
@@ -25,14 +27,13 @@ class biLSTM_TextCNN(nn.Module):
     def forward(self, x: torch.Tensor, mask, **kwargs) -> torch.Tensor:
         """
         Args:
-            x: [batch_size, embeddings_dim, sequence_length] embedding tensor that should be classified
+            x: [batch_size, sequence_length, embeddings_dim] embedding tensor that should be classified
             mask: [batch_size, sequence_length] mask corresponding to the zero padding used for the shorter sequecnes in the batch. All values corresponding to padding are False and the rest is True.
 
         Returns:
             classification: [batch_size,output_dim] tensor with logits
         """
         # print('x',x.shape)
-        x = x.permute(0, 2, 1)
         
         lstm_output, _ = self.lstm(x)
         # print('lstm_output',lstm_output.shape)
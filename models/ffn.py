@@ -3,6 +3,8 @@ import torch.nn as nn
 
 
 class FFN(nn.Module):
+    input_layout = 'BDL'  # per residue embeddings are pooled over the last dimension
+
     def __init__(self, embeddings_dim: int = 1024, output_dim: int = 12, hidden_dim: int = 32,
                  n_hidden_layers: int = 0, dropout: float = 0.25):
         """
@@ -15,7 +17,7 @@ class FFN(nn.Module):
             dropout: dropout ratio of every layer
         """
         super(FFN, self).__init__()
-        self.global_avg_pool = nn.AdaptiveAvgPool2d((embeddings_dim, 1)) 
+        self.embeddings_dim = embeddings_dim
         self.n_hidden_layers = n_hidden_layers
         self.input = nn.Sequential(
             nn.Linear(embeddings_dim, hidden_dim),
@@ -40,13 +42,18 @@ class FFN(nn.Module):
     def forward(self, x, **kwargs) -> torch.Tensor:
         """
         Args:
-            x: [batch_size, input_dim] embedding tensor that should be classified
+            x: [batch_size, D, L] per residue, [batch_size, D] or [batch_size, 2*D] pooled (mean half used)
 
         Returns:
             classification: [batch_size,output_dim] tensor with logits
         """
         # print('x',x.shape)
-        x = self.global_avg_pool(x)
+        if x.dim() == 3:  # per residue embeddings, pooled embeddings are already [batch_size, embeddings_dim]
+            # mean over the length like the former AdaptiveAvgPool2d((embeddings_dim, 1)), which can not be exported to
+            # ONNX with a dynamic length
+            x = x.mean(dim=-1)
+        elif x.size(1) == 2 * self.embeddings_dim:  # mean and max pooled vectors
+            x = x[:, :self.embeddings_dim]
         x = x.view(x.size(0), -1) 
         # print('x',x.shape)
         o = self.input(x)
@@ -3,6 +3,8 @@ import torch.nn as nn
 
 
 class LightAttention(nn.Module):
+    input_layout = 'BDL'  # the convolutions run over [batch_size, embeddings_dim, sequence_length] batches
+
     def __init__(self, embeddings_dim=1024, output_dim=1, dropout=0.25, kernel_size=9, conv_dropout: float = 0.25):
         super(LightAttention, self).__init__()
 
@@ -48,9 +50,9 @@ class LightAttention(nn.Module):
         attention = self.attention_convolution(x)  # [batch_size, embeddings_dim, sequence_length]
         # print('attention_2',attention.shape)
         # mask out the padding to which we do not want to pay any attention (we have the padding because the sequences have different lenghts).
-        # This padding is added by the dataloader when using the padded_permuted_collate function in utils/general.py
+        # This padding is added by the dataloader when using the PaddedCollate function in utils/general.py
         # print('mask',mask[:, None, :]== False)
-        attention = attention.masked_fill(mask[:, None, :] == False, -1e9)
+        attention = attention.masked_fill(~mask[:, None, :], torch.finfo(attention.dtype).min)
         # print('attention',attention.shape)
         # code used for extracting embeddings for UMAP visualizations
         # extraction =  torch.sum(x * self.softmax(attention), dim=-1)
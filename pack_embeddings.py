@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""
+Pack an embeddings_file.h5 written by bio_embeddings and its remapped fasta file into one contiguous memory mapped
+residue matrix with an offsets/lengths index and an id table. The output directory can be used in place of the h5
+file as train_embeddings, val_embeddings, test_embeddings or embeddings in the training and inference configs.
+"""
+
+import argparse
+
+from datasets.packed_store import pack_embeddings
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Pack per protein h5 embeddings into a memory mapped store')
+    parser.add_argument('--embeddings', type=str, required=True,
+                        help='embeddings_file.h5 with one dataset per protein')
+    parser.add_argument('--remapping', type=str, required=True,
+                        help='remapped_sequences_file.fasta with the keys of the embeddings file')
+    parser.add_argument('--output', type=str, required=True, help='directory to write the packed store to')
+    parser.add_argument('--key_format', type=str, default='hash',
+                        help='the formatting of the keys in the h5 file [fasta_descriptor_old, fasta_descriptor, hash]')
+    parser.add_argument('--dtype', type=str, default='float16', help='dtype of the packed residue matrix')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    print(f"Packing {args.embeddings} into {args.output}")
+    count = pack_embeddings(args.embeddings, args.remapping, args.output, key_format=args.key_format,
+                            dtype=args.dtype)
+    print(f"Packed {count} embeddings to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -18,6 +18,12 @@ import pandas as pd
 from Bio import SeqIO
 import yaml
 
+from datasets.embedding_store import store_directory
+from generate_embeddings_memory_efficient import EMBEDDER_PROTOCOL
+from inference import add_train_arguments, parse_arguments
+from utils.prediction_cache import PredictionCache, cached_checkpoints, prediction_fingerprint, sequence_hash
+from utils.prediction_writer import prediction_path
+
 # Helper to write a config YAML for embedding
 EMBED_CONFIG_TEMPLATE = {
     'global': {
@@ -26,25 +32,19 @@ EMBED_CONFIG_TEMPLATE = {
     }
 }
 
-# Helper to write a config YAML for inference
-INFER_CONFIG_TEMPLATE = {
-    'global': {
-        'model_config': './configs/inference_Sol_biLSTM_TextCNN.yml',
-        'embeddings_file': '',   # to be filled
-        'remapping': '',        # to be filled
-        'output_file': ''       # to be filled
-    }
-}
+DEFAULT_INFERENCE_CONFIG = './configs/inference_Sol_biLSTM_TextCNN.yml'
 
 def fasta_to_remapped(fasta_path, remapped_path):
     # PLM_Sol expects remapped_sequences_file.fasta in FASTA format
     shutil.copy(fasta_path, remapped_path)
 
-def run_embeddings(config_path):
+def run_embeddings(config_path, embedding_store=None, store_max_bytes=0):
     cmd = [
         'python', 'generate_embeddings_memory_efficient.py',
         '--config', config_path
     ]
+    if embedding_store:
+        cmd += ['--embedding_store', embedding_store, '--store_max_bytes', str(store_max_bytes)]
     subprocess.run(cmd, check=True)
 
 def run_inference(config_path):
@@ -54,61 +54,103 @@ def run_inference(config_path):
     ]
     subprocess.run(cmd, check=True)
 
+def read_prediction_scores(path):
+    """solubility scores of a predictions file of inference.py by the sequence_hash of their sequence, the rows are
+    matched by sequence, since deduplication, length bucketing or sharding may change their order"""
+    pred_df = pd.read_csv(path, usecols=['sequence', 'predict_result'])
+    return {sequence_hash(sequence): float(score) for sequence, score in zip(pred_df['sequence'],
+                                                                             pred_df['predict_result'])}
+
 def main():
     parser = argparse.ArgumentParser(description="Batch PLM_Sol predictor wrapper")
     parser.add_argument('--fasta', '-f', required=True, help='Input FASTA file')
     parser.add_argument('--out', '-o', required=True, help='Output CSV file')
+    parser.add_argument('--inference_config', default=DEFAULT_INFERENCE_CONFIG,
+                        help='inference config with the checkpoint and the prediction settings')
+    parser.add_argument('--prediction_cache', default='prediction_cache.sqlite',
+                        help='SQLite prediction cache, sequences in it are neither embedded nor predicted again '
+                             '(empty string disables the cache)')
+    parser.add_argument('--embedding_store', default='embedding_store',
+                        help='persistent embedding store directory, sequences in it are not embedded again '
+                             '(empty string embeds into a temporary directory that is removed afterwards)')
+    parser.add_argument('--store_max_bytes', type=int, default=0,
+                        help='size cap of the embedding store in bytes, 0 for no cap')
     args = parser.parse_args()
 
+    records = list(SeqIO.parse(args.fasta, "fasta"))
+    # the same arguments as inference.py, so the fingerprint of the cached predictions matches
+    inference_args = add_train_arguments(parse_arguments(['--config', args.inference_config]))
+    inference_args.checkpoint = inference_args.checkpoints_list[0]
+    hashes = [sequence_hash(str(record.seq)) for record in records]
+    cached = {}
+    if args.prediction_cache:
+        checkpoints = cached_checkpoints(inference_args)
+        cache = PredictionCache(args.prediction_cache, checkpoints,
+                                prediction_fingerprint(inference_args, checkpoints))
+        cached = cache.get_many(hashes)
+        print(f"Prediction cache: {cache.hits} hits, {cache.misses} misses, hit rate {cache.hit_rate():.1%}")
+        cache.close()
+    missing = [record for record, hash in zip(records, hashes) if hash not in cached]
+
+    scores = {}
     with tempfile.TemporaryDirectory() as tmpdir:
-        # Step 1: Prepare embedding config
-        embed_config = EMBED_CONFIG_TEMPLATE.copy()
-        embed_config['global']['sequences_file'] = os.path.abspath(args.fasta)
-        embed_config['global']['prefix'] = tmpdir
-        embed_config_path = os.path.join(tmpdir, 'embed_config.yml')
-        with open(embed_config_path, 'w') as f:
-            yaml.safe_dump(embed_config, f)
-
-        # Step 2: Run embedding
-        run_embeddings(embed_config_path)
-        embeddings_file = os.path.join(tmpdir, 't5_embeddings', 'embeddings_file.h5')
-        remapped_fasta = os.path.join(tmpdir, 'remapped_sequences_file.fasta')
-        fasta_to_remapped(args.fasta, remapped_fasta)
-
-        # Step 3: Prepare inference config
-        infer_config = INFER_CONFIG_TEMPLATE.copy()
-        infer_config['global']['embeddings_file'] = embeddings_file
-        infer_config['global']['remapping'] = remapped_fasta
-        infer_config['global']['output_file'] = os.path.join(tmpdir, 'plmsol_predictions.csv')
-        infer_config_path = os.path.join(tmpdir, 'infer_config.yml')
-        with open(infer_config_path, 'w') as f:
-            yaml.safe_dump(infer_config, f)
-
-        # Step 4: Run inference
-        run_inference(infer_config_path)
-
-        # Step 5: Parse predictions and write standardized CSV
-        pred_df = pd.read_csv(infer_config['global']['output_file'])
-        seqs = {rec.id: str(rec.seq) for rec in SeqIO.parse(args.fasta, "fasta")}
-        pred_df['Predictor'] = 'PLM_Sol'
-        pred_df['Sequence'] = pred_df['Accession'].map(seqs)
-        # Assume prediction column is 'SolubilityScore' or similar
-        if 'SolubilityScore' not in pred_df.columns:
-            # Try to infer from available columns
-            if 'probability' in pred_df.columns:
-                pred_df['SolubilityScore'] = pred_df['probability']
-            elif 'pred_label' in pred_df.columns:
-                pred_df['SolubilityScore'] = pred_df['pred_label'].map(lambda x: 1 if x == 1 or str(x).lower() == 'soluble' else 0)
+        if missing:
+            missing_fasta = os.path.join(tmpdir, 'sequences.fasta')
+            SeqIO.write(missing, missing_fasta, 'fasta')
+
+            # Step 1: Prepare embedding config
+            embed_config = EMBED_CONFIG_TEMPLATE.copy()
+            embed_config['global']['sequences_file'] = missing_fasta
+            embed_config['global']['prefix'] = tmpdir
+            embed_config_path = os.path.join(tmpdir, 'embed_config.yml')
+            with open(embed_config_path, 'w') as f:
+                yaml.safe_dump(embed_config, f)
+
+            # Step 2: Run embedding of the sequences that are neither in the prediction cache nor in the store
+            run_embeddings(embed_config_path, args.embedding_store, args.store_max_bytes)
+            if args.embedding_store:
+                embeddings_file = os.path.abspath(store_directory(args.embedding_store, EMBEDDER_PROTOCOL))
             else:
-                pred_df['SolubilityScore'] = 0.0
-        pred_df['Probability_Soluble'] = pred_df['SolubilityScore']
-        pred_df['Probability_Insoluble'] = 1 - pred_df['SolubilityScore']
-        # Standardize columns
-        pred_df.rename(columns={'name': 'Accession'}, inplace=True)
-        out_df = pred_df[['Accession', 'Sequence', 'Predictor', 'SolubilityScore', 'Probability_Soluble', 'Probability_Insoluble']]
+                embeddings_file = os.path.join(tmpdir, 't5_embeddings', 'embeddings_file.h5')
+            remapped_fasta = os.path.join(tmpdir, 'remapped_sequences_file.fasta')
+            fasta_to_remapped(missing_fasta, remapped_fasta)
+
+            # Step 3: Prepare inference config
+            with open(args.inference_config) as f:
+                infer_config = yaml.safe_load(f)
+            infer_config.update({'embeddings': embeddings_file, 'remapping': remapped_fasta,
+                                 'key_format': 'fasta_descriptor', 'checkpoints_list': [inference_args.checkpoint],
+                                 'output_files_name': os.path.join(tmpdir, 'plmsol'), 'output_format': 'csv',
+                                 'write_sequences': True})
+            if args.prediction_cache:
+                infer_config['prediction_cache'] = os.path.abspath(args.prediction_cache)
+            infer_config_path = os.path.join(tmpdir, 'infer_config.yml')
+            with open(infer_config_path, 'w') as f:
+                yaml.safe_dump(infer_config, f)
+
+            # Step 4: Run inference
+            run_inference(infer_config_path)
+
+            # Step 5: Parse predictions and match them to the records by their sequence
+            scores = read_prediction_scores(prediction_path(infer_config['output_files_name']))
+            unscored = [record.id for record, hash in zip(records, hashes) if hash not in cached and
+                        hash not in scores]
+            if unscored:
+                raise RuntimeError(f"inference wrote no prediction for {len(unscored)} sequences, "
+                                   f"for example {unscored[:5]}")
+
+    # Step 6: Write standardized CSV
+    solubility_scores = [float(cached[hash][0]) if hash in cached else float(scores[hash]) for hash in hashes]
+    out_df = pd.DataFrame({'Accession': [record.id for record in records],
+                           'Sequence': [str(record.seq) for record in records],
+                           'Predictor': 'PLM_Sol',
+                           'SolubilityScore': solubility_scores})
+    out_df['Probability_Soluble'] = out_df['SolubilityScore']
+    out_df['Probability_Insoluble'] = 1 - out_df['SolubilityScore']
+    if os.path.dirname(args.out):
         os.makedirs(os.path.dirname(args.out), exist_ok=True)
-        out_df.to_csv(args.out, index=False)
-        print(f"Results written to {args.out}")
+    out_df.to_csv(args.out, index=False)
+    print(f"Results written to {args.out}")
 
 if __name__ == '__main__':
     main()
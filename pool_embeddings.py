@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""
+Pool the per residue embeddings of an embeddings_file.h5 into one [N, 2 * embeddings_dim] array of mean and max pooled
+vectors per protein. The pooled file can be used in place of the h5 file as train_embeddings, val_embeddings,
+test_embeddings or embeddings in the training and inference configs of models that only use the pooled form, like
+FFN, which then read about 1/length of the data. FFN is built for the per residue embeddings_dim and only uses the
+mean half of the vectors, so its checkpoints load for the h5 file and the pooled file alike. They only get the same
+inputs from both with batch_size 1, since FFN averages per residue embeddings over the zero padded batch. An existing
+pooled file is continued with the proteins it misses.
+"""
+
+import argparse
+import os
+
+from datasets.pooled_embeddings import pool_h5_file
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Pool per residue h5 embeddings into mean and max vectors')
+    parser.add_argument('--embeddings', type=str, required=True,
+                        help='embeddings_file.h5 with one dataset per protein')
+    parser.add_argument('--output', type=str, default=None,
+                        help='pooled embeddings file, pooled_embeddings.h5 next to the embeddings file by default')
+    parser.add_argument('--dtype', type=str, default='float32', help='dtype of the pooled vectors')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    output = args.output or os.path.join(os.path.dirname(args.embeddings), 'pooled_embeddings.h5')
+    print(f"Pooling {args.embeddings} into {output}")
+    count = pool_h5_file(args.embeddings, output, dtype=args.dtype)
+    print(f"Pooled {count} embeddings to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Long-lived local prediction server that keeps the model of an inference config loaded and coalesces the proteins of
+concurrent requests into length bucketed batches, so a prediction neither pays for the start of a Python process nor
+for loading the checkpoint.
+
+Usage:
+  python prediction_server.py --config ./configs/inference_Sol_biLSTM_TextCNN.yml --port 8000
+
+POST /predict with a JSON body {"ids": [...], "sequences": [...], "embeddings": [...]} predicts the proteins and
+returns {"ids": [...], "predict_result": [...]} in the order of the request. Every embedding is a base64 encoded
+.npy file or a nested [length, embeddings_dim] list. Without embeddings the sequences are one hot encoded for onehot
+models or looked up in --embedding_store, sequences that are not in the store are embedded with ProtT5 if
+bio_embeddings is installed. GET /stats returns the latency percentiles, the queue depth and the batch sizes.
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from datasets.embedding_store import StoredEmbeddings
+from datasets.embeddings_dataset import one_hot_encoding
+from inference import add_train_arguments, parse_arguments
+from models import *  # For loading classes specified in config
+from solver import Solver
+from utils.fasta import amino_acid_composition, encode_sequences
+from utils.general import AMINO_ACIDS
+from utils.micro_batcher import MicroBatcher
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Local PLM_Sol prediction server with dynamic micro-batching')
+    parser.add_argument('--config', type=str, required=True,
+                        help='inference config with the checkpoint and the prediction settings')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--unix_socket', type=str, default=None,
+                        help='listen on this unix socket instead of host and port')
+    parser.add_argument('--batch_window_ms', type=float, default=5,
+                        help='milliseconds that the first waiting protein waits for the proteins of other requests')
+    parser.add_argument('--max_batch_size', type=int, default=None,
+                        help='maximum number of proteins of a batch (default: batch_size of the config)')
+    parser.add_argument('--bucket_batches', type=int, default=4,
+                        help='number of batches whose proteins are sorted by length together')
+    parser.add_argument('--embedding_store', type=str, default=None,
+                        help='namespace directory of an embedding store that embeddings of sequences are read from')
+    parser.add_argument('--embeddings_dim', type=int, default=1024,
+                        help='size of the language model embeddings the checkpoint was trained on')
+    return parser.parse_args()
+
+
+class Predictor():
+    """Turns requests into (embedding, metadata) samples and predicts batches of samples with the Solver"""
+
+    def __init__(self, args, embedding_store: str = None, embeddings_dim: int = 1024):
+        self.args = args
+        if args.embedding_mode == 'onehot':
+            embeddings_dim = len(AMINO_ACIDS)
+        self.embeddings_dim = embeddings_dim
+        model = globals()[args.model_type](embeddings_dim=embeddings_dim, **args.model_parameters)
+        self.solver = Solver(model, args, getattr(torch.optim, args.optimizer))
+        self.solver.model.eval()
+        self.collate_function = self.solver.collate_function(labelled=False)
+        self.store = StoredEmbeddings(embedding_store) if embedding_store else None
+        self.embedder = None
+        self.embedder_lock = threading.Lock()
+
+    def samples(self, request: dict) -> list:
+        """
+        (embedding, metadata) samples of the proteins of a request
+        Args:
+            request: dict with embeddings or sequences and optionally ids
+
+        Returns: list of samples
+
+        """
+        sequences = request.get('sequences')
+        embeddings = request.get('embeddings')
+        if sequences is None and embeddings is None:
+            raise ValueError('a request needs sequences or embeddings')
+        count = len(embeddings if embeddings is not None else sequences)
+        ids = request.get('ids') or [str(i) for i in range(count)]
+        if len(ids) != count or (sequences is not None and len(sequences) != count):
+            raise ValueError('ids, sequences and embeddings need the same number of entries')
+        if embeddings is not None:
+            embeddings = [self.decode_embedding(embedding) for embedding in embeddings]
+        else:
+            embeddings = self.embed(sequences)
+        # a malformed embedding would fail the whole micro-batch it is predicted in, not only its own request
+        for id, embedding in zip(ids, embeddings):
+            if np.ndim(embedding) != 2 or np.shape(embedding)[0] == 0 or np.shape(embedding)[1] != self.embeddings_dim:
+                raise ValueError('the embedding of {} has the shape {}, expected [length, {}]'.format(
+                    id, np.shape(embedding), self.embeddings_dim))
+        frequencies = np.zeros((count, len(AMINO_ACIDS)), dtype=np.float32)
+        if sequences is not None:
+            residues = np.frombuffer(''.join(sequences).encode(), dtype=np.uint8)
+            offsets = np.concatenate([[0], np.cumsum([len(sequence) for sequence in sequences])])
+            frequencies = amino_acid_composition(encode_sequences(residues), offsets)
+        return [(embedding, {'id': id, 'sequence': '' if sequences is None else sequences[i],
+                             'length': len(embedding), 'frequencies': torch.from_numpy(frequencies[i])})
+                for i, (id, embedding) in enumerate(zip(ids, embeddings))]
+
+    @staticmethod
+    def decode_embedding(embedding) -> np.ndarray:
+        if isinstance(embedding, str):
+            return np.load(io.BytesIO(base64.b64decode(embedding)), allow_pickle=False)
+        return np.asarray(embedding, dtype=np.float32)
+
+    def embed(self, sequences: list) -> list:
+        if self.args.embedding_mode == 'onehot':
+            return [one_hot_encoding(np.frombuffer(sequence.encode(), dtype=np.uint8)) for sequence in sequences]
+        embeddings = [self.store[sequence] if self.store is not None and sequence in self.store else None
+                      for sequence in sequences]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            with self.embedder_lock:
+                if self.embedder is None:
+                    try:
+                        from bio_embeddings.embed import ProtTransT5XLU50Embedder
+                    except ImportError:
+                        raise ValueError('{} sequences are not in the embedding store and bio_embeddings is not '
+                                         'installed, send their embeddings instead'.format(len(missing)))
+                    self.embedder = ProtTransT5XLU50Embedder()
+                for i, embedding in zip(missing, self.embedder.embed_many([sequences[i] for i in missing])):
+                    embeddings[i] = embedding
+        return embeddings
+
+    def predict(self, samples: list) -> np.ndarray:
+        return self.solver.predict_batch(self.collate_function(samples))
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep the connections of clients open between requests
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            samples = self.server.predictor.samples(request)
+        except (ValueError, KeyError, TypeError) as e:
+            return self.send_json(400, {'error': str(e)})
+        try:
+            predictions = self.server.batcher.submit(samples)
+        except Exception as e:
+            return self.send_json(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+        if predictions.shape[1] == 1:
+            predictions = predictions[:, 0]
+        self.send_json(200, {'ids': [sample[1]['id'] for sample in samples], 'predict_result': predictions.tolist()})
+
+    def do_GET(self):
+        if self.path == '/stats':
+            return self.send_json(200, self.server.batcher.stats())
+        if self.path == '/health':
+            return self.send_json(200, {'status': 'ok'})
+        self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+
+    def send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self) -> str:
+        # clients of a unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        pass  # a line per request would dominate the time of small requests
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    server_args = parse_args()
+    args = add_train_arguments(parse_arguments(['--config', server_args.config]))
+    args.checkpoint = args.checkpoints_list[0]
+    predictor = Predictor(args, server_args.embedding_store, server_args.embeddings_dim)
+    batcher = MicroBatcher(predictor.predict, length=lambda sample: len(sample[0]),
+                           batch_window=server_args.batch_window_ms / 1000,
+                           max_batch_size=server_args.max_batch_size or args.batch_size,
+                           bucket_batches=server_args.bucket_batches)
+    if server_args.unix_socket:
+        if os.path.exists(server_args.unix_socket):
+            os.remove(server_args.unix_socket)
+        server = ThreadingUnixHTTPServer(server_args.unix_socket, PredictionHandler)
+        address = server_args.unix_socket
+    else:
+        server = ThreadingHTTPServer((server_args.host, server_args.port), PredictionHandler)
+        address = 'http://{}:{}'.format(server_args.host, server_args.port)
+    server.predictor = predictor
+    server.batcher = batcher
+    print('serving {} with {} on {}'.format(args.model_type, args.checkpoint, address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
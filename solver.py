@@ -1,24 +1,200 @@
 import copy
+import hashlib
 import inspect
+import multiprocessing
 import os
 import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Dict, Iterator, List, Tuple
 import pandas as pd
 import pyaml
 import torch
 import numpy as np
-from models import *
 import sklearn.metrics as metrics
 from torch.utils.data import DataLoader, Dataset
+import torch.nn as nn
 import torch.nn.functional as F
 from torch.optim.lr_scheduler import ReduceLROnPlateau
-from utils.general import padded_permuted_collate,predict_padded_permuted_collate
+from datasets.samplers import LengthBucketBatchSampler
+from datasets.sliding_windows import SlidingWindowDataset
+from datasets.subsets import LengthSubset
+from utils.general import PaddedCollate, min_input_length, padding_mask
+from utils.prediction_cache import PredictionCache, cached_checkpoints, prediction_fingerprint, sequence_hash
+from utils.prediction_writer import PredictionWriter, prediction_path, verify_predictions
+from utils.quantization import quantize_model
+
+INPUT_DTYPES = ['stored', 'float32', 'float16', 'bfloat16']
+
+
+def build_data_loader(dataset: Dataset, args, collate_fn=None, shuffle: bool = False,
+                      drop_last: bool = False) -> DataLoader:
+    """
+    Create the DataLoader for a dataset according to the loading options in args
+    Args:
+        dataset: dataset with a lengths attribute if length bucketing is used
+        args: parsed arguments with batch_size, length_bucketing, bucket_size_multiplier and the worker options
+            num_workers, pin_memory, prefetch_factor and persistent_workers
+        collate_fn: collate function, usually a PaddedCollate
+        shuffle: whether to shuffle the samples every epoch
+        drop_last: whether to drop the last incomplete batch
+
+    Returns: the DataLoader
+
+    """
+    worker_options = {'num_workers': args.num_workers, 'pin_memory': args.pin_memory and torch.cuda.is_available()}
+    if args.num_workers > 0:  # these options are only valid when loading with worker processes
+        worker_options['prefetch_factor'] = args.prefetch_factor
+        worker_options['persistent_workers'] = args.persistent_workers
+        # the workers share an embedding cache that is filled before they start instead of filling one each
+        if hasattr(dataset, 'fill_cache'):
+            dataset.fill_cache()
+    if args.length_bucketing:
+        batch_sampler = LengthBucketBatchSampler(dataset.lengths, args.batch_size, args.bucket_size_multiplier,
+                                                 shuffle=shuffle, drop_last=drop_last, seed=getattr(args, 'seed', None))
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn, **worker_options)
+    return DataLoader(dataset, batch_size=args.batch_size, shuffle=shuffle, collate_fn=collate_fn,
+                      drop_last=drop_last, **worker_options)
+
+
+# state of a worker process of a ShardPool, set once by init_shard_worker
+shard_worker = {}
+
+
+def init_shard_worker(models: bytes, args, dataset: Dataset, threads: int, cores_queue):
+    """initializer of the worker processes, pins the process to its cores, loads the models that were saved with
+    torch.save and creates its Solver on the cpu"""
+    rank, cores = cores_queue.get()
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    models = torch.load(BytesIO(models), map_location='cpu', weights_only=False)
+    shard_worker.update(rank=rank, models=models, dataset=dataset,
+                        solver=Solver(models[0], args, eval=True, device='cpu'))
+
+
+def predict_shard(proteins: np.ndarray) -> Tuple[int, np.ndarray, int, float]:
+    """predictions of the proteins of a shard in a worker process, with the rank of the worker, the number of
+    residues and the seconds it took"""
+    started = time.time()
+    shard = LengthSubset(shard_worker['dataset'], proteins)
+    predictions = np.concatenate([predictions for _, predictions in
+                                  shard_worker['solver'].iter_predictions(shard, shard_worker['models'])])
+    return shard_worker['rank'], predictions, int(np.sum(shard.lengths)), time.time() - started
+
+
+class ShardPool():
+    """
+    Worker processes that predict shards of the proteins of a dataset on the cpu, with args.num_processes workers and
+    args.threads_per_process torch threads each. A single process does not use the cores of a large node, since the
+    recurrence of the LSTM does not scale over intra-op threads. With args.pin_processes every worker is pinned to its
+    own cores. The dataset and the models are sent to the workers once when they start, so several passes over
+    proteins of the dataset, like the chunks of Solver.iter_cached_predictions, reuse the same workers. The residues
+    per second of every worker and of all workers together are printed when the pool is closed.
+    """
+
+    def __init__(self, args, eval_dataset: Dataset, models: List[nn.Module]):
+        """
+
+        Args:
+            args: parsed arguments with num_processes, threads_per_process and pin_processes
+            eval_dataset: dataset without solubility labels that can be pickled
+            models: models that predict every batch, they are copied to the workers on the cpu
+        """
+        self.num_processes = args.num_processes
+        self.lengths = np.asarray(eval_dataset.lengths, dtype=np.int64)
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(
+            range(os.cpu_count()))
+        self.threads = getattr(args, 'threads_per_process', 0) or max(1, len(cores) // self.num_processes)
+        pin = getattr(args, 'pin_processes', True) and self.threads * self.num_processes <= len(cores)
+
+        worker_args = copy.copy(args)
+        worker_args.config = None  # the open config file can not be pickled
+        worker_args.num_processes = 1
+        # the packed weights of quantized models can not be sent with the pickler of multiprocessing
+        worker_models = BytesIO()
+        torch.save([copy.deepcopy(model).cpu().eval() for model in models], worker_models)
+        context = multiprocessing.get_context('spawn')
+        cores_queue = context.Queue()
+        for rank in range(self.num_processes):
+            cores_queue.put((rank, cores[rank * self.threads:(rank + 1) * self.threads] if pin else None))
+        self.worker_residues = np.zeros(self.num_processes, dtype=np.int64)
+        self.worker_seconds = np.zeros(self.num_processes)
+        self.proteins = 0
+        self.started = time.time()
+        self.executor = ProcessPoolExecutor(self.num_processes, mp_context=context, initializer=init_shard_worker,
+                                            initargs=(worker_models.getvalue(), worker_args, eval_dataset,
+                                                      self.threads, cores_queue))
+
+    def predict(self, proteins: np.ndarray, shards_per_process: int = 4) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Predict proteins of the dataset in shards with about the same number of residues. The shards are yielded in
+        order as soon as they and the shards before them are predicted.
+        Args:
+            proteins: ascending indices of the proteins in the dataset
+            shards_per_process: number of shards per worker, more shards yield the first predictions earlier
+
+        Returns: iterator of (indices of the proteins in the dataset, predictions) in the order of proteins
+
+        """
+        if len(proteins) == 0:
+            return
+        residues = np.cumsum(self.lengths[proteins])
+        num_shards = self.num_processes * shards_per_process
+        bounds = np.searchsorted(residues, residues[-1] * np.arange(1, num_shards) / num_shards)
+        shards = [shard for shard in np.split(proteins, np.unique(bounds)) if len(shard) > 0]
+        futures = [self.executor.submit(predict_shard, shard) for shard in shards]
+        try:
+            for shard, future in zip(shards, futures):
+                rank, predictions, shard_residues, seconds = future.result()
+                self.worker_residues[rank] += shard_residues
+                self.worker_seconds[rank] += seconds
+                self.proteins += len(shard)
+                yield shard, predictions
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def close(self):
+        self.executor.shutdown()
+        seconds = time.time() - self.started
+        for rank in range(self.num_processes):
+            print('worker {}: {} threads, {} residues, {:.0f} residues/s'.format(
+                rank, self.threads, self.worker_residues[rank],
+                self.worker_residues[rank] / max(self.worker_seconds[rank], 1e-9)))
+        print('{} processes: {} proteins, {} residues in {:.1f}s, {:.0f} residues/s'.format(
+            self.num_processes, self.proteins, self.worker_residues.sum(), seconds,
+            self.worker_residues.sum() / seconds))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 
 class Solver():
-    def __init__(self, model, args, optim=torch.optim.Adam, eval=False):
-        self.optim = optim(list(model.parameters()), **args.optimizer_parameters)
+    def __init__(self, model, args, optim=torch.optim.Adam, eval=False, device: str = None):
+        # models that only predict, like the runtimes of exported models, may have no parameters to optimize
+        self.optim = None if eval else optim(list(model.parameters()), **args.optimizer_parameters)
         self.args = args
-        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        if device is None:
+            device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
         self.model = model.to(self.device)
+        # dtype of the padded batches on the host and during the transfer, the model step casts them to float32 or
+        # runs under autocast. None ('stored') keeps the on-disk dtype of the embeddings
+        input_dtype = getattr(args, 'input_dtype', 'stored')
+        if input_dtype not in INPUT_DTYPES:
+            raise ValueError('input_dtype {} not supported, use one of {}'.format(input_dtype, INPUT_DTYPES))
+        self.input_dtype = None if input_dtype == 'stored' else getattr(torch, input_dtype)
+        self.autocast_dtype = None
+        if getattr(args, 'autocast', False):
+            if self.device.type == 'cuda':
+                self.autocast_dtype = torch.bfloat16 if self.input_dtype == torch.bfloat16 else torch.float16
+            else:  # autocast on the cpu only supports bfloat16
+                self.autocast_dtype = torch.bfloat16
         if args.checkpoint and not eval:
             checkpoint = torch.load(os.path.join(args.checkpoint), map_location=self.device)
             
@@ -52,6 +228,8 @@ class Solver():
             train_true = []
             train_loss = 0.0
             count = 0.0
+            padded_residues = 0  # number of positions in the padded batches, to report the padding ratio
+            residues = 0
             for i, batch in enumerate(train_loader):
                 embedding, sol, metadata = batch  # print('sol',sol)
                 
@@ -61,8 +239,10 @@ class Solver():
                 frequencies = metadata['frequencies'].to(self.device)  
                 # create mask corresponding to the zero padding used for the shorter sequecnes in the batch. All values corresponding to padding are False and the rest is True.
                 # print(metadata)
-                mask = torch.arange(metadata['length'].max())[None, :] < metadata['length'][:,None]  # [batchsize, seq_len]
-                outputs = self.model(embedding, mask=mask.to(self.device), sequence_lengths=sequence_lengths,
+                mask = self.padding_mask(embedding, metadata)  # [batchsize, seq_len]
+                padded_residues += mask.numel()
+                residues += int(metadata['length'].sum())
+                outputs = self.forward(embedding, mask=mask.to(self.device), sequence_lengths=sequence_lengths,
                                         frequencies=frequencies)
                 # print('outputs',outputs)
                 loss = F.binary_cross_entropy(outputs.squeeze(1), solubility.float())
@@ -81,15 +261,17 @@ class Solver():
 
             train_true = np.concatenate(train_true)
             train_pred = np.concatenate(train_pred)
-            outstr = 'Train %d, loss: %.6f, train acc: %.6f, train avg acc: %.6f' % (epoch,
+            outstr = 'Train %d, loss: %.6f, train acc: %.6f, train avg acc: %.6f, padding ratio: %.4f' % (epoch,
                                                                                      train_loss*1.0/count,
                                                                                  metrics.accuracy_score(
                                                                                      train_true, train_pred),
                                                                                  metrics.balanced_accuracy_score(
-                                                                                     train_true, train_pred))
+                                                                                     train_true, train_pred),
+                                                                                 1 - residues / padded_residues)
             
             
             io.cprint(outstr)
+            self.log_cache_stats(io, 'Train', train_loader.dataset)
             ####################
             # Val
             ####################
@@ -100,6 +282,8 @@ class Solver():
                 count = 0.0
                 test_pred = []
                 test_true = []
+                padded_residues = 0
+                residues = 0
                 for batch in val_loader:
                     embedding, sol, metadata = batch  # print('sol',sol)
                 
@@ -107,8 +291,10 @@ class Solver():
                     sequence_lengths = metadata['length'][:, None].to(self.device) 
                     frequencies = metadata['frequencies'].to(self.device)  
 
-                    mask = torch.arange(metadata['length'].max())[None, :] < metadata['length'][:,None]  
-                    outputs = self.model(embedding, mask=mask.to(self.device), sequence_lengths=sequence_lengths,
+                    mask = self.padding_mask(embedding, metadata)
+                    padded_residues += mask.numel()
+                    residues += int(metadata['length'].sum())
+                    outputs = self.forward(embedding, mask=mask.to(self.device), sequence_lengths=sequence_lengths,
                                             frequencies=frequencies)
                     
                     loss = F.binary_cross_entropy(outputs.squeeze(1), solubility.float())
@@ -122,11 +308,13 @@ class Solver():
                 test_pred = np.concatenate(test_pred)
                 test_acc = metrics.accuracy_score(test_true, test_pred)
                 avg_per_class_acc = metrics.balanced_accuracy_score(test_true, test_pred)
-                outstr = 'Test %d, loss: %.6f, test acc: %.6f, test avg acc: %.6f' % (epoch,
+                outstr = 'Test %d, loss: %.6f, test acc: %.6f, test avg acc: %.6f, padding ratio: %.4f' % (epoch,
                                                                                       test_loss*1.0/count,
                                                                                       test_acc,
-                                                                                      avg_per_class_acc)
+                                                                                      avg_per_class_acc,
+                                                                                      1 - residues / padded_residues)
                 io.cprint(outstr)
+                self.log_cache_stats(io, 'Test', val_loader.dataset)
                 if test_acc >= best_test_acc:
                     best_test_acc = test_acc
                     best_epoch = epoch
@@ -144,7 +332,7 @@ class Solver():
             self.evaluation(eval_data, filename='val_data_after_training')
 
             
-    def evaluation(self, eval_dataset: Dataset):
+    def evaluation(self, eval_dataset: Dataset, filename: str = None):
         """
         Estimate the standard error on the provided dataset and write it to evaluation_val.txt in the run directory
         Args:
@@ -158,18 +346,17 @@ class Solver():
         """
        
         self.model.eval()
-        if len(eval_dataset[0][0].shape) == 2:  # if we have per residue embeddings they have an additional length dim
-            collate_function = padded_permuted_collate
-        else:  # if we have reduced sequence wise embeddings use the default collate function by passing None
-            collate_function = None
+        collate_function = self.collate_function(labelled=True)
         io = IOStream('outputs/' + self.args.exp_name + '/run.log')
-        data_loader = DataLoader(eval_dataset, batch_size=self.args.batch_size, collate_fn=collate_function)
+        data_loader = build_data_loader(eval_dataset, self.args, collate_fn=collate_function)
         
         with torch.no_grad():  
             
             count = 0.0
             test_pred = []
             test_true = []
+            padded_residues = 0
+            residues = 0
             for batch in data_loader:
                 embedding, sol, metadata = batch  # print('sol',sol)
 
@@ -177,8 +364,10 @@ class Solver():
                 sequence_lengths = metadata['length'][:, None].to(self.device) 
                 frequencies = metadata['frequencies'].to(self.device)  
 
-                mask = torch.arange(metadata['length'].max())[None, :] < metadata['length'][:,None]  
-                outputs = self.model(embedding, mask=mask.to(self.device), sequence_lengths=sequence_lengths,
+                mask = self.padding_mask(embedding, metadata)
+                padded_residues += mask.numel()
+                residues += int(metadata['length'].sum())
+                outputs = self.forward(embedding, mask=mask.to(self.device), sequence_lengths=sequence_lengths,
                                         frequencies=frequencies)
 
                 
@@ -191,71 +380,422 @@ class Solver():
             test_pred = np.concatenate(test_pred)
             test_acc = metrics.accuracy_score(test_true, test_pred)
             avg_per_class_acc = metrics.balanced_accuracy_score(test_true, test_pred)
-            outstr = 'Test acc: %.6f, Test avg acc: %.6f' % (test_acc,avg_per_class_acc)
+            outstr = 'Test acc: %.6f, Test avg acc: %.6f, padding ratio: %.4f' % (test_acc, avg_per_class_acc,
+                                                                                1 - residues / padded_residues)
             io.cprint(outstr)
                 
 
-    def predict_evaluation(self, eval_dataset: Dataset):
+    def iter_predictions(self, eval_dataset: Dataset, models: List[nn.Module] = None, start: int = 0) -> Iterator[
+        Tuple[np.ndarray, np.ndarray]]:
         """
-        Estimate the standard error on the provided dataset and write it to evaluation_val.txt in the run directory
+        Predict the proteins of eval_dataset and yield the predictions in the order of the fasta file as soon as all
+        earlier proteins are predicted. Batches of the length buckets are predicted out of order, their predictions
+        wait in a buffer that holds at most one bucket. If args.window_size is set, long proteins are predicted in
+        overlapping windows that are batched with the other proteins and their predictions are aggregated with
+        args.window_aggregation.
         Args:
-            eval_dataset: the dataset for which to estimate the stderr
-            filename: string to append to the produced visualizations
-            lookup_dataset: dataset used for embedding space similarity annotation transfer. If it is none, no annotation transfer will be done
-            accuracy_threshold: accuracy to determine the distance below which the annotation transfer is used.
+            eval_dataset: dataset without solubility labels
+            models: models that predict every batch while it is on the device, only self.model by default
+            start: index of the first protein to predict, the proteins before it are skipped
 
-        Returns:
+        Returns: iterator of (indices of the proteins in eval_dataset, [number of proteins, output_dim] predictions)
+            or [number of proteins, len(models) * output_dim] predictions if models are given
 
         """
-        
-        self.model.eval()
-        if len(eval_dataset[0][0].shape) == 2:  # if we have per residue embeddings they have an additional length dim
-            collate_function = predict_padded_permuted_collate
-        else:  # if we have reduced sequence wise embeddings use the default collate function by passing None
-            collate_function = None
-
-        data_loader = DataLoader(eval_dataset, batch_size=self.args.batch_size, collate_fn=collate_function)
-        identifiers =[]
-        sequences = []
+        models = [self.model] if models is None else models
+        if getattr(self.args, 'num_processes', 1) > 1:
+            yield from self.iter_sharded_predictions(eval_dataset, models, start)
+            return
+        for model in models:
+            model.eval()
+        collate_function = self.collate_function(labelled=False)
+        windows = None
+        samples = eval_dataset
+        if getattr(self.args, 'window_size', 0) > 0:
+            windows = samples = SlidingWindowDataset(eval_dataset, self.args.window_size, self.args.window_overlap)
+            window_ends = windows.first_windows + windows.window_counts
+        if start >= len(eval_dataset):
+            return
+        first_sample = start if windows is None else int(windows.first_windows[start])
+        if first_sample > 0:
+            samples = LengthSubset(samples, range(first_sample, len(samples)))
+
+        data_loader = build_data_loader(samples, self.args, collate_fn=collate_function)
+        batch_sampler = data_loader.batch_sampler
+        if isinstance(batch_sampler, LengthBucketBatchSampler):
+            batch_sampler.record_batches = True  # the indices of the batches that are prefetched by the loader
+        pending = {}  # predictions of samples that wait for an earlier sample
+        next_sample = first_sample
+        next_protein = start
+        window_predictions = None  # predicted windows of the proteins that are not complete yet
+        with torch.no_grad():
+            for batch_index, batch in enumerate(data_loader):
+                outputs = self.predict_batch(batch, models)
+
+                if isinstance(batch_sampler, LengthBucketBatchSampler):
+                    indices = batch_sampler.yielded_batches.popleft()
+                else:
+                    first = batch_index * self.args.batch_size
+                    indices = range(first, first + len(outputs))
+                pending.update(zip(np.asarray(indices) + first_sample, outputs))
+                ordered = []
+                while next_sample in pending:
+                    ordered.append(pending.pop(next_sample))
+                    next_sample += 1
+                if not ordered:
+                    continue
+                ordered = np.stack(ordered)
+
+                if windows is None:
+                    yield np.arange(next_sample - len(ordered), next_sample), ordered
+                    continue
+                # proteins are complete once all of their windows are predicted
+                if window_predictions is not None:
+                    ordered = np.concatenate([window_predictions, ordered])
+                window_predictions = ordered
+                complete = int(np.searchsorted(window_ends, next_sample, side='right'))
+                if complete == next_protein:
+                    continue
+                proteins = slice(next_protein, complete)
+                complete_windows = int(windows.window_counts[proteins].sum())
+                yield np.arange(next_protein, complete), windows.aggregate(window_predictions[:complete_windows],
+                                                                           self.args.window_aggregation, proteins)
+                window_predictions = window_predictions[complete_windows:]
+                next_protein = complete
+
+    def iter_sharded_predictions(self, eval_dataset: Dataset, models: List[nn.Module], start: int = 0,
+                                 shards_per_process: int = 4) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Like iter_predictions, but the proteins are split into shards with about the same number of residues that are
+        predicted on the cpu by the args.num_processes worker processes of a ShardPool.
+        Args:
+            eval_dataset: dataset without solubility labels that can be pickled
+            models: models that predict every batch, they are copied to the workers on the cpu
+            start: index of the first protein to predict, the proteins before it are skipped
+            shards_per_process: number of shards per worker, more shards write the first predictions earlier
+
+        Returns: iterator of (indices of the proteins in eval_dataset, predictions) in the order of the fasta file
+
+        """
+        proteins = np.arange(start, len(eval_dataset))
+        if len(proteins) == 0:
+            return
+        with ShardPool(self.args, eval_dataset, models) as pool:
+            yield from pool.predict(proteins, shards_per_process)
+
+    def predict_batch(self, batch: Tuple[torch.Tensor, dict], models: List[nn.Module] = None) -> np.ndarray:
+        """
+        Predict a batch of the collate_function without labels, the models have to be in eval mode
+        Args:
+            batch: padded embeddings and collated metadata
+            models: models that predict the batch while it is on the device, only self.model by default
+
+        Returns: [batch_size, len(models) * output_dim] predictions
+
+        """
+        models = [self.model] if models is None else models
+        embedding, metadata = batch
+
+        embedding = embedding.to(self.device)
+        sequence_lengths = metadata['length'][:, None].to(self.device)
+        frequencies = metadata['frequencies'].to(self.device)
+
+        mask = self.padding_mask(embedding, metadata)
+        mask = mask.to(self.device)
+        with torch.no_grad():
+            outputs = torch.cat([self.forward(embedding, model=model, mask=mask, sequence_lengths=sequence_lengths,
+                                              frequencies=frequencies) for model in models], dim=1)
+        return outputs.cpu().numpy()
+
+    def iter_cached_predictions(self, eval_dataset: Dataset, cache: PredictionCache, models: List[nn.Module] = None,
+                                start: int = 0, chunk_size: int = 100000, proteins: np.ndarray = None) -> Iterator[
+        Tuple[np.ndarray, np.ndarray]]:
+        """
+        Like iter_predictions, but the proteins whose sequences are in the cache are taken from there and only the
+        other proteins are read and predicted. Their predictions are added to the cache. The cache is queried for
+        chunk_size proteins at a time.
+        Args:
+            eval_dataset: dataset without solubility labels
+            cache: PredictionCache with the fingerprint of the models
+            models: models that predict every batch while it is on the device, only self.model by default
+            start: index of the first protein to predict, the proteins before it are skipped
+            chunk_size: number of proteins that are looked up at once
+            proteins: ascending indices of the proteins to predict instead of all proteins from start
+
+        Returns: iterator of (indices of the proteins in eval_dataset, predictions) in the order of the fasta file
+
+        """
+        metadata = eval_dataset.metadata
+        if proteins is None:
+            proteins = np.arange(start, len(eval_dataset))
+        models = [self.model] if models is None else models
+        pool = None  # worker processes that predict the misses of all chunks, started at the first miss
+        try:
+            for chunk_start in range(0, len(proteins), chunk_size):
+                chunk = proteins[chunk_start:chunk_start + chunk_size]
+                hashes = [sequence_hash(metadata.sequence(i)) for i in chunk]
+                cached = cache.get_many(hashes)
+                missing = np.array([i for i, hash in enumerate(hashes) if hash not in cached], dtype=np.int64)
+                predicted = []
+                if len(missing) > 0 and getattr(self.args, 'num_processes', 1) > 1:
+                    if pool is None:
+                        pool = ShardPool(self.args, eval_dataset, models)
+                    predicted = ((np.searchsorted(chunk[missing], shard), predictions)
+                                 for shard, predictions in pool.predict(chunk[missing]))
+                elif len(missing) > 0:
+                    predicted = self.iter_predictions(LengthSubset(eval_dataset, chunk[missing]), models)
+                first = 0  # first position in the chunk that was not yielded yet
+                for positions, predictions in predicted:
+                    done = missing[positions]
+                    cache.put_many([hashes[i] for i in done], predictions)
+                    merged = np.empty((done[-1] + 1 - first,) + predictions.shape[1:], dtype=predictions.dtype)
+                    merged[done - first] = predictions
+                    for i in np.setdiff1d(np.arange(first, done[-1] + 1), done):
+                        merged[i - first] = cached[hashes[i]]
+                    yield chunk[first:done[-1] + 1], merged
+                    first = done[-1] + 1
+                if first < len(chunk):  # the cached proteins after the last predicted one
+                    yield chunk[first:], np.stack([cached[hashes[i]] for i in range(first, len(chunk))])
+        finally:
+            if pool is not None:
+                pool.close()
+
+    def iter_deduplicated_predictions(self, eval_dataset: Dataset, models: List[nn.Module] = None,
+                                      cache: PredictionCache = None, start: int = 0) -> Iterator[
+        Tuple[np.ndarray, np.ndarray]]:
+        """
+        Like iter_predictions, but a sequence that occurs under several ids is only read and predicted for its first
+        protein, the prediction is repeated for the other proteins with the same sequence. The dedup ratio and an
+        estimate of the prediction time that was saved are printed when all proteins are predicted. Unlike the other
+        iterators its memory grows with the input: the first protein of every sequence hash is kept for the whole run,
+        about 150 bytes per protein, so it is only used with args.deduplicate.
+        Args:
+            eval_dataset: dataset without solubility labels
+            models: models that predict every batch while it is on the device, only self.model by default
+            cache: PredictionCache that the unique sequences are looked up in, no cache by default
+            start: index of the first protein to predict, the proteins before it are skipped
+
+        Returns: iterator of (indices of the proteins in eval_dataset, predictions) in the order of the fasta file
+
+        """
+        metadata = eval_dataset.metadata
+        first_proteins = {}
+        # first protein with the same sequence for every protein
+        representatives = np.array([first_proteins.setdefault(sequence_hash(metadata.sequence(i)), i)
+                                    for i in range(start, len(eval_dataset))], dtype=np.int64)
+        unique, counts = np.unique(representatives, return_counts=True)
+        if len(unique) == len(representatives):  # no duplicates
+            if cache is None:
+                yield from self.iter_predictions(eval_dataset, models, start=start)
+            else:
+                yield from self.iter_cached_predictions(eval_dataset, cache, models, start=start)
+            return
+        if cache is None:
+            predicted = ((unique[positions], predictions) for positions, predictions in
+                         self.iter_predictions(LengthSubset(eval_dataset, unique), models))
+        else:
+            predicted = self.iter_cached_predictions(eval_dataset, cache, models, proteins=unique)
+        shared = set(unique[counts > 1].tolist())
+        kept = {}  # predictions of the sequences that occur again later
+        next_protein = start
+        started = time.time()
+        for proteins, predictions in predicted:
+            kept.update((protein, prediction) for protein, prediction in zip(proteins.tolist(), predictions)
+                        if protein in shared)
+            end = len(eval_dataset) if proteins[-1] == unique[-1] else int(proteins[-1]) + 1
+            yield np.arange(next_protein, end), np.stack([kept[protein] if protein in shared else
+                                                          predictions[np.searchsorted(proteins, protein)]
+                                                          for protein in representatives[next_protein - start:
+                                                                                         end - start]])
+            next_protein = end
+        lengths = np.asarray(metadata.lengths[start:], dtype=np.int64)
+        unique_residues = int(lengths[unique - start].sum())
+        saved = (time.time() - started) / max(unique_residues, 1) * (int(lengths.sum()) - unique_residues)
+        print('deduplication: {} proteins, {} unique sequences, dedup ratio {:.2f}, saved about {:.1f}s of '
+              'prediction'.format(len(representatives), len(unique), len(representatives) / len(unique), saved))
+
+    def predict(self, eval_dataset: Dataset) -> pd.DataFrame:
+        """
+        Predict the proteins of eval_dataset
+        Args:
+            eval_dataset: dataset without solubility labels
+
+        Returns: DataFrame with the columns protein_ID, sequence and predict_result in the order of the fasta file
+
+        """
+        indices = []
         predictions = []
-        
-        with torch.no_grad():  
-                
-                count = 0.0
-                test_pred = []
-                
-                for batch in data_loader:
-                    # print(batch)
-                    
-                    embedding, metadata = batch  # print('sol',sol)
-                
-                    embedding = embedding.to(self.device)
-                    sequence_lengths = metadata['length'][:, None].to(self.device) 
-                    frequencies = metadata['frequencies'].to(self.device)  
-                    
-                    mask = torch.arange(metadata['length'].max())[None, :] < metadata['length'][:,None]  
-                    outputs = self.model(embedding, mask=mask.to(self.device), sequence_lengths=sequence_lengths,
-                                            frequencies=frequencies)
-                    
-                    identifiers.append(metadata['id'])
-                    sequences.append(metadata['sequence'])
-                    predictions.append(outputs.detach().cpu().numpy())
+        for batch_indices, batch_predictions in self.iter_predictions(eval_dataset):
+            indices.append(batch_indices)
+            predictions.append(batch_predictions)
+        indices = np.concatenate(indices)
+        prediction_result = pd.DataFrame(columns=['protein_ID', 'sequence', 'predict_result'])
+        prediction_result['protein_ID'] = [eval_dataset.metadata.id(i) for i in indices]
+        prediction_result['sequence'] = [eval_dataset.metadata.sequence(i) for i in indices]
+        prediction_result['predict_result'] = np.concatenate(predictions).reshape(-1)
+        return prediction_result
+
+    def predict_evaluation(self, eval_dataset: Dataset, models: Dict[str, nn.Module] = None):
+        """
+        Predict the solubility of the proteins in eval_dataset and stream the predictions in chunks to
+        <output_files_name>_prediction_result.csv or .parquet, depending on args.output_format
+        Args:
+            eval_dataset: dataset without solubility labels
+            models: ensemble of models by the name of their prediction column, for example from ensemble_models. Every
+                batch is read once and predicted by all models, the file gets a column per model and the columns
+                ensemble_mean and ensemble_std. Only self.model predicts the predict_result column by default
+
+        Returns: path of the written file
+
+        """
+        output_format = getattr(self.args, 'output_format', 'csv')
+        path = prediction_path(getattr(self.args, 'output_files_name', 'protTrans'), output_format)
+        write_sequences = getattr(self.args, 'write_sequences', True)
+        prediction_columns = ['predict_result'] if models is None else list(models) + ['ensemble_mean',
+                                                                                      'ensemble_std']
+        metadata = eval_dataset.metadata
+        # a run is only resumed for the same proteins and prediction settings
+        run_info = {'proteins': len(metadata), 'ids_sha1': hashlib.sha1(metadata.ids.tobytes()).hexdigest(),
+                    'window_size': getattr(self.args, 'window_size', 0),
+                    'checkpoints': [str(self.args.checkpoint)] if models is None else list(models)}
+        cache = None
+        if getattr(self.args, 'prediction_cache', None):
+            checkpoints = cached_checkpoints(self.args, ensemble=models is not None)
+            cache = PredictionCache(self.args.prediction_cache, checkpoints,
+                                    prediction_fingerprint(self.args, checkpoints))
+        with PredictionWriter(path, output_format, write_sequences=write_sequences,
+                              chunk_size=getattr(self.args, 'write_chunk_size', 10000),
+                              prediction_columns=prediction_columns, resume=getattr(self.args, 'resume', False),
+                              run_info=run_info) as writer:
+            if writer.rows_written > 0:
+                print('resuming {} after {} of {} proteins'.format(path, writer.rows_written, len(metadata)))
+            model_list = None if models is None else list(models.values())
+            if getattr(self.args, 'deduplicate', False):
+                predictions_iterator = self.iter_deduplicated_predictions(eval_dataset, model_list, cache,
+                                                                          start=writer.rows_written)
+            elif cache is None:
+                predictions_iterator = self.iter_predictions(eval_dataset, model_list, start=writer.rows_written)
+            else:
+                predictions_iterator = self.iter_cached_predictions(eval_dataset, cache, model_list,
+                                                                    start=writer.rows_written)
+            for indices, predictions in predictions_iterator:
+                if models is not None:
+                    predictions = np.concatenate([predictions, predictions.mean(axis=1, keepdims=True),
+                                                  predictions.std(axis=1, keepdims=True)], axis=1)
+                sequences = [metadata.sequence(i) for i in indices] if write_sequences else None
+                writer.write([metadata.id(i) for i in indices], sequences, predictions)
+        if cache is not None:
+            print('prediction cache: {} hits, {} misses, hit rate {:.1%}'.format(cache.hits, cache.misses,
+                                                                                cache.hit_rate()))
+            cache.close()
+        if getattr(self.args, 'verify_predictions', True):
+            rows = verify_predictions(path, metadata.ids.astype(str), output_format)
+            print('verified {}: {} rows, one for every protein in the order of the fasta file'.format(path, rows))
+        return path
+
+    def ensemble_models(self, checkpoints: List[str]) -> Dict[str, nn.Module]:
+        """
+        Copies of self.model with the weights of every checkpoint
+        Args:
+            checkpoints: paths of the state dicts of the models
+
+        Returns: dict of the models by the name of their prediction column, predict_result_<checkpoint file name>
+            or predict_result_<position in checkpoints> if the file names are not unique
+
+        """
+        names = [os.path.splitext(os.path.basename(checkpoint))[0] for checkpoint in checkpoints]
+        if len(set(names)) < len(names):
+            names = [str(i) for i in range(len(checkpoints))]
+        models = {}
+        for name, checkpoint in zip(names, checkpoints):
+            model = copy.deepcopy(self.model)
+            model.load_state_dict(torch.load(checkpoint, map_location=self.device))
+            models['predict_result_' + name] = model
+        return models
+
+    def quantize(self, mode: str, calibration_dataset: Dataset = None, calibration_samples: int = 64):
+        """
+        Replace self.model by an int8 quantized copy. Quantized models only run on the cpu, so the batches are no
+        longer moved to the gpu and autocast is disabled.
+        Args:
+            mode: one of QUANTIZATION_MODES
+            calibration_dataset: dataset without labels whose embeddings calibrate the static quantization
+            calibration_samples: number of randomly chosen proteins of calibration_dataset for the calibration
+
+        Returns:
+
+        """
+        self.device = torch.device('cpu')
+        self.autocast_dtype = None
+        calibration_batches = None
+        if mode == 'static':
+            if calibration_dataset is None:
+                raise ValueError('static quantization needs a calibration dataset')
+            rng = np.random.default_rng(getattr(self.args, 'seed', 123))
+            sample = np.sort(rng.choice(len(calibration_dataset), min(calibration_samples, len(calibration_dataset)),
+                                        replace=False))
+            loader = build_data_loader(LengthSubset(calibration_dataset, sample), self.args,
+                                       collate_fn=self.collate_function(labelled=False))
+            calibration_batches = ((embedding.float(), self.padding_mask(embedding, metadata))
+                                   for embedding, metadata in loader)
+        self.model = quantize_model(self.model, mode, calibration_batches)
+
+    def padding_mask(self, embedding: torch.Tensor, metadata: dict) -> torch.Tensor:
+        """mask of the residues of a batch of collate_function that is as wide as the padded batch"""
+        return padding_mask(embedding, metadata['length'], getattr(self.model, 'input_layout', 'BDL'))
+
+    def collate_function(self, labelled: bool) -> PaddedCollate:
+        """
+        Collate function that pads the embeddings into the layout that the model declares with input_layout
+        Args:
+            labelled: whether the dataset returns solubility labels
+
+        Returns: the collate function
+
+        """
+        return PaddedCollate(layout=getattr(self.model, 'input_layout', 'BDL'), dtype=self.input_dtype,
+                             pin_memory=self.args.pin_memory, labelled=labelled,
+                             min_length=min_input_length(self.model))
+
+    def forward(self, embedding: torch.Tensor, model: nn.Module = None, **kwargs) -> torch.Tensor:
+        """
+        Run the model on a padded batch that is already on the device. Batches in half precision are cast to float32
+        here, or the model runs under autocast if args.autocast is set, so the host only ever holds and transfers
+        them in input_dtype.
+        Args:
+            embedding: padded batch in input_dtype
+            model: model to run, self.model by default
+            **kwargs: mask, sequence_lengths and frequencies for the model
+
+        Returns: float32 outputs of the model
+
+        """
+        model = self.model if model is None else model
+        if self.autocast_dtype is not None:
+            with torch.autocast(device_type=self.device.type, dtype=self.autocast_dtype):
+                outputs = model(embedding, **kwargs)
+            return outputs.float()
+        return model(embedding.float(), **kwargs)
+
+    def log_cache_stats(self, io, name: str, dataset: Dataset):
+        """
+        Write the embedding cache counters of the last epoch to the log and reset them
+        Args:
+            io: IOStream of the run
+            name: name of the dataset in the log line
+            dataset: dataset that may have an EmbeddingCache as cache attribute
+
+        Returns:
+
+        """
+        cache = getattr(dataset, 'cache', None)
+        if cache is None:
+            return
+        stats = cache.stats()
+        io.cprint('%s cache, hits: %d, misses: %d, evictions: %d, cached MB: %.1f' % (
+            name, stats['hits'], stats['misses'], stats['evictions'], stats['bytes'] / 2 ** 20))
+        cache.reset_stats()
 
-                    
-                    count += self.args.batch_size
-                    
-                    test_pred.append((outputs.detach().cpu().numpy() >= 0.5))
-                
-                test_pred = np.concatenate(test_pred)
-        
-        prediction_result = pd.DataFrame(columns=['protein_ID','sequence','predict_result'])
-        # print('identifiers',identifiers)
-        prediction_result['protein_ID'] = [s for i in identifiers for s in i]
-        prediction_result['sequence'] = [s for i in sequences for s in i]
-        prediction_result['predict_result'] = [a for i in predictions for s in i for a in s]
-        
-        prediction_result.to_csv('protTrans_prediction_result.csv')
-       
     def save_checkpoint(self, epoch: int):
         """
         Saves checkpoint of model in the logdir of the summarywriter/ in the used rundir
@@ -272,8 +812,7 @@ class Solver():
         pyaml.dump(train_args.__dict__, open(os.path.join(run_dir, 'train_arguments.yaml'), 'w'))
         shutil.copyfile(self.args.config.name, os.path.join(run_dir, os.path.basename(self.args.config.name)))
 
-        # Get the class of the used model (works because of the "from models import *" calling the init.py in the models dir)
-        model_class = globals()[type(self.model).__name__]
+        model_class = type(self.model)
         source_code = inspect.getsource(model_class)  # Get the sourcecode of the class of the model.
         file_name = os.path.basename(inspect.getfile(model_class))
         with open(os.path.join(run_dir, file_name), "w") as f:
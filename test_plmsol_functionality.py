@@ -180,7 +180,7 @@ def main():
         print(f"2. conda activate PLM_Sol (or create environment if needed)")
         print(f"3. bio_embeddings {os.path.join(test_dir, 'test_embedding_config.yml')}")
         print(f"4. python inference.py --config {inference_config_path}")
-        print("\nIf successful, you should see a file named 'protTrans_prediction_result.csv' with predictions.")
+        print("\nIf successful, you should see a file named 'test_inference_prediction_result.csv' with predictions.")
         
     except Exception as e:
         print(f"\n❌ Error during test setup: {e}")
@@ -0,0 +1,76 @@
+import argparse
+import os
+import sys
+
+import h5py
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from torchvision.transforms import transforms
+
+from datasets.embeddings_dataset import Embeddings_predict_Dataset
+from datasets.transforms import Solubility_predict_ToInt, predict_ToTensor
+
+AMINO_ACID_LETTERS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+class MaskedMeanModel(nn.Module):
+    """
+    Predicts from the mean over the residues in the mask, so the prediction of a protein does not depend on the
+    padding of its batch and every batching of the proteins has to give the predictions of one protein at a time.
+    It is defined here and not in a test so the worker processes of sharded predictions can unpickle it.
+    """
+    input_layout = 'BLD'
+
+    def __init__(self, embeddings_dim: int = 8, output_dim: int = 1):
+        super().__init__()
+        self.linear = nn.Linear(embeddings_dim, output_dim)
+
+    def forward(self, x, mask, **kwargs) -> torch.Tensor:
+        mask = mask[:, :, None].to(x.dtype)
+        return torch.sigmoid(self.linear((x * mask).sum(dim=1) / mask.sum(dim=1)))
+
+
+@pytest.fixture
+def solver_args():
+    """inference arguments of a Solver that predicts on the cpu in the main process, options override them"""
+
+    def make(**options) -> argparse.Namespace:
+        args = dict(batch_size=4, optimizer_parameters={}, checkpoint=None, length_bucketing=False,
+                    bucket_size_multiplier=2, num_workers=0, pin_memory=False, prefetch_factor=2,
+                    persistent_workers=False, seed=123, window_size=0, window_overlap=0, window_aggregation='mean',
+                    deduplicate=False)
+        args.update(options)
+        return argparse.Namespace(**args)
+
+    return make
+
+
+@pytest.fixture
+def make_dataset(tmp_path):
+    """
+    Writes random proteins of the given lengths to an h5 file and a remapped fasta file and returns their
+    Embeddings_predict_Dataset. Protein i gets the sequence and embedding of protein j for every (i, j) in repeats.
+    """
+
+    def make(lengths, embeddings_dim: int = 8, repeats=(), seed: int = 0) -> Embeddings_predict_Dataset:
+        rng = np.random.default_rng(seed)
+        sequences = [''.join(rng.choice(list(AMINO_ACID_LETTERS), size=length)) for length in lengths]
+        embeddings = [rng.standard_normal((length, embeddings_dim)).astype(np.float32) for length in lengths]
+        for i, j in repeats:
+            sequences[i] = sequences[j]
+            embeddings[i] = embeddings[j]
+        embeddings_path = str(tmp_path / 'embeddings_file.h5')
+        remapping_path = str(tmp_path / 'remapped_sequences_file.fasta')
+        with h5py.File(embeddings_path, 'w') as f, open(remapping_path, 'w') as fasta:
+            for i, (sequence, embedding) in enumerate(zip(sequences, embeddings)):
+                f.create_dataset('id{:05d}'.format(i), data=embedding)
+                fasta.write('>id{:05d} protein_{}\n{}\n'.format(i, i, sequence))
+        transform = transforms.Compose([Solubility_predict_ToInt(), predict_ToTensor(dtype=None)])
+        return Embeddings_predict_Dataset(embeddings_path, remapping_path, key_format='hash', transform=transform)
+
+    return make
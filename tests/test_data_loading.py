@@ -0,0 +1,41 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+from solver import build_data_loader
+from utils.general import PaddedCollate
+
+LENGTHS = [12, 30, 7, 19, 25, 3, 40, 16, 9]
+
+
+def test_h5_file_is_opened_on_first_access_once_per_process(make_dataset):
+    data_set = make_dataset(LENGTHS)
+    assert data_set._embeddings_file is None
+    embedding = data_set[2][0]
+    handle = data_set.embeddings_file
+    assert data_set.embeddings_file is handle and handle.id.valid
+    # a process that inherited the dataset, like a forked DataLoader worker, opens its own handle
+    data_set._embeddings_pid = os.getpid() + 1
+    assert data_set.embeddings_file is not handle
+    # spawned workers get a pickled copy without the open handle
+    copy = pickle.loads(pickle.dumps(data_set))
+    assert copy._embeddings_file is None
+    torch.testing.assert_close(copy[2][0], embedding)
+
+
+@pytest.mark.parametrize('num_workers, persistent_workers', [(2, False), (2, True)])
+def test_workers_load_the_same_batches(make_dataset, solver_args, num_workers, persistent_workers):
+    data_set = make_dataset(LENGTHS)
+    collate = PaddedCollate(layout='BLD', labelled=False)
+    expected = [batch.clone() for batch, _ in build_data_loader(data_set, solver_args(batch_size=4), collate)]
+    data_loader = build_data_loader(data_set, solver_args(batch_size=4, num_workers=num_workers, prefetch_factor=1,
+                                                          persistent_workers=persistent_workers), collate)
+    assert data_loader.num_workers == num_workers and data_loader.persistent_workers == persistent_workers
+    for _ in range(2):  # persistent workers keep their open h5 files for the next epoch
+        batches = [batch for batch, _ in data_loader]
+        assert len(batches) == len(expected)
+        for batch, expected_batch in zip(batches, expected):
+            np.testing.assert_array_equal(batch.numpy(), expected_batch.numpy())
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from torchvision.transforms import transforms
+
+from datasets.embedding_cache import EmbeddingCache, split_cache_budget
+from datasets.embeddings_dataset import EmbeddingsDataset
+from datasets.transforms import SolubilityToInt, ToTensor
+
+LENGTHS = [10, 40, 25, 5, 60, 15]
+
+
+@pytest.fixture
+def train_set(make_dataset, tmp_path):
+    """EmbeddingsDataset with solubility labels of the proteins of make_dataset"""
+    predict_set = make_dataset(LENGTHS, embeddings_dim=8)
+    remapping = str(tmp_path / 'labelled_sequences_file.fasta')
+    with open(remapping, 'w') as fasta:
+        for i in range(len(LENGTHS)):
+            fasta.write('>id{:05d} protein_{} A-{}\n{}\n'.format(i, i, i % 2, predict_set.metadata.sequence(i)))
+    return EmbeddingsDataset(predict_set.embeddings_path, remapping, key_format='hash',
+                             transform=transforms.Compose([SolubilityToInt(), ToTensor(dtype=None)]),
+                             cache_bytes=(10 + 40 + 25) * 8 * 4)
+
+
+def test_least_recently_used_embeddings_are_evicted():
+    cache = EmbeddingCache(max_bytes=3 * 400)
+    for key in 'abc':
+        cache.put(key, np.zeros(100, dtype=np.float32))
+    assert cache.get('a') is not None
+    cache.put('d', np.zeros(100, dtype=np.float32))
+    assert 'b' not in cache and all(key in cache for key in 'acd')
+    # an embedding larger than the budget is not cached
+    cache.put('e', np.zeros(400, dtype=np.float32))
+    assert 'e' not in cache
+    assert cache.stats() == {'hits': 1, 'misses': 0, 'evictions': 1, 'bytes': 3 * 400}
+
+
+def test_cache_budget_is_split_by_residues():
+    budgets = split_cache_budget(1000, [np.array([30, 50]), np.array([20])])
+    assert budgets == [800, 200]
+    assert split_cache_budget(0, [np.array([30]), np.array([20])]) == [0, 0]
+
+
+def test_fill_cache_reads_no_embedding_that_does_not_fit(train_set):
+    read = []
+    read_embedding = train_set.read
+
+    def counting_read(key, *args):
+        read.append(key)
+        return read_embedding(key, *args)
+
+    train_set.read = counting_read
+    train_set.fill_cache()
+    # the first three proteins fill the budget exactly, the size of the fourth is known from its length
+    assert len(train_set.cache) == 3 and train_set.cache.frozen
+    assert read == ['id00000', 'id00001', 'id00002']
+    assert train_set.cache.nbytes <= train_set.cache.max_bytes
+    np.testing.assert_array_equal(train_set[1][0].numpy(), read_embedding('id00001'))
+
+
+def test_epoch_stats_count_only_the_epoch(train_set):
+    read = []
+    read_embedding = train_set.read
+
+    def counting_read(key, *args):
+        read.append(key)
+        return read_embedding(key, *args)
+
+    train_set.read = counting_read
+    # the model is built from the width of the embeddings before the cache is filled
+    assert train_set.embeddings_dim == 8
+    assert read == [] and len(train_set.cache) == 0
+    train_set.fill_cache()
+    assert train_set.cache.stats()['hits'] == train_set.cache.stats()['misses'] == 0
+    for index in range(len(train_set)):
+        train_set[index]
+    assert train_set.cache.stats()['hits'] == 3 and train_set.cache.stats()['misses'] == len(LENGTHS) - 3
@@ -0,0 +1,225 @@
+import os
+import queue
+import shutil
+import sys
+
+import h5py
+import numpy as np
+import pytest
+import yaml
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+import generate_embeddings_memory_efficient
+from datasets.embeddings_dataset import Embeddings_predict_Dataset
+from generate_embeddings_memory_efficient import (STAGING_GROUP, length_balanced_shards, merge_shards,
+                                                  peak_rss_megabytes, present_ids, read_batches, reset_peak_rss,
+                                                  shard_files, token_budget_batches)
+from utils.h5_storage import VIRTUAL_SOURCES_ATTRIBUTE
+
+SEQUENCES = ['MKV', 'ACDEFGHIK', 'WY', 'MKV', 'LLLLKPP', 'GS', 'QQRRT']
+
+
+def records(lengths):
+    return [SeqRecord(Seq('A' * length), id='id{}'.format(i)) for i, length in enumerate(lengths)]
+
+
+def embedding(sequence: str) -> np.ndarray:
+    """[length, 4] embedding that depends only on the sequence"""
+    return np.repeat(np.frombuffer(sequence.encode(), dtype=np.uint8).astype(np.float32)[:, None], 4, axis=1)
+
+
+class FakeEmbedder():
+    """embed_many of the ProtT5 embedder that interrupts the run after fail_after batches"""
+
+    def __init__(self, fail_after: int = None):
+        self.fail_after = fail_after
+        self.batches = []
+
+    def embed_many(self, sequences):
+        if self.fail_after is not None and len(self.batches) == self.fail_after:
+            raise KeyboardInterrupt
+        self.batches.append(list(sequences))
+        return [embedding(sequence) for sequence in sequences]
+
+
+@pytest.fixture
+def generate(tmp_path, monkeypatch):
+    """runs the main function of generate_embeddings_memory_efficient on SEQUENCES with an embedder and options"""
+    with open(tmp_path / 'remapped_sequences_file.fasta', 'w') as fasta:
+        for i, sequence in enumerate(SEQUENCES):
+            fasta.write('>id{}\n{}\n'.format(i, sequence))
+    with open(tmp_path / 'embed_config.yml', 'w') as f:
+        yaml.safe_dump({'global': {'sequences_file': str(tmp_path / 'remapped_sequences_file.fasta'),
+                                   'prefix': str(tmp_path)}}, f)
+
+    def run(embedder, *options) -> str:
+        monkeypatch.setattr(generate_embeddings_memory_efficient, 'load_embedder', lambda args: embedder)
+        monkeypatch.setattr(sys, 'argv', ['generate_embeddings_memory_efficient.py', '--config',
+                                          str(tmp_path / 'embed_config.yml')] + list(options))
+        generate_embeddings_memory_efficient.main()
+        return str(tmp_path / 't5_embeddings' / 'embeddings_file.h5')
+
+    return run
+
+
+def test_token_budget_batches_are_longest_first_within_the_budget():
+    lengths = [12, 300, 40, 41, 7, 150, 90, 3, 60, 18]
+    batches = list(token_budget_batches(records(lengths), max_residues=160))
+    batch_lengths = [[len(record.seq) for record in batch] for batch in batches]
+    assert sorted(record.id for batch in batches for record in batch) == sorted('id{}'.format(i)
+                                                                                for i in range(len(lengths)))
+    flat = [length for batch in batch_lengths for length in batch]
+    assert flat == sorted(lengths, reverse=True)
+    # sequences longer than the budget are embedded alone, every other batch fits the budget padded
+    assert batch_lengths[0] == [300]
+    assert all(len(batch) * batch[0] <= 160 for batch in batch_lengths[1:])
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='the peak resident memory is reset through /proc')
+def test_peak_rss_is_measured_per_batch():
+    if not reset_peak_rss():
+        pytest.skip('the kernel does not reset the peak resident memory')
+    large = np.ones(200 * 2 ** 20 // 8)
+    large_peak = peak_rss_megabytes()
+    del large
+    assert reset_peak_rss()
+    small = np.ones(2 ** 20 // 8)
+    small_peak = peak_rss_megabytes()
+    del small
+    # a later and smaller batch does not report the peak of the first batch
+    assert small_peak < large_peak - 150
+
+
+def test_interrupted_runs_are_resumed(generate):
+    interrupted = FakeEmbedder(fail_after=2)
+    with pytest.raises(KeyboardInterrupt):
+        generate(interrupted, '--batch_size', '2')
+    resumed = FakeEmbedder()
+    embeddings_file = generate(resumed, '--batch_size', '2')
+    # every unique sequence is embedded once over both runs, the duplicate of MKV is linked to the embedding of id0
+    assert interrupted.batches + resumed.batches == [['MKV', 'ACDEFGHIK'], ['WY', 'LLLLKPP'], ['GS', 'QQRRT']]
+    with h5py.File(embeddings_file, 'r') as f:
+        assert sorted(f.keys()) == ['id{}'.format(i) for i in range(len(SEQUENCES))]
+        for i, sequence in enumerate(SEQUENCES):
+            np.testing.assert_array_equal(f['id{}'.format(i)][:], embedding(sequence))
+
+
+def test_resumed_runs_skip_the_present_ids(generate):
+    embeddings_file = generate(FakeEmbedder(), '--batch_size', '2')
+    resumed = FakeEmbedder()
+    generate(resumed, '--batch_size', '2')
+    assert resumed.batches == []
+    # an interrupted batch leaves embeddings in the staging group, they do not count as present
+    with h5py.File(embeddings_file, 'a') as f:
+        f.move('id6', '{}/id6'.format(STAGING_GROUP))
+    assert 'id6' not in present_ids(embeddings_file)
+    with h5py.File(embeddings_file, 'r') as f:
+        assert STAGING_GROUP not in f
+    generate(resumed, '--batch_size', '2')
+    assert resumed.batches == [['QQRRT']]
+
+
+def test_the_pipeline_reports_its_stages(generate, capsys):
+    embedder = FakeEmbedder()
+    generate(embedder, '--batch_size', '2', '--queue_size', '1')
+    assert len(embedder.batches) == 3
+    output = capsys.readouterr().out
+    assert 'Stage timing: read' in output and 'The slowest stage is' in output
+
+
+def test_reader_ends_the_batches_after_an_error():
+    def failing_batches():
+        yield ['a']
+        raise ValueError('unreadable fasta')
+
+    batch_queue = queue.Queue()
+    with pytest.raises(ValueError):
+        read_batches(failing_batches(), batch_queue, {'read': 0.0})
+    # the model thread gets the batches before the error and then the end of the batches
+    assert [batch_queue.get_nowait() for _ in range(2)] == [['a'], None]
+
+
+def test_writer_errors_are_raised_in_the_main_thread(generate, monkeypatch):
+    write_batch = generate_embeddings_memory_efficient.write_batch
+    writes = []
+
+    def failing_write_batch(f, embedded, args):
+        writes.append(len(embedded))
+        if len(writes) == 1:
+            raise OSError('disk full')
+        write_batch(f, embedded, args)
+
+    monkeypatch.setattr(generate_embeddings_memory_efficient, 'write_batch', failing_write_batch)
+    embedder = FakeEmbedder()
+    with pytest.raises(OSError, match='disk full'):
+        generate(embedder, '--batch_size', '1', '--queue_size', '1')
+    # after the error the writer drops the batches instead of writing them
+    assert writes == [1]
+    monkeypatch.setattr(generate_embeddings_memory_efficient, 'write_batch', write_batch)
+    resumed = FakeEmbedder()
+    generate(resumed, '--batch_size', '1')
+    assert resumed.batches[0] == ['MKV']
+
+
+def write_shards(shards_dir, shards) -> list:
+    """shard h5 files like the processes of a sharded run write them, the last one with an interrupted batch"""
+    for rank, shard in enumerate(shards):
+        directory = os.path.join(shards_dir, 'shard_{}'.format(rank), 't5_embeddings')
+        os.makedirs(directory)
+        with h5py.File(os.path.join(directory, 'embeddings_file.h5'), 'w') as f:
+            for i in shard:
+                f.create_dataset('id{}'.format(i), data=embedding(SEQUENCES[i]))
+            if rank == len(shards) - 1:
+                f.create_dataset('{}/id99'.format(STAGING_GROUP), data=embedding('MKV'))
+    return shard_files(shards_dir)
+
+
+def test_length_balanced_shards():
+    shards = length_balanced_shards(records([300, 10, 150, 140, 20, 5]), 3)
+    assert [[len(record.seq) for record in shard] for shard in shards] == [[300], [150, 10, 5], [140, 20]]
+    assert len(length_balanced_shards(records([10, 20]), 4)) == 2
+
+
+def test_virtual_merges_read_from_the_shard_files(tmp_path):
+    shards_dir = str(tmp_path / 't5_embeddings' / 'shards')
+    files = write_shards(shards_dir, [[0, 2], [1, 4], [5, 6]])
+    embeddings_file = str(tmp_path / 't5_embeddings' / 'embeddings_file.h5')
+    assert merge_shards(embeddings_file, files, 'virtual') == 6
+    with h5py.File(embeddings_file, 'r') as f:
+        assert sorted(f.keys()) == ['id0', 'id1', 'id2', 'id4', 'id5', 'id6']
+        assert all(f[key].is_virtual for key in f)
+        # the shard files are mapped relative to the h5 file, so the directory can be moved as a whole
+        assert [str(source) for source in f.attrs[VIRTUAL_SOURCES_ATTRIBUTE]] == [
+            os.path.join('shards', 'shard_{}'.format(rank), 't5_embeddings', 'embeddings_file.h5') for rank in range(3)]
+
+    remapping = str(tmp_path / 'remapped_sequences_file.fasta')
+    with open(remapping, 'w') as fasta:
+        for i in [0, 1, 2, 4, 5, 6]:
+            fasta.write('>id{}\n{}\n'.format(i, SEQUENCES[i]))
+    moved = str(tmp_path / 'moved')
+    shutil.move(shards_dir, moved)
+    # without its shard files the h5 file is not read as zeros
+    data_set = Embeddings_predict_Dataset(embeddings_file, remapping, key_format='hash')
+    with pytest.raises(FileNotFoundError, match='missing shard files'):
+        data_set[0]
+    shutil.move(moved, shards_dir)
+    data_set = Embeddings_predict_Dataset(embeddings_file, remapping, key_format='hash')
+    np.testing.assert_array_equal(np.asarray(data_set[1][0]), embedding(SEQUENCES[1]))
+
+
+def test_copy_merges_replace_the_virtual_datasets(tmp_path):
+    shards_dir = str(tmp_path / 'shards')
+    files = write_shards(shards_dir, [[0, 2], [1, 4]])
+    embeddings_file = str(tmp_path / 'embeddings_file.h5')
+    merge_shards(embeddings_file, files[:1], 'virtual')
+    with h5py.File(embeddings_file, 'a') as f:
+        f['id3'] = f['id0']  # the hard link of a duplicate sequence
+    assert merge_shards(embeddings_file, files, 'copy') == 2
+    assert shard_files(shards_dir) == []
+    with h5py.File(embeddings_file, 'r') as f:
+        assert VIRTUAL_SOURCES_ATTRIBUTE not in f.attrs and STAGING_GROUP not in f
+        assert sorted(f.keys()) == ['id0', 'id1', 'id2', 'id3', 'id4']
+        for key in f:
+            assert not f[key].is_virtual
+            np.testing.assert_array_equal(f[key][:], embedding(SEQUENCES[int(key[2:])]))
@@ -0,0 +1,61 @@
+import os
+
+import h5py
+import numpy as np
+import torch
+
+from datasets.embedding_store import EmbeddingStore, StoredEmbeddings, store_directory
+from datasets.embeddings_dataset import Embeddings_predict_Dataset
+
+SEQUENCES = ['MKV', 'ACDEFG', 'WY', 'LLLLK']
+
+
+def embedding(sequence: str) -> np.ndarray:
+    return np.full((len(sequence), 4), len(sequence), dtype=np.float32)
+
+
+def test_least_recently_looked_up_embeddings_are_evicted(tmp_path):
+    path = str(tmp_path / 'store')
+    store = EmbeddingStore(path, 'prottrans_t5_xl_u50', 'float16')
+    for sequence in SEQUENCES[:3]:
+        store.put(sequence, embedding(sequence))
+    nbytes = store.total_bytes
+    store.close()
+
+    # a later run looks up the first sequence, so the second is the least recently used one
+    store = EmbeddingStore(path, 'prottrans_t5_xl_u50', 'float16', max_bytes=nbytes)
+    assert store.total_bytes == nbytes
+    assert store.lookup(['MKV', 'PPP', 'MKV']) == [True, False, True]
+    store.put(SEQUENCES[3], embedding(SEQUENCES[3]))
+    assert store.lookup(SEQUENCES) == [True, False, True, True]
+    assert store.total_bytes <= nbytes
+    stored = StoredEmbeddings(store.directory)
+    assert stored['LLLLK'].dtype == np.float16 and stored['LLLLK'].shape == (5, 4)
+    assert 'ACDEFG' not in stored
+    store.close()
+
+
+def test_precisions_and_protocols_are_separate_namespaces(tmp_path):
+    path = str(tmp_path / 'store')
+    half = EmbeddingStore(path, 'prottrans_t5_xl_u50', 'float16')
+    half.put('MKV', embedding('MKV'))
+    single = EmbeddingStore(path, 'prottrans_t5_xl_u50', 'float32')
+    assert single.lookup(['MKV']) == [False]
+    assert EmbeddingStore(path, 'esm1b', 'float16').lookup(['MKV']) == [False]
+    assert os.path.basename(half.directory) == 'prottrans_t5_xl_u50-float16'
+    assert single.directory == store_directory(path, 'prottrans_t5_xl_u50')
+
+
+def test_datasets_read_stored_embeddings_by_sequence(make_dataset, tmp_path):
+    data_set = make_dataset([12, 30, 7], repeats=[(2, 0)])
+    store = EmbeddingStore(str(tmp_path / 'store'), 'prottrans_t5_xl_u50')
+    with h5py.File(data_set.embeddings_path, 'r') as f:
+        for i in range(len(data_set)):
+            store.put(data_set.metadata.sequence(i), f['id{:05d}'.format(i)][:])
+    # the duplicated sequence is stored once
+    assert len(store.connection.execute('SELECT key FROM embeddings').fetchall()) == 2
+    stored_set = Embeddings_predict_Dataset(store.directory, str(tmp_path / 'remapped_sequences_file.fasta'),
+                                            key_format='hash', transform=data_set.transform)
+    for i in range(len(data_set)):
+        assert torch.equal(stored_set[i][0], data_set[i][0])
+        assert stored_set[i][-1]['id'] == 'id{:05d}'.format(i)
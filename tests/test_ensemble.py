@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import torch
+
+from conftest import MaskedMeanModel
+from solver import Solver
+
+
+def test_every_batch_is_read_once_for_all_checkpoints(make_dataset, solver_args, tmp_path):
+    data_set = make_dataset([12, 30, 7, 19, 25, 3])
+    checkpoints = []
+    for seed in range(3):
+        torch.manual_seed(seed)
+        checkpoints.append(str(tmp_path / 'model_{}.pt'.format(seed)))
+        torch.save(MaskedMeanModel().state_dict(), checkpoints[-1])
+
+    single = []
+    for checkpoint in checkpoints:
+        model = MaskedMeanModel()
+        model.load_state_dict(torch.load(checkpoint))
+        solver = Solver(model.eval(), solver_args(), eval=True, device='cpu')
+        single.append(solver.predict(data_set)['predict_result'].to_numpy(dtype=np.float32))
+
+    read = []
+    read_embedding = data_set.read
+
+    def counting_read(key, *args):
+        read.append(key)
+        return read_embedding(key, *args)
+
+    data_set.read = counting_read
+    solver = Solver(MaskedMeanModel().eval(), solver_args(output_files_name=str(tmp_path / 'ensemble')), eval=True,
+                    device='cpu')
+    predictions = pd.read_csv(solver.predict_evaluation(data_set, solver.ensemble_models(checkpoints)),
+                              index_col=0)
+    assert sorted(read) == ['id{:05d}'.format(i) for i in range(len(data_set))]
+
+    columns = ['predict_result_model_{}'.format(seed) for seed in range(3)]
+    assert list(predictions.columns) == ['protein_ID', 'sequence'] + columns + ['ensemble_mean', 'ensemble_std']
+    for column, expected in zip(columns, single):
+        np.testing.assert_allclose(predictions[column], expected, rtol=1e-6)
+    np.testing.assert_allclose(predictions['ensemble_mean'], np.mean(single, axis=0), rtol=1e-6)
+    np.testing.assert_allclose(predictions['ensemble_std'], np.std(single, axis=0), rtol=1e-5, atol=1e-7)
+
+
+def test_checkpoints_with_the_same_file_name_are_numbered(solver_args, tmp_path):
+    checkpoints = []
+    for directory in ['a', 'b']:
+        (tmp_path / directory).mkdir()
+        checkpoints.append(str(tmp_path / directory / 'model.pt'))
+        torch.save(MaskedMeanModel().state_dict(), checkpoints[-1])
+    solver = Solver(MaskedMeanModel(), solver_args(), eval=True, device='cpu')
+    models = solver.ensemble_models(checkpoints)
+    assert list(models) == ['predict_result_0', 'predict_result_1']
+    assert all(model is not solver.model for model in models.values())
@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+from models import FFN, LightAttention, biLSTM_TextCNN
+from solver import Solver
+from utils.export import export_model, load_runtime_model
+
+# the convolutions of biLSTM_TextCNN take half of the embeddings_dim channels, which only fits 1024 dimensions
+MODELS = {'biLSTM_TextCNN': (biLSTM_TextCNN, 1024, {'kernel_size': 9}),
+          'LightAttention': (LightAttention, 16, {'kernel_size': 9}),
+          'FFN': (FFN, 16, {})}
+
+
+@pytest.mark.parametrize('model_type', sorted(MODELS))
+@pytest.mark.parametrize('export_format, runtime', [('torchscript', 'torchscript'), ('onnx', 'onnxruntime')])
+def test_exported_models_predict_like_the_eager_model(make_dataset, solver_args, tmp_path, model_type, export_format,
+                                                      runtime):
+    if export_format == 'onnx':
+        pytest.importorskip('onnx')
+        pytest.importorskip('onnxruntime')
+    model_class, embeddings_dim, model_parameters = MODELS[model_type]
+    data_set = make_dataset([3, 40, 12, 25, 1, 60], embeddings_dim=embeddings_dim)
+    torch.manual_seed(0)
+    model = model_class(embeddings_dim=embeddings_dim, output_dim=1, **model_parameters).eval()
+    path = str(tmp_path / 'model.{}'.format(export_format))
+    export_model(model, path, export_format, embeddings_dim=embeddings_dim)
+
+    predictions = []
+    for predict_model in [model, load_runtime_model(runtime, path)]:
+        solver = Solver(predict_model, solver_args(batch_size=4, length_bucketing=True), eval=True, device='cpu')
+        predictions.append(solver.predict(data_set)['predict_result'].to_numpy(dtype=np.float32))
+    np.testing.assert_allclose(predictions[0], predictions[1], rtol=1e-4, atol=1e-5)
+
+
+def test_inference_imports_no_model_code():
+    # the runtimes of exported models only need utils/export.py, the model classes are imported for the eager model
+    code = 'import sys, inference; print(any(name.split(".")[0] == "models" for name in sys.modules))'
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert output.stdout.strip() == 'False'
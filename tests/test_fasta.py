@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from Bio import SeqIO
+
+from utils.fasta import amino_acid_composition, encode_sequences, fasta_key, read_fasta
+from utils.general import AMINO_ACIDS
+
+# wrapped lines, windows line endings, lower case and unknown letters, an empty record and text before the first one
+FASTA = (b'comment line\n'
+         b'>sp|P1.2 first protein A-1\nMKVLAAGG\nHHKLXW\n'
+         b'>second/2 B-0\r\nmkvl\r\nAAZ\r\n'
+         b'>empty U\n'
+         b'>last C-U\nACDEFGHIKLMNPQRSTVWY' + b'A' * 130 + b'\n')
+
+
+@pytest.fixture
+def fasta_path(tmp_path):
+    path = str(tmp_path / 'sequences.fasta')
+    with open(path, 'wb') as f:
+        f.write(FASTA)
+    return path
+
+
+def test_records_match_biopython(fasta_path, tmp_path):
+    descriptions, residues, offsets = read_fasta(fasta_path)
+    # biopython does not accept the text before the first record, which read_fasta skips
+    records_path = str(tmp_path / 'records.fasta')
+    with open(records_path, 'wb') as f:
+        f.write(FASTA[FASTA.index(b'>'):])
+    records = list(SeqIO.parse(records_path, 'fasta'))
+    assert descriptions == [record.description for record in records]
+    sequences = [residues[start:end].tobytes().decode() for start, end in zip(offsets[:-1], offsets[1:])]
+    assert sequences == [str(record.seq) for record in records]
+    assert sequences[2] == ''
+
+
+def test_composition_matches_counting_letters(fasta_path):
+    _, residues, offsets = read_fasta(fasta_path)
+    sequences = [residues[start:end].tobytes().decode() for start, end in zip(offsets[:-1], offsets[1:])]
+    for chunk_residues in [1, 10, 1 << 24]:  # chunks of single sequences, of a few sequences and of all of them
+        frequencies = amino_acid_composition(encode_sequences(residues), offsets, chunk_residues)
+        assert frequencies.shape == (len(sequences), len(AMINO_ACIDS)) and frequencies.dtype == np.float32
+        for sequence, sequence_frequencies in zip(sequences, frequencies):
+            if not sequence:
+                assert np.isnan(sequence_frequencies).all()
+                continue
+            expected = [sequence.count(amino_acid) / len(sequence) for amino_acid in AMINO_ACIDS]
+            np.testing.assert_allclose(sequence_frequencies, expected, rtol=1e-6)
+
+
+def test_fasta_keys():
+    description = 'sp|P1.2/3 first protein A-1'
+    assert fasta_key(description, 'hash') == 'sp|P1.2/3'
+    assert fasta_key(description, 'fasta_descriptor') == 'sp|P1_2_3'
+    assert fasta_key(description, 'fasta_descriptor_old') == description
+    with pytest.raises(Exception):
+        fasta_key(description, 'unknown')
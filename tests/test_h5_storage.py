@@ -0,0 +1,61 @@
+import h5py
+import numpy as np
+import torch
+from torchvision.transforms import transforms
+
+from datasets.embeddings_dataset import EmbeddingsDataset, Embeddings_predict_Dataset
+from datasets.transforms import SolubilityToInt, ToTensor
+from models import LightAttention
+from solver import Solver
+from utils.h5_storage import STORAGE_DTYPE_ATTRIBUTE, decode_bfloat16, encode_embedding
+
+
+def write_bfloat16_copy(embeddings_path: str, path: str):
+    """copy of an h5 file with its embeddings stored as bfloat16 in uint16 datasets"""
+    with h5py.File(embeddings_path, 'r') as source, h5py.File(path, 'w') as f:
+        f.attrs[STORAGE_DTYPE_ATTRIBUTE] = 'bfloat16'
+        for key in source:
+            f.create_dataset(key, data=encode_embedding(source[key][:], 'bfloat16'))
+
+
+def test_bfloat16_embeddings_stay_two_bytes_until_the_device(make_dataset, solver_args, tmp_path):
+    data_set = make_dataset([12, 30, 7, 19, 25], embeddings_dim=16)
+    bfloat16_path = str(tmp_path / 'bfloat16_embeddings.h5')
+    write_bfloat16_copy(data_set.embeddings_path, bfloat16_path)
+    bfloat16_set = Embeddings_predict_Dataset(bfloat16_path, str(tmp_path / 'remapped_sequences_file.fasta'),
+                                              key_format='hash', transform=data_set.transform)
+    # the float32 embeddings that the bfloat16 file decodes to
+    with h5py.File(data_set.embeddings_path, 'r+') as f:
+        for key in list(f):
+            decoded = decode_bfloat16(encode_embedding(f[key][:], 'bfloat16'))
+            del f[key]
+            f.create_dataset(key, data=decoded)
+
+    embedding = bfloat16_set[1][0]
+    assert embedding.dtype == torch.bfloat16 and embedding.shape == (30, 16)
+    torch.manual_seed(0)
+    model = LightAttention(embeddings_dim=16, output_dim=1, kernel_size=9).eval()
+    solver = Solver(model, solver_args(batch_size=2), eval=True, device='cpu')
+    padded, _ = solver.collate_function(labelled=False)([bfloat16_set[i] for i in range(2)])
+    assert padded.dtype == torch.bfloat16
+
+    predictions = [solver.predict(embeddings)['predict_result'].to_numpy(dtype=np.float32)
+                   for embeddings in [data_set, bfloat16_set]]
+    np.testing.assert_array_equal(predictions[0], predictions[1])
+
+
+def test_bfloat16_embeddings_are_cached_in_their_stored_dtype(make_dataset, tmp_path):
+    lengths = [12, 30, 7]
+    predict_set = make_dataset(lengths, embeddings_dim=16)
+    bfloat16_path = str(tmp_path / 'bfloat16_embeddings.h5')
+    write_bfloat16_copy(predict_set.embeddings_path, bfloat16_path)
+    remapping = str(tmp_path / 'labelled_sequences_file.fasta')
+    with open(remapping, 'w') as fasta:
+        for i in range(len(lengths)):
+            fasta.write('>id{:05d} protein_{} A-1\n{}\n'.format(i, i, predict_set.metadata.sequence(i)))
+    train_set = EmbeddingsDataset(bfloat16_path, remapping, key_format='hash',
+                                  transform=transforms.Compose([SolubilityToInt(), ToTensor(dtype=None)]),
+                                  cache_bytes=2 ** 20)
+    train_set.fill_cache()
+    assert train_set.cache.nbytes == sum(lengths) * 16 * 2
+    assert train_set[0][0].dtype == torch.bfloat16
@@ -0,0 +1,50 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+from torchvision.transforms import transforms
+
+from datasets.embeddings_dataset import Embeddings_predict_Dataset
+from datasets.transforms import Solubility_predict_ToInt, predict_ToTensor
+from models import biLSTM_TextCNN
+from solver import Solver
+
+TEST_DATASET = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'plmsol_test',
+                            'test_dataset_emb')
+
+
+@pytest.fixture(scope='module')
+def test_dataset():
+    """the bundled test embeddings, which are stored in half precision"""
+    transform = transforms.Compose([Solubility_predict_ToInt(), predict_ToTensor(dtype=None)])
+    return Embeddings_predict_Dataset(os.path.join(TEST_DATASET, 't5_embeddings', 'embeddings_file.h5'),
+                                      os.path.join(TEST_DATASET, 'remapped_sequences_file.fasta'), key_format='hash',
+                                      transform=transform)
+
+
+@pytest.fixture(scope='module')
+def model():
+    torch.manual_seed(123)
+    return biLSTM_TextCNN(embeddings_dim=1024, output_dim=1, kernel_size=9, dropout=0.25).eval()
+
+
+def test_half_precision_batches_stay_half_on_the_host(test_dataset, model, solver_args):
+    assert test_dataset[0][0].dtype == torch.float16
+    for input_dtype, expected in [('stored', torch.float16), ('float16', torch.float16),
+                                  ('bfloat16', torch.bfloat16), ('float32', torch.float32)]:
+        solver = Solver(model, solver_args(input_dtype=input_dtype), eval=True, device='cpu')
+        padded, _ = solver.collate_function(labelled=False)([test_dataset[i] for i in range(len(test_dataset))])
+        assert padded.dtype == expected
+
+
+@pytest.mark.parametrize('input_dtype, autocast, tolerance', [('stored', False, 0), ('float16', False, 0),
+                                                              ('bfloat16', False, 1e-2), ('float16', True, 1e-2)])
+def test_half_precision_predictions_match_float32(test_dataset, model, solver_args, input_dtype, autocast, tolerance):
+    predictions = []
+    for args in [solver_args(input_dtype='float32'), solver_args(input_dtype=input_dtype, autocast=autocast)]:
+        solver = Solver(model, args, eval=True, device='cpu')
+        predictions.append(solver.predict(test_dataset)['predict_result'].to_numpy(dtype=np.float32))
+    # fp16 embeddings are cast to float32 on the device, exactly like the float32 path casts them on the host
+    np.testing.assert_allclose(predictions[1], predictions[0], rtol=0, atol=tolerance)
+    assert ((predictions[1] >= 0.5) == (predictions[0] >= 0.5)).all()
@@ -0,0 +1,59 @@
+import numpy as np
+import torch
+
+from datasets.embeddings_dataset import read_sequence_metadata
+from utils.metadata import MetadataRow, SequenceMetadata, collate_metadata
+
+SEQUENCES = ['MKV', 'ACDEFG', 'WY', 'LLLLK']
+
+
+def metadata(solubility=None) -> SequenceMetadata:
+    residues = np.frombuffer(''.join(SEQUENCES).encode(), dtype=np.uint8)
+    lengths = np.array([len(sequence) for sequence in SEQUENCES])
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    frequencies = np.arange(len(SEQUENCES) * 25, dtype=np.float32).reshape(len(SEQUENCES), 25)
+    return SequenceMetadata(['p{}'.format(i) for i in range(len(SEQUENCES))], residues, starts, lengths, frequencies,
+                            solubility)
+
+
+def test_rows_behave_like_the_old_dicts():
+    table = metadata(solubility=['1', 'U', '0', '1'])
+    row = table[1]
+    assert isinstance(row, MetadataRow) and len(table) == 4
+    assert dict(row).keys() == {'id', 'sequence', 'length', 'frequencies', 'solubility_known'}
+    assert (row['id'], row['sequence'], row['length'], row['solubility_known']) == ('p1', 'ACDEFG', 6, False)
+    assert torch.equal(row['frequencies'], torch.arange(25, 50, dtype=torch.float32))
+    assert 'solubility_known' not in metadata()[1]
+
+
+def test_batches_are_gathered_by_fancy_indexing():
+    table = metadata(solubility=['1', 'U', '0', '1'])
+    batch = collate_metadata([table[3], table[0], table[1]])
+    assert batch['id'] == ['p3', 'p0', 'p1']
+    assert batch['sequence'] == ['LLLLK', 'MKV', 'ACDEFG']
+    assert batch['length'].tolist() == [5, 3, 6]
+    assert batch['solubility_known'].tolist() == [True, True, False]
+    assert torch.equal(batch['frequencies'], torch.from_numpy(table.frequencies[[3, 0, 1]]))
+    # the gathered batch has the keys, dtypes and shapes of default_collate on plain dicts
+    expected = torch.utils.data.dataloader.default_collate([dict(table[i]) for i in [3, 0, 1]])
+    assert batch.keys() == expected.keys()
+    for key in ['length', 'frequencies', 'solubility_known']:
+        assert batch[key].shape == expected[key].shape and torch.equal(batch[key], expected[key].to(batch[key].dtype))
+
+
+def test_mixed_metadata_falls_back_to_default_collate():
+    batch = collate_metadata([metadata()[0], metadata()[2]])
+    assert batch['id'] == ['p0', 'p2'] and batch['length'].tolist() == [3, 2]
+
+
+def test_fasta_is_read_into_columns(tmp_path):
+    path = str(tmp_path / 'labelled_sequences_file.fasta')
+    with open(path, 'w') as fasta:
+        for i, (sequence, label) in enumerate(zip(SEQUENCES, ['1', 'U', '0', '1'])):
+            fasta.write('>id{:05d} protein_{} A-{}\n{}\n'.format(i, i, label, sequence))
+    table = read_sequence_metadata(path, labelled=True, unknown_solubility=False, max_length=5)
+    # the unknown and the too long protein are left out, the buffer still holds every residue
+    assert [table.id(i) for i in range(len(table))] == ['id00000', 'id00002', 'id00003']
+    assert [table.sequence(i) for i in range(len(table))] == ['MKV', 'WY', 'LLLLK']
+    assert table.frequencies.shape == (3, 25) and table.frequencies.dtype == np.float32
+    np.testing.assert_allclose(table.frequencies.sum(axis=1), 1, rtol=1e-6)
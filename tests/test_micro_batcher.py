@@ -0,0 +1,51 @@
+import threading
+
+import numpy as np
+import pytest
+
+from utils.micro_batcher import MicroBatcher
+
+
+def test_concurrent_requests_are_batched_by_length():
+    batches = []
+
+    def predict(samples):
+        batches.append(list(samples))
+        return np.array(samples, dtype=np.float32)[:, None] * 10
+
+    # the window only closes early, once the samples of two full batches are waiting
+    batcher = MicroBatcher(predict, length=lambda sample: sample, batch_window=30, max_batch_size=3, bucket_batches=2)
+    requests = [[50, 10], [30, 60], [20, 40]]
+    results = [None] * len(requests)
+    barrier = threading.Barrier(len(requests))
+
+    def submit(i):
+        barrier.wait()
+        results[i] = batcher.submit(requests[i])
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert batches == [[10, 20, 30], [40, 50, 60]]
+    # every request gets the predictions of its samples in the order it sent them
+    for samples, result in zip(requests, results):
+        np.testing.assert_array_equal(result, np.array(samples)[:, None] * 10)
+    stats = batcher.stats()
+    assert (stats['requests'], stats['samples'], stats['batches'], stats['mean_batch_size']) == (3, 6, 2, 3)
+    assert stats['queue_depth'] == 0 and stats['latency_p50_ms'] is not None
+
+
+def test_failed_batches_fail_their_requests_only():
+    def predict(samples):
+        if 0 in samples:
+            raise ValueError('empty sequence')
+        return np.ones((len(samples), 1), dtype=np.float32)
+
+    batcher = MicroBatcher(predict, length=lambda sample: sample, batch_window=0)
+    with pytest.raises(ValueError, match='empty sequence'):
+        batcher.submit([0])
+    # the prediction thread keeps serving later requests
+    np.testing.assert_array_equal(batcher.submit([3, 5]), np.ones((2, 1)))
+    assert batcher.submit([]).shape == (0, 1)
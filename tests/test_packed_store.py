@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+
+import h5py
+import numpy as np
+import pytest
+
+from conftest import MaskedMeanModel
+from datasets.embeddings_dataset import Embeddings_predict_Dataset
+from datasets.packed_store import PackedEmbeddings, is_packed_embeddings, pack_embeddings
+from solver import Solver
+
+LENGTHS = [12, 30, 7, 19, 25]
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float16'])
+def test_packed_embeddings_match_the_h5_file(make_dataset, tmp_path, dtype):
+    data_set = make_dataset(LENGTHS)
+    output_path = str(tmp_path / 'embeddings_packed')
+    remapping = str(tmp_path / 'remapped_sequences_file.fasta')
+    assert pack_embeddings(data_set.embeddings_path, remapping, output_path, dtype=dtype) == len(LENGTHS)
+    assert is_packed_embeddings(output_path) and not is_packed_embeddings(str(tmp_path))
+
+    store = PackedEmbeddings(output_path)
+    assert store.embeddings.dtype == np.dtype(dtype) and isinstance(store.embeddings, np.memmap)
+    assert store.embeddings.shape == (sum(LENGTHS), 8)
+    with h5py.File(data_set.embeddings_path, 'r') as f:
+        for key in f:
+            np.testing.assert_array_equal(store[key], f[key][:].astype(dtype))
+    # a sample is a slice of the memory mapped matrix
+    assert np.shares_memory(store['id00001'], store.embeddings)
+
+
+def test_packed_store_replaces_the_h5_file(make_dataset, solver_args, tmp_path):
+    data_set = make_dataset(LENGTHS)
+    output_path = str(tmp_path / 'embeddings_packed')
+    remapping = str(tmp_path / 'remapped_sequences_file.fasta')
+    subprocess.run([sys.executable, 'pack_embeddings.py', '--embeddings', data_set.embeddings_path, '--remapping',
+                    remapping, '--output', output_path, '--dtype', 'float32'], check=True, capture_output=True,
+                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    packed_set = Embeddings_predict_Dataset(output_path, remapping, key_format='hash', transform=data_set.transform)
+    assert packed_set.embeddings_dim == 8
+    solver = Solver(MaskedMeanModel().eval(), solver_args(), eval=True, device='cpu')
+    np.testing.assert_array_equal(solver.predict(packed_set)['predict_result'].to_numpy(),
+                                  solver.predict(data_set)['predict_result'].to_numpy())
@@ -0,0 +1,101 @@
+import numpy as np
+import torch
+
+from conftest import MaskedMeanModel
+from datasets.transforms import predict_ToTensor
+from models import FFN, LightAttention, biLSTM_TextCNN
+from solver import Solver
+from utils.general import PaddedCollate, min_input_length, padding_mask, predict_padded_permuted_collate
+
+
+def samples(lengths, embeddings_dim=4):
+    return [(np.ones((length, embeddings_dim), dtype=np.float32), {'id': str(i), 'sequence': 'A' * length,
+                                                                   'length': length,
+                                                                   'frequencies': torch.zeros(20)})
+            for i, length in enumerate(lengths)]
+
+
+def test_min_input_length_of_the_models():
+    assert min_input_length(biLSTM_TextCNN(embeddings_dim=1024, output_dim=1, kernel_size=9)) == 9
+    # the convolutions of light attention are padded to keep the length
+    assert min_input_length(LightAttention(embeddings_dim=16, output_dim=1, kernel_size=9)) == 1
+    assert min_input_length(FFN(embeddings_dim=16, output_dim=1)) == 1
+
+
+def test_short_batches_are_padded_to_min_length():
+    for layout, length_axis in [('BLD', 1), ('BDL', 2)]:
+        collate = PaddedCollate(layout=layout, labelled=False, min_length=9)
+        padded, metadata = collate(samples([3, 5]))
+        assert padded.shape[length_axis] == 9
+        assert metadata['length'].tolist() == [3, 5]
+        assert padded.sum().item() == (3 + 5) * 4
+        # batches that are longer than min_length keep their length
+        padded, _ = collate(samples([12, 5]))
+        assert padded.shape[length_axis] == 12
+
+
+def test_bucketed_batches_of_short_proteins_are_predicted(make_dataset, solver_args):
+    # length bucketing puts the proteins that are shorter than the kernel of biLSTM_TextCNN into the same batches
+    data_set = make_dataset([2, 40, 5, 3, 60, 8, 1, 50], embeddings_dim=1024)
+    model = biLSTM_TextCNN(embeddings_dim=1024, output_dim=1, kernel_size=9)
+    solver = Solver(model, solver_args(batch_size=2, length_bucketing=True), eval=True, device='cpu')
+    predictions = solver.predict(data_set)
+    assert predictions['protein_ID'].tolist() == ['id{:05d}'.format(i) for i in range(8)]
+    assert np.isfinite(predictions['predict_result'].to_numpy(dtype=np.float32)).all()
+
+
+def test_mask_is_as_wide_as_the_padded_batch():
+    for layout in ['BLD', 'BDL']:
+        padded, metadata = PaddedCollate(layout=layout, labelled=False, min_length=9)(samples([3, 5]))
+        mask = padding_mask(padded, metadata['length'], layout)
+        assert mask.shape == (2, 9)
+        assert mask.sum(dim=1).tolist() == [3, 5]
+
+
+def test_masked_models_predict_short_batches(make_dataset, solver_args):
+    data_set = make_dataset([2, 5, 3, 7, 1, 4], embeddings_dim=16)
+    torch.manual_seed(0)
+    light_attention = LightAttention(embeddings_dim=16, output_dim=1, kernel_size=9).eval()
+    light_attention.min_input_length = 9  # pads every batch of these proteins beyond the longest one
+    predictions = Solver(light_attention, solver_args(batch_size=2), eval=True, device='cpu').predict(data_set)
+    assert np.isfinite(predictions['predict_result'].to_numpy(dtype=np.float32)).all()
+
+    # the padding beyond the longest protein is masked, so a padded batch predicts like one protein at a time
+    masked_mean = MaskedMeanModel(embeddings_dim=16).eval()
+    masked_mean.min_input_length = 9
+    predictions = Solver(masked_mean, solver_args(batch_size=3), eval=True, device='cpu').predict(data_set)
+    with torch.no_grad():
+        expected = [masked_mean(data_set[i][0][None].float(), torch.ones(1, len(data_set[i][0]), dtype=torch.bool))
+                    for i in range(len(data_set))]
+    np.testing.assert_allclose(predictions['predict_result'].to_numpy(dtype=np.float32),
+                               torch.cat(expected).reshape(-1).numpy(), rtol=1e-5, atol=1e-6)
+
+
+def test_collate_matches_the_permuted_pad_sequence_batch():
+    rng = np.random.default_rng(0)
+    items = [(rng.standard_normal((length, 4)).astype(np.float16), metadata)
+             for length, (_, metadata) in zip([7, 3, 5], samples([7, 3, 5]))]
+    expected, _ = predict_padded_permuted_collate([(predict_ToTensor()(embedding), metadata)
+                                                   for embedding, metadata in items])
+    for layout in ['BDL', 'BLD']:
+        padded, metadata = PaddedCollate(layout=layout, labelled=False)(items)
+        # fp16 embeddings are converted to float32 during the one copy into the contiguous batch
+        assert padded.dtype == torch.float32 and padded.is_contiguous()
+        assert torch.equal(padded, expected if layout == 'BDL' else expected.permute(0, 2, 1))
+        assert metadata['length'].tolist() == [7, 3, 5]
+
+
+def test_buffers_are_reused_across_batches():
+    collate = PaddedCollate(layout='BLD', labelled=False, num_buffers=2)
+    first, _ = collate(samples([6, 4]))
+    second, _ = collate(samples([6, 6]))
+    third, _ = collate(samples([2, 5]))
+    # every num_buffers batches write into the same memory, smaller batches are views of the buffer
+    assert third.data_ptr() == first.data_ptr() and second.data_ptr() != first.data_ptr()
+    assert third.sum().item() == (2 + 5) * 4
+    # bytes copied count each padded batch once, in the dtype of the batch
+    assert collate.bytes_copied == (2 * 6 + 2 * 6 + 2 * 5) * 4 * 4 and collate.batches == 3
+    # without a dtype the batch keeps the dtype of the embeddings
+    fourth, _ = PaddedCollate(layout='BLD', labelled=False, dtype=None)(
+        [(embedding.astype(np.float16), metadata) for embedding, metadata in samples([3])])
+    assert fourth.dtype == torch.float16
@@ -0,0 +1,49 @@
+import numpy as np
+import torch
+from torchvision.transforms import transforms
+
+from datasets.embeddings_dataset import Embeddings_predict_Dataset
+from datasets.pooled_embeddings import pool_h5_file
+from datasets.transforms import Solubility_predict_ToInt, predict_ToTensor
+from models import FFN
+from solver import Solver
+
+
+def test_ffn_checkpoint_predicts_on_pooled_embeddings(make_dataset, solver_args, tmp_path):
+    data_set = make_dataset([7, 30, 12, 1, 25], embeddings_dim=16)
+    pooled_path = str(tmp_path / 'pooled_embeddings.h5')
+    assert pool_h5_file(data_set.embeddings_path, pooled_path) == 5
+    transform = transforms.Compose([Solubility_predict_ToInt(), predict_ToTensor(dtype=None)])
+    pooled_set = Embeddings_predict_Dataset(pooled_path, str(tmp_path / 'remapped_sequences_file.fasta'),
+                                            key_format='hash', transform=transform)
+    assert pooled_set[0][0].shape[-1] == 32
+    # the model is built for the per residue embeddings, so the same checkpoint loads for both files
+    assert data_set.embeddings_dim == pooled_set.embeddings_dim == 16
+
+    torch.manual_seed(0)
+    checkpoint = FFN(embeddings_dim=16, output_dim=1).state_dict()
+    predictions = []
+    for embeddings in [data_set, pooled_set]:
+        model = FFN(embeddings_dim=embeddings.embeddings_dim, output_dim=1)
+        model.load_state_dict(checkpoint)
+        # one protein per batch, so the mean over the per residue embeddings includes no padding
+        solver = Solver(model, solver_args(batch_size=1), eval=True, device='cpu')
+        predictions.append(solver.predict(embeddings)['predict_result'].to_numpy(dtype=np.float32))
+    np.testing.assert_allclose(predictions[0], predictions[1], rtol=1e-5, atol=1e-6)
+
+
+def test_pooled_means_differ_from_padded_batches(make_dataset, solver_args, tmp_path):
+    data_set = make_dataset([7, 30, 12, 1, 25], embeddings_dim=16)
+    pooled_path = str(tmp_path / 'pooled_embeddings.h5')
+    pool_h5_file(data_set.embeddings_path, pooled_path)
+    pooled_set = Embeddings_predict_Dataset(pooled_path, str(tmp_path / 'remapped_sequences_file.fasta'),
+                                            key_format='hash', transform=data_set.transform)
+    torch.manual_seed(0)
+    model = FFN(embeddings_dim=16, output_dim=1).eval()
+    solver = Solver(model, solver_args(batch_size=5), eval=True, device='cpu')
+    padded, pooled = (solver.predict(embeddings)['predict_result'].to_numpy(dtype=np.float32)
+                      for embeddings in [data_set, pooled_set])
+    # only the longest protein of the batch has no padding in its mean, the documented limit of pooled inputs
+    lengths = data_set.lengths
+    same = np.isclose(padded, pooled, rtol=1e-5, atol=1e-6)
+    assert same.tolist() == (lengths == lengths.max()).tolist()
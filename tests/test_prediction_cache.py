@@ -0,0 +1,85 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+from conftest import MaskedMeanModel
+from plmsol_predict_wrapper import read_prediction_scores
+from solver import Solver
+from utils.export import export_model, load_runtime_model
+from utils.prediction_cache import PredictionCache, cached_checkpoints, prediction_fingerprint, sequence_hash
+
+SEQUENCES = ['MKVL', 'MKVLA', 'GGSGG', 'MKVL' * 5]
+
+
+def write_checkpoint(path, seed: int) -> str:
+    torch.manual_seed(seed)
+    torch.save(MaskedMeanModel().state_dict(), str(path))
+    return str(path)
+
+
+def test_changed_checkpoint_invalidates_its_predictions(tmp_path):
+    cache_path = str(tmp_path / 'predictions.sqlite')
+    checkpoint = write_checkpoint(tmp_path / 'model.pt', seed=0)
+    args = argparse.Namespace(model_type='MaskedMeanModel', window_size=0)
+    hashes = [sequence_hash(sequence) for sequence in SEQUENCES]
+
+    cache = PredictionCache(cache_path, [checkpoint], prediction_fingerprint(args, [checkpoint]))
+    cache.put_many(hashes, np.arange(len(hashes), dtype=np.float32))
+    cache.close()
+    cache = PredictionCache(cache_path, [checkpoint], prediction_fingerprint(args, [checkpoint]))
+    assert sorted(float(prediction[0]) for prediction in cache.get_many(hashes).values()) == [0, 1, 2, 3]
+    cache.close()
+
+    # other settings of the same checkpoint get another fingerprint
+    assert prediction_fingerprint(argparse.Namespace(model_type='MaskedMeanModel', window_size=500),
+                                  [checkpoint]) != prediction_fingerprint(args, [checkpoint])
+    # new weights in the same file delete the predictions of the old weights
+    write_checkpoint(checkpoint, seed=1)
+    cache = PredictionCache(cache_path, [checkpoint], prediction_fingerprint(args, [checkpoint]))
+    assert cache.get_many(hashes) == {}
+    assert cache.connection.execute('SELECT COUNT(*) FROM predictions').fetchone()[0] == 0
+    cache.close()
+
+
+def test_cached_checkpoints_need_the_weights(tmp_path):
+    assert cached_checkpoints(argparse.Namespace(checkpoint='model.pt')) == ['model.pt']
+    assert cached_checkpoints(argparse.Namespace(checkpoint=None, runtime='onnxruntime',
+                                                 exported_model='model.onnx')) == ['model.onnx']
+    assert cached_checkpoints(argparse.Namespace(checkpoint=None, checkpoints_list=['a.pt', 'b.pt']),
+                              ensemble=True) == ['a.pt', 'b.pt']
+    with pytest.raises(ValueError, match='prediction cache'):
+        cached_checkpoints(argparse.Namespace(checkpoint=None))
+    with pytest.raises(ValueError, match='prediction cache'):
+        cached_checkpoints(argparse.Namespace(checkpoint='model.pt', runtime='torchscript', exported_model=None))
+
+
+def test_exported_runtime_predictions_are_cached(make_dataset, solver_args, tmp_path):
+    data_set = make_dataset([12, 30, 7, 19, 25])
+    torch.manual_seed(0)
+    exported_model = str(tmp_path / 'model.torchscript.pt')
+    export_model(MaskedMeanModel().eval(), exported_model, 'torchscript', embeddings_dim=8)
+    paths = []
+    for run in range(2):
+        args = solver_args(runtime='torchscript', exported_model=exported_model, input_dtype='float32',
+                           prediction_cache=str(tmp_path / 'predictions.sqlite'),
+                           output_files_name=str(tmp_path / 'run{}'.format(run)))
+        solver = Solver(load_runtime_model('torchscript', exported_model), args, eval=True, device='cpu')
+        paths.append(solver.predict_evaluation(data_set))
+    first, second = (pd.read_csv(path) for path in paths)
+    pd.testing.assert_frame_equal(first, second)
+    cache = PredictionCache(str(tmp_path / 'predictions.sqlite'), [exported_model],
+                            prediction_fingerprint(args, [exported_model]))
+    assert len(cache.get_many([sequence_hash(sequence) for sequence in first['sequence']])) == len(data_set)
+    cache.close()
+
+
+def test_wrapper_matches_predictions_by_sequence(tmp_path):
+    path = str(tmp_path / 'plmsol_prediction_result.csv')
+    # rows in another order than the records and without the duplicate of the first sequence
+    pd.DataFrame({'protein_ID': ['c', 'a', 'd', 'b'], 'sequence': [SEQUENCES[i] for i in [2, 0, 3, 1]],
+                  'predict_result': [0.3, 0.1, 0.4, 0.2]}).to_csv(path)
+    scores = read_prediction_scores(path)
+    assert [scores[sequence_hash(sequence)] for sequence in SEQUENCES + ['MKVL']] == [0.1, 0.2, 0.3, 0.4, 0.1]
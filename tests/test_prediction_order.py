@@ -0,0 +1,183 @@
+import json
+
+import numpy as np
+import pytest
+import torch
+
+import solver as solver_module
+from conftest import MaskedMeanModel
+from solver import Solver
+from utils.prediction_cache import PredictionCache, sequence_hash
+from utils.prediction_writer import prediction_path
+
+LENGTHS = [31, 4, 17, 58, 9, 23, 2, 41, 12, 7, 36, 19, 5, 27, 14, 63, 8, 22, 3, 45, 11, 16, 29]
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return MaskedMeanModel(embeddings_dim=8).eval()
+
+
+def reference_predictions(model, data_set, window_size: int = 0, window_overlap: int = 0,
+                          aggregation: str = 'mean') -> np.ndarray:
+    """predictions of one protein, or one window of a protein, at a time without any padding"""
+    predictions = []
+    with torch.no_grad():
+        for i in range(len(data_set)):
+            embedding = data_set[i][0].float()
+            length = len(embedding)
+            if window_size == 0 or length <= window_size:
+                windows = [(0, length)]
+            else:
+                starts = list(range(0, length - window_size, window_size - window_overlap)) + [length - window_size]
+                windows = [(start, start + window_size) for start in starts]
+            outputs = np.concatenate([model(embedding[None, start:end], mask=torch.ones(1, end - start,
+                                                                                          dtype=torch.bool)).numpy()
+                                      for start, end in windows])
+            predictions.append(outputs.mean(axis=0) if aggregation == 'mean' else outputs.max(axis=0))
+    return np.stack(predictions)
+
+
+def collect(predictions_iterator):
+    """indices and predictions of all batches of an iterator of Solver.iter_predictions"""
+    indices, predictions = zip(*predictions_iterator)
+    return np.concatenate(indices), np.concatenate(predictions)
+
+
+@pytest.mark.parametrize('start', [0, 7])
+def test_bucketed_predictions_are_in_fasta_order(make_dataset, solver_args, model, start):
+    data_set = make_dataset(LENGTHS)
+    expected = reference_predictions(model, data_set)
+    for length_bucketing in [False, True]:
+        solver = Solver(model, solver_args(batch_size=4, length_bucketing=length_bucketing), eval=True, device='cpu')
+        indices, predictions = collect(solver.iter_predictions(data_set, start=start))
+        assert indices.tolist() == list(range(start, len(LENGTHS)))
+        np.testing.assert_allclose(predictions, expected[start:], rtol=1e-5, atol=1e-6)
+    predictions = solver.predict(data_set)
+    assert predictions['protein_ID'].tolist() == ['id{:05d}'.format(i) for i in range(len(LENGTHS))]
+    np.testing.assert_allclose(predictions['predict_result'].to_numpy(dtype=np.float32), expected.reshape(-1),
+                               rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('start', [0, 6])
+def test_deduplicated_predictions_fan_out_to_every_id(make_dataset, solver_args, model, start):
+    repeats = [(5, 1), (9, 1), (12, 3), (20, 0), (22, 18)]
+    data_set = make_dataset(LENGTHS, repeats=repeats)
+    expected = reference_predictions(model, data_set)
+    predicted = []
+    forward = model.forward
+
+    def counting_forward(x, mask, **kwargs):
+        predicted.append(len(x))
+        return forward(x, mask, **kwargs)
+
+    model.forward = counting_forward
+    solver = Solver(model, solver_args(batch_size=4, length_bucketing=True), eval=True, device='cpu')
+    indices, predictions = collect(solver.iter_deduplicated_predictions(data_set, start=start))
+    assert indices.tolist() == list(range(start, len(LENGTHS)))
+    np.testing.assert_allclose(predictions, expected[start:], rtol=1e-5, atol=1e-6)
+    # only the first protein of every sequence from start on is predicted
+    sequences = {data_set.metadata.sequence(i) for i in range(start, len(LENGTHS))}
+    assert sum(predicted) == len(sequences) < len(LENGTHS) - start
+
+
+def test_predictions_are_not_deduplicated_by_default(make_dataset, solver_args, model, tmp_path):
+    data_set = make_dataset(LENGTHS, repeats=[(5, 1), (9, 1)])
+    predicted = []
+    forward = model.forward
+
+    def counting_forward(x, mask, **kwargs):
+        predicted.append(len(x))
+        return forward(x, mask, **kwargs)
+
+    model.forward = counting_forward
+    args = solver_args(output_files_name=str(tmp_path / 'predictions'))
+    del args.deduplicate
+    Solver(model, args, eval=True, device='cpu').predict_evaluation(data_set)
+    # deduplication keeps every sequence hash in memory, so it is only used when it is asked for
+    assert sum(predicted) == len(LENGTHS)
+
+
+@pytest.mark.parametrize('aggregation', ['mean', 'max'])
+def test_windows_are_aggregated_per_protein(make_dataset, solver_args, model, aggregation):
+    data_set = make_dataset(LENGTHS)
+    expected = reference_predictions(model, data_set, window_size=10, window_overlap=3, aggregation=aggregation)
+    for length_bucketing, start in [(False, 0), (True, 0), (True, 3)]:
+        solver = Solver(model, solver_args(batch_size=3, length_bucketing=length_bucketing, window_size=10,
+                                           window_overlap=3, window_aggregation=aggregation), eval=True, device='cpu')
+        indices, predictions = collect(solver.iter_predictions(data_set, start=start))
+        assert indices.tolist() == list(range(start, len(LENGTHS)))
+        np.testing.assert_allclose(predictions, expected[start:], rtol=1e-5, atol=1e-6)
+
+
+def test_sharded_predictions_are_in_fasta_order(make_dataset, solver_args, model):
+    data_set = make_dataset(LENGTHS)
+    expected = reference_predictions(model, data_set)
+    solver = Solver(model, solver_args(batch_size=4, length_bucketing=True, num_processes=2, threads_per_process=1,
+                                       pin_processes=False), eval=True, device='cpu')
+    for start in [0, 5]:
+        indices, predictions = collect(solver.iter_predictions(data_set, start=start))
+        assert indices.tolist() == list(range(start, len(LENGTHS)))
+        np.testing.assert_allclose(predictions, expected[start:], rtol=1e-5, atol=1e-6)
+
+
+def test_cached_sharded_predictions_start_the_workers_once(make_dataset, solver_args, model, tmp_path, monkeypatch):
+    data_set = make_dataset(LENGTHS)
+    expected = reference_predictions(model, data_set)
+    cache = PredictionCache(str(tmp_path / 'predictions.sqlite'), ['checkpoint'], 'fingerprint')
+    cached = [1, 2, 8, 9, 10, 15, 22]
+    cache.put_many([sequence_hash(data_set.metadata.sequence(i)) for i in cached], expected[cached])
+    pools = []
+
+    class CountedShardPool(solver_module.ShardPool):
+        def __init__(self, *args, **kwargs):
+            pools.append(self)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(solver_module, 'ShardPool', CountedShardPool)
+    solver = Solver(model, solver_args(batch_size=4, num_processes=2, threads_per_process=1, pin_processes=False),
+                    eval=True, device='cpu')
+    indices, predictions = collect(solver.iter_cached_predictions(data_set, cache, chunk_size=5))
+    assert indices.tolist() == list(range(len(LENGTHS)))
+    np.testing.assert_allclose(predictions, expected, rtol=1e-5, atol=1e-6)
+    # the misses of all five chunks are predicted by the same worker processes
+    assert len(pools) == 1
+    assert pools[0].proteins == len(LENGTHS) - len(cached)
+
+
+def test_resumed_run_writes_the_uninterrupted_file(make_dataset, solver_args, model, tmp_path):
+    data_set = make_dataset(LENGTHS)
+    options = dict(batch_size=2, length_bucketing=True, deduplicate=False, write_chunk_size=3)
+    solver = Solver(model, solver_args(output_files_name=str(tmp_path / 'uninterrupted'), **options), eval=True,
+                    device='cpu')
+    with open(solver.predict_evaluation(data_set), 'rb') as f:
+        uninterrupted = f.read()
+
+    output_files_name = str(tmp_path / 'interrupted')
+    path = prediction_path(output_files_name)
+    forward = model.forward
+    calls = []
+
+    def crashing_forward(x, mask, **kwargs):
+        calls.append(len(x))
+        if len(calls) == 6:
+            raise RuntimeError('simulated crash')
+        return forward(x, mask, **kwargs)
+
+    model.forward = crashing_forward
+    solver = Solver(model, solver_args(output_files_name=output_files_name, **options), eval=True, device='cpu')
+    with pytest.raises(RuntimeError, match='simulated crash'):
+        solver.predict_evaluation(data_set)
+    with open(path + '.progress') as f:
+        assert 0 < json.load(f)['rows'] < len(LENGTHS)
+    # a crash while a chunk is written leaves a torn line behind the recorded progress
+    with open(path, 'a') as f:
+        f.write('99,id00099,MKV')
+
+    model.forward = forward
+    solver = Solver(model, solver_args(output_files_name=output_files_name, resume=True, **options), eval=True,
+                    device='cpu')
+    assert solver.predict_evaluation(data_set) == path
+    with open(path, 'rb') as f:
+        assert f.read() == uninterrupted
@@ -0,0 +1,61 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.prediction_writer import PredictionWriter, verify_predictions
+
+IDS = ['id{:05d}'.format(i) for i in range(7)]
+
+
+def write(writer: PredictionWriter, rows: range):
+    writer.write([IDS[i] for i in rows], ['MKV'] * len(rows), np.array(rows, dtype=np.float32) / 10)
+
+
+def test_interrupted_file_is_truncated_to_the_last_chunk(tmp_path):
+    path = str(tmp_path / 'predictions.csv')
+    with pytest.raises(RuntimeError):
+        with PredictionWriter(path, chunk_size=2, run_info={'proteins': 7}) as writer:
+            write(writer, range(0, 3))
+            write(writer, range(3, 4))
+            raise RuntimeError('simulated crash')
+    with open(path + '.progress') as f:
+        progress = json.load(f)
+    # the rows buffered at the crash are flushed, the progress records every row that is on disk
+    assert progress['rows'] == 4 and not progress['complete']
+    with open(path, 'a') as f:
+        f.write('4,id00004,MK')
+
+    writer = PredictionWriter(path, chunk_size=2, resume=True, run_info={'proteins': 7})
+    assert writer.rows_written == 4
+    write(writer, range(4, 7))
+    writer.close()
+    predictions = pd.read_csv(path, index_col=0)
+    assert predictions.index.tolist() == list(range(7))
+    np.testing.assert_allclose(predictions['predict_result'], np.arange(7) / 10, rtol=1e-6)
+    assert verify_predictions(path, IDS) == 7
+
+
+def test_runs_are_only_resumed_for_the_same_inputs(tmp_path):
+    path = str(tmp_path / 'predictions.csv')
+    with PredictionWriter(path, chunk_size=2, run_info={'proteins': 7}) as writer:
+        write(writer, range(0, 2))
+    with pytest.raises(ValueError, match='other inputs'):
+        PredictionWriter(path, resume=True, run_info={'proteins': 8})
+    with pytest.raises(ValueError, match='other inputs'):
+        PredictionWriter(path, resume=True, prediction_columns=['a', 'b'], run_info={'proteins': 7})
+    with pytest.raises(ValueError, match='csv'):
+        PredictionWriter(str(tmp_path / 'predictions.parquet'), 'parquet', resume=True)
+    # without resume the file of the earlier run is replaced
+    assert PredictionWriter(path, run_info={'proteins': 8}).rows_written == 0
+    assert not (tmp_path / 'predictions.csv').exists()
+
+
+@pytest.mark.parametrize('rows, message', [([0, 1, 1], 'row 2'), ([0, 2], 'row 1'), ([0, 1], 'has 2 rows'),
+                                           ([0, 1, 2, 0], 'more rows')])
+def test_verification_finds_duplicated_missing_and_extra_rows(tmp_path, rows, message):
+    path = str(tmp_path / 'predictions.csv')
+    pd.DataFrame({'protein_ID': [IDS[i] for i in rows], 'predict_result': 0.5}).to_csv(path)
+    with pytest.raises(ValueError, match=message):
+        verify_predictions(path, IDS[:3])
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from models import FFN, LightAttention, biLSTM_TextCNN
+from solver import Solver
+from utils.quantization import QUANTIZATION_MODES, WeightOnlyInt8Conv1d, quantize_model
+
+# the convolutions of biLSTM_TextCNN take half of the embeddings_dim channels, which only fits 1024 dimensions
+MODELS = {'biLSTM_TextCNN': (biLSTM_TextCNN, 1024, {'kernel_size': 9}),
+          'LightAttention': (LightAttention, 16, {'kernel_size': 9}),
+          'FFN': (FFN, 16, {})}
+
+
+@pytest.mark.skipif('none' in torch.backends.quantized.supported_engines and
+                    len(torch.backends.quantized.supported_engines) == 1, reason='no quantized cpu engine')
+@pytest.mark.parametrize('model_type', sorted(MODELS))
+@pytest.mark.parametrize('mode', QUANTIZATION_MODES)
+def test_quantized_models_predict_like_the_float_model(make_dataset, solver_args, model_type, mode):
+    model_class, embeddings_dim, model_parameters = MODELS[model_type]
+    data_set = make_dataset([3, 40, 12, 25, 1, 60, 33, 18], embeddings_dim=embeddings_dim)
+    torch.manual_seed(0)
+    model = model_class(embeddings_dim=embeddings_dim, output_dim=1, **model_parameters).eval()
+    state = {name: value.clone() for name, value in model.state_dict().items()}
+
+    solver = Solver(model, solver_args(batch_size=4), eval=True, device='cpu')
+    expected = solver.predict(data_set)['predict_result'].to_numpy(dtype=np.float32)
+    solver.quantize(mode, calibration_dataset=data_set, calibration_samples=4)
+    predictions = solver.predict(data_set)['predict_result'].to_numpy(dtype=np.float32)
+    # randomly initialized models predict close to 0.5, so the predictions also have to keep their ranking
+    np.testing.assert_allclose(predictions, expected, rtol=0, atol=5e-3)
+    assert np.corrcoef(predictions, expected)[0, 1] > 0.95
+    assert solver.model is not model
+    # the float model keeps its weights
+    for name, value in model.state_dict().items():
+        assert torch.equal(value, state[name])
+
+
+def test_weight_only_convolutions_keep_int8_weights():
+    torch.manual_seed(0)
+    conv = nn.Conv1d(16, 8, kernel_size=9, padding=4)
+    quantized = WeightOnlyInt8Conv1d(conv)
+    assert quantized.weight_int8.dtype == torch.int8 and quantized.weight_int8.abs().max() == 127
+    x = torch.randn(2, 16, 30)
+    with torch.no_grad():
+        # the rounding error of a weight is at most half of the scale of its output channel
+        assert (quantized.weight_int8 * quantized.scale - conv.weight).abs().max() <= quantized.scale.max() / 2
+        torch.testing.assert_close(quantized(x), conv(x), rtol=0, atol=5e-2)
+
+
+def test_quantization_modes_are_checked():
+    model = FFN(embeddings_dim=16, output_dim=1)
+    with pytest.raises(ValueError, match='not supported'):
+        quantize_model(model, 'int4')
+    with pytest.raises(ValueError, match='calibration'):
+        quantize_model(model, 'static')
@@ -0,0 +1,69 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from datasets.samplers import LengthBucketBatchSampler
+
+LENGTHS = np.random.default_rng(0).integers(1, 1000, size=103)
+
+
+@pytest.mark.parametrize('drop_last', [False, True])
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_every_sample_is_in_one_batch_per_epoch(shuffle, drop_last):
+    sampler = LengthBucketBatchSampler(LENGTHS, batch_size=8, bucket_size_multiplier=3, shuffle=shuffle,
+                                       drop_last=drop_last, seed=1, record_batches=True)
+    for _ in range(2):
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        indices = np.concatenate(batches)
+        assert len(np.unique(indices)) == len(indices)
+        if drop_last:
+            assert all(len(batch) == 8 for batch in batches)
+            # every bucket of 24 samples gives three full batches, the last bucket of 7 samples none
+            assert len(indices) == 96
+        else:
+            assert sorted(indices.tolist()) == list(range(len(LENGTHS)))
+        assert list(sampler.yielded_batches) == batches
+
+
+def test_unshuffled_batches_are_sorted_within_consecutive_buckets():
+    sampler = LengthBucketBatchSampler(LENGTHS, batch_size=8, bucket_size_multiplier=3, shuffle=False)
+    indices = np.concatenate(list(sampler))
+    for bucket_start in range(0, len(LENGTHS), 24):
+        bucket = indices[bucket_start:bucket_start + 24]
+        # a consumer only holds one bucket to restore the order of the dataset
+        assert sorted(bucket.tolist()) == list(range(bucket_start, min(bucket_start + 24, len(LENGTHS))))
+        assert np.all(np.diff(LENGTHS[bucket]) >= 0)
+
+
+def test_bucketing_reduces_the_padding():
+    def padded_residues(batches):
+        return sum(len(batch) * LENGTHS[batch].max() for batch in batches)
+
+    bucketed = list(LengthBucketBatchSampler(LENGTHS, batch_size=8, bucket_size_multiplier=100, shuffle=True, seed=2))
+    unbucketed = [list(range(start, min(start + 8, len(LENGTHS)))) for start in range(0, len(LENGTHS), 8)]
+    assert padded_residues(bucketed) < 0.7 * padded_residues(unbucketed)
+
+
+def test_shuffled_epochs_are_reproducible_and_differ():
+    first, second = (LengthBucketBatchSampler(LENGTHS, batch_size=8, seed=3) for _ in range(2))
+    epochs = [list(first), list(first)]
+    assert epochs == [list(second), list(second)]
+    assert epochs[0] != epochs[1]
+
+
+def test_unshuffled_batches_are_formed_one_bucket_at_a_time():
+    lengths = np.random.default_rng(0).integers(1, 1000, size=2000000)
+    sampler = LengthBucketBatchSampler(lengths, batch_size=1, bucket_size_multiplier=100, shuffle=False,
+                                       record_batches=True)
+    tracemalloc.start()
+    batches = iter(sampler)
+    for _ in range(250):
+        batch = next(batches)
+        # a consumer that takes the indices of every batch it gets keeps the deque empty
+        assert sampler.yielded_batches.popleft() == batch
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < 2 ** 20 and len(sampler.yielded_batches) == 0
+    assert batch == [int(np.argsort(lengths[200:300], kind='stable')[49]) + 200]
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import torch
+
+from datasets.sliding_windows import SlidingWindowDataset
+from datasets.transforms import RandomCrop
+
+
+def test_random_crop_bounds_the_length_of_long_proteins():
+    embedding = np.arange(50 * 2, dtype=np.float32).reshape(50, 2)
+    crop = RandomCrop(window=10)
+    torch.manual_seed(0)
+    starts = set()
+    for _ in range(20):
+        cropped, solubility = crop((embedding, 1))
+        assert cropped.shape == (10, 2) and solubility == 1
+        start = int(cropped[0, 0]) // 2
+        np.testing.assert_array_equal(cropped, embedding[start:start + 10])
+        starts.add(start)
+    assert len(starts) > 1 and min(starts) >= 0 and max(starts) <= 40
+    # short proteins and reduced embeddings are not cropped
+    assert crop((embedding[:10], 0))[0].shape == (10, 2)
+    assert crop((embedding[0], 0))[0].shape == (2,)
+
+
+def test_windows_cover_every_residue(make_dataset):
+    data_set = make_dataset([4, 10, 11, 25])
+    windows = SlidingWindowDataset(data_set, window_size=10, window_overlap=3)
+    assert windows.window_counts.tolist() == [1, 1, 2, 4]
+    assert windows.lengths.max() == 10 and len(windows) == 8
+    for protein in range(len(data_set)):
+        selected = windows.proteins == protein
+        starts, ends = windows.starts[selected], windows.ends[selected]
+        assert starts[0] == 0 and ends[-1] == data_set.lengths[protein]
+        # consecutive windows overlap by at least window_overlap residues
+        assert (ends[:-1] - starts[1:] >= 3).all()
+    embedding, metadata = windows[5]
+    assert metadata['id'] == 'id00003'
+    torch.testing.assert_close(embedding, data_set[3][0][windows.starts[5]:windows.ends[5]])
+
+
+def test_window_predictions_are_aggregated_per_protein(make_dataset):
+    windows = SlidingWindowDataset(make_dataset([4, 11, 25]), window_size=10, window_overlap=3)
+    predictions = np.arange(len(windows), dtype=np.float32)[:, None]
+    np.testing.assert_array_equal(windows.aggregate(predictions, 'mean'), [[0], [1.5], [4.5]])
+    np.testing.assert_array_equal(windows.aggregate(predictions, 'max'), [[0], [2], [6]])
+    # the windows of consecutive proteins that complete during a prediction run
+    np.testing.assert_array_equal(windows.aggregate(predictions[1:3], 'max', slice(1, 2)), [[2]])
+    with pytest.raises(ValueError):
+        SlidingWindowDataset(make_dataset([4]), window_size=10, window_overlap=10)
@@ -4,11 +4,12 @@ from models import *  # For loading classes specified in config
 from torch.optim import *  # For loading optimizer specified in config
 from torch.utils.data import DataLoader
 from torchvision.transforms import transforms
+from datasets.embedding_cache import EmbeddingCache, split_cache_budget
 from datasets.embeddings_dataset import EmbeddingsDataset
 from datasets.transforms import *
 import os
-from solver import Solver
-from utils.general import padded_permuted_collate, seed_all
+from solver import Solver, build_data_loader
+from utils.general import seed_all
 
 
 def train(args):
@@ -21,28 +22,34 @@ def train(args):
         os.makedirs('outputs/'+args.exp_name+'/'+'models')
 
     seed_all(args.seed)
-    transform = transforms.Compose([SolubilityToInt(), ToTensor()])
+    # the embeddings keep their on-disk dtype until the collate function copies them into the padded batch
+    transform = transforms.Compose([SolubilityToInt(), ToTensor(dtype=None)])
+    if args.crop_window > 0:
+        train_transform = transforms.Compose([SolubilityToInt(), RandomCrop(args.crop_window), ToTensor(dtype=None)])
+    else:
+        train_transform = transform
     train_set = EmbeddingsDataset(args.train_embeddings, args.train_remapping, args.unknown_solubility,
                                                max_length=args.max_length, key_format=args.key_format,
-                                              embedding_mode=args.embedding_mode, transform=transform)
+                                              embedding_mode=args.embedding_mode, transform=train_transform)
     val_set = EmbeddingsDataset(args.val_embeddings, args.val_remapping, args.unknown_solubility,
                                             key_format=args.key_format, max_length=args.max_length,
                                             embedding_mode=args.embedding_mode, transform=transform)
-    
-    if len(train_set[0][0].shape) == 2:  # if we have per residue embeddings they have an additional length dim
-        collate_function = padded_permuted_collate
-    else:  # if we have reduced sequence wise embeddings use the default collate function by passing None
-        collate_function = None
-
-    train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, collate_fn=collate_function,drop_last=True)
-    val_loader = DataLoader(val_set, batch_size=args.batch_size,shuffle=True, collate_fn=collate_function,drop_last=True)
+    # the train and val embeddings share one cache budget
+    for data_set, cache_bytes in zip([train_set, val_set], split_cache_budget(args.embedding_cache_bytes,
+                                                                              [train_set.lengths, val_set.lengths])):
+        data_set.cache = EmbeddingCache(cache_bytes) if cache_bytes > 0 else None
 
     # Needs "from models import *" to work
-    model = globals()[args.model_type](embeddings_dim=train_set[0][0].shape[-1], **args.model_parameters)
+    model = globals()[args.model_type](embeddings_dim=train_set.embeddings_dim, **args.model_parameters)
     print('trainable params: ', sum(p.numel() for p in model.parameters() if p.requires_grad))
 
     # Needs "from torch.optim import *" and "from models import *" to work
     solver = Solver(model, args, globals()[args.optimizer])
+
+    train_loader = build_data_loader(train_set, args, collate_fn=solver.collate_function(labelled=True), shuffle=True,
+                                     drop_last=True)
+    val_loader = build_data_loader(val_set, args, collate_fn=solver.collate_function(labelled=True), shuffle=True,
+                                   drop_last=True)
     solver.train(train_loader, val_loader, eval_data=val_set)
 
     if args.eval_on_test:
@@ -81,6 +88,32 @@ def parse_arguments():
                                                                 'training when using embedddings of variable length')
     p.add_argument('--embedding_mode', type=str, default='lm',
                    help='type of embedding to use (lm means Language model) [lm, onehot, profile]')
+    p.add_argument('--crop_window', type=int, default=0,
+                   help='randomly crop the per residue embeddings of longer training proteins to this many residues '
+                        '(0 disables cropping)')
+    p.add_argument('--length_bucketing', type=bool, default=False,
+                   help='batch sequences of similar length together to reduce the padding of per residue embeddings')
+    p.add_argument('--bucket_size_multiplier', type=int, default=100,
+                   help='number of batches per length sorted bucket when using length_bucketing')
+    p.add_argument('--num_workers', type=int, default=0,
+                   help='number of DataLoader worker processes that read the embeddings (0 loads in the main process)')
+    p.add_argument('--pin_memory', type=bool, default=False,
+                   help='copy batches into page locked memory for faster transfers to the gpu')
+    p.add_argument('--prefetch_factor', type=int, default=2,
+                   help='number of batches loaded in advance by each worker')
+    p.add_argument('--persistent_workers', type=bool, default=False,
+                   help='keep the worker processes and their open h5 files alive between epochs')
+    p.add_argument('--input_dtype', type=str, default='stored',
+                   help='[stored, float32, float16, bfloat16] dtype of the padded batches on the host and during the '
+                        'transfer to the device, stored keeps the dtype of the embeddings file, half precision batches '
+                        'are cast to float32 in the model step')
+    p.add_argument('--autocast', type=bool, default=False,
+                   help='run the model under torch.autocast (float16 on cuda, bfloat16 on the cpu) instead of casting '
+                        'the batches to float32')
+    p.add_argument('--embedding_cache_bytes', type=int, default=0,
+                   help='byte budget of the in-memory cache of the train and val embeddings together, it is split '
+                        'between them by their residues, with num_workers > 0 it is filled before the workers start '
+                        'and shared by them (0 disables it)')
 
     p.add_argument('--eval_on_test', type=bool, default=True, help='runs evaluation on test set if true')
     p.add_argument('--train_embeddings', type=str, default='data/embeddings/train.h5',
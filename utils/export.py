@@ -0,0 +1,149 @@
+import inspect
+import json
+import os
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+
+from utils.general import min_input_length
+
+EXPORT_FORMATS = ['torchscript', 'onnx']
+RUNTIMES = ['torch', 'torchscript', 'onnxruntime']
+
+
+class MaskedModel(nn.Module):
+    """The forward(x, mask) signature of a model that is traced for the export, the models take **kwargs"""
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        return self.model(x, mask=mask)
+
+
+def example_inputs(model: nn.Module, embeddings_dim: int, lengths: Tuple[int, ...] = (24, 17)) -> Tuple[
+    torch.Tensor, torch.Tensor]:
+    """padded batch of random embeddings in the input_layout of the model and its mask, to trace the model with"""
+    mask = torch.arange(max(lengths))[None, :] < torch.tensor(lengths)[:, None]
+    x = torch.randn(len(lengths), max(lengths), embeddings_dim) * mask[:, :, None]
+    if getattr(model, 'input_layout', 'BDL') == 'BDL':
+        x = x.permute(0, 2, 1).contiguous()
+    return x, mask
+
+
+def export_info_path(path: str) -> str:
+    return path + '.json'
+
+
+def export_model(model: nn.Module, path: str, export_format: str, embeddings_dim: int, opset_version: int = 17):
+    """
+    Export a model in eval mode with dynamic batch and sequence length axes. The input_layout of the model is written
+    to <path>.json, the runtimes batch the embeddings in that layout.
+    Args:
+        model: model with the weights of a checkpoint
+        path: file to write the exported model to
+        export_format: 'torchscript' for a traced module that torch.jit.load reads or 'onnx'
+        embeddings_dim: size of the embeddings the model takes
+        opset_version: ONNX opset of the export
+
+    Returns:
+
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError('export format {} not supported, use one of {}'.format(export_format, EXPORT_FORMATS))
+    if export_format == 'onnx':
+        try:
+            import onnx
+        except ImportError:
+            raise ImportError('exporting ONNX models needs onnx, install it with "pip install onnx"')
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    model = model.cpu().eval()
+    input_layout = getattr(model, 'input_layout', 'BDL')
+    masked_model = MaskedModel(model).eval()
+    inputs = example_inputs(model, embeddings_dim)
+    with torch.no_grad():
+        if export_format == 'torchscript':
+            torch.jit.trace(masked_model, inputs, check_trace=False).save(path)
+        else:
+            length_axis = 1 if input_layout == 'BLD' else 2
+            # newer torch versions export with dynamo by default, which does not take dynamic_axes; older versions,
+            # like the pinned 2.0.1, have no dynamo argument and always use the TorchScript exporter
+            options = {}
+            if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+                options['dynamo'] = False
+            torch.onnx.export(masked_model, inputs, path, input_names=['embedding', 'mask'],
+                              output_names=['prediction'], opset_version=opset_version,
+                              dynamic_axes={'embedding': {0: 'batch_size', length_axis: 'sequence_length'},
+                                            'mask': {0: 'batch_size', 1: 'sequence_length'},
+                                            'prediction': {0: 'batch_size'}}, **options)
+    with open(export_info_path(path), 'w') as f:
+        json.dump({'model_type': type(model).__name__, 'input_layout': input_layout, 'embeddings_dim': embeddings_dim,
+                   'export_format': export_format, 'min_input_length': min_input_length(model)}, f, indent=2)
+
+
+class TorchScriptModel(nn.Module):
+    """Traced module written by export_model, it runs without the Python code of the model"""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.module = torch.jit.load(path, map_location='cpu')
+        with open(export_info_path(path)) as f:
+            info = json.load(f)
+        self.input_layout = info['input_layout']
+        # the exported graph has no convolution modules to read the shortest accepted length from
+        self.min_input_length = info.get('min_input_length', 1)
+
+    def forward(self, x: torch.Tensor, mask: torch.Tensor, **kwargs) -> torch.Tensor:
+        return self.module(x, mask)
+
+
+class OnnxRuntimeModel(nn.Module):
+    """ONNX model written by export_model that runs on the CPU with ONNX Runtime, it takes and returns tensors"""
+
+    def __init__(self, path: str, num_threads: int = 0):
+        """
+
+        Args:
+            path: ONNX file written by export_model
+            num_threads: number of threads of an operator, 0 lets ONNX Runtime decide
+        """
+        super().__init__()
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('running ONNX models needs onnxruntime, install it with "pip install onnxruntime"')
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        # the exporter drops inputs that the model does not use, like the mask of the FFN
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        with open(export_info_path(path)) as f:
+            info = json.load(f)
+        self.input_layout = info['input_layout']
+        # the exported graph has no convolution modules to read the shortest accepted length from
+        self.min_input_length = info.get('min_input_length', 1)
+
+    def forward(self, x: torch.Tensor, mask: torch.Tensor, **kwargs) -> torch.Tensor:
+        feeds = {'embedding': x.detach().float().cpu().numpy(), 'mask': mask.cpu().numpy()}
+        outputs = self.session.run(None, {name: feeds[name] for name in self.input_names})
+        return torch.from_numpy(outputs[0]).to(x.device)
+
+
+def load_runtime_model(runtime: str, path: str) -> nn.Module:
+    """
+    Model that runs an exported model with the given runtime
+    Args:
+        runtime: 'torchscript' or 'onnxruntime'
+        path: file written by export_model in the matching format
+
+    Returns: module with the forward signature of the models and their input_layout
+
+    """
+    if runtime == 'torchscript':
+        return TorchScriptModel(path)
+    elif runtime == 'onnxruntime':
+        return OnnxRuntimeModel(path)
+    raise ValueError('runtime {} does not run exported models, use one of {}'.format(runtime, RUNTIMES[1:]))
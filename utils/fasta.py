@@ -0,0 +1,91 @@
+from typing import List, Tuple
+
+import numpy as np
+
+from utils.general import AMINO_ACIDS
+
+UNKNOWN_AMINO_ACID = 255
+
+# maps the ascii code of every amino acid letter to its index in AMINO_ACIDS, all other bytes to UNKNOWN_AMINO_ACID
+AMINO_ACID_LOOKUP = np.full(256, UNKNOWN_AMINO_ACID, dtype=np.uint8)
+for amino_acid, amino_acid_id in AMINO_ACIDS.items():
+    AMINO_ACID_LOOKUP[ord(amino_acid)] = amino_acid_id
+
+WHITESPACE = b' \t\r\n\v\f'
+
+
+def read_fasta(path: str) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """
+    Read a fasta file at the byte level without creating a SeqRecord per sequence
+    Args:
+        path: fasta file
+
+    Returns: the descriptions (header lines without '>') of the records, all sequences concatenated into one uint8
+    array of ascii codes and the [number_of_records + 1] offsets of the sequences in that array
+
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data.startswith(b'>'):
+        start = 1
+    else:  # skip anything before the first record
+        start = data.find(b'\n>') + 2
+        if start == 1:
+            return [], np.zeros(0, dtype=np.uint8), np.zeros(1, dtype=np.int64)
+    descriptions = []
+    sequences = []
+    for record in data[start:].split(b'\n>'):
+        header, _, sequence = record.partition(b'\n')
+        descriptions.append(header.decode().rstrip())
+        sequences.append(sequence.translate(None, WHITESPACE))
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum([len(sequence) for sequence in sequences], out=offsets[1:])
+    return descriptions, np.frombuffer(b''.join(sequences), dtype=np.uint8), offsets
+
+
+def fasta_key(description: str, key_format: str = 'hash') -> str:
+    """Key of the embeddings file for the fasta record with the given description"""
+    if key_format == 'hash':
+        return description.split(None, 1)[0]
+    elif key_format == 'fasta_descriptor':
+        return str(description.split(' ')[0]).replace('.', '_').replace('/', '_')
+    elif key_format == 'fasta_descriptor_old':
+        return description
+    else:
+        raise Exception('Unknown key_format: ', key_format)
+
+
+def encode_sequences(residues: np.ndarray) -> np.ndarray:
+    """Map ascii codes to the indices of AMINO_ACIDS, letters that are not in AMINO_ACIDS become UNKNOWN_AMINO_ACID"""
+    return AMINO_ACID_LOOKUP[residues]
+
+
+def amino_acid_composition(amino_acid_ids: np.ndarray, offsets: np.ndarray,
+                           chunk_residues: int = 1 << 24) -> np.ndarray:
+    """
+    Relative frequency of every amino acid in every sequence, computed with one bincount per chunk of sequences
+    Args:
+        amino_acid_ids: encoded residues of all sequences as returned by encode_sequences
+        offsets: [number_of_sequences + 1] offsets of the sequences in amino_acid_ids
+        chunk_residues: approximate number of residues per bincount, to bound the size of the temporary arrays
+
+    Returns: [number_of_sequences, len(AMINO_ACIDS)] float32 array, the frequencies are relative to the full sequence
+    length including letters that are not in AMINO_ACIDS
+
+    """
+    num_amino_acids = len(AMINO_ACIDS)
+    lengths = np.diff(offsets)
+    counts = np.zeros((len(lengths), num_amino_acids + 1), dtype=np.int64)
+    start = 0
+    while start < len(lengths):
+        # take sequences until the chunk holds chunk_residues, but always at least one sequence
+        end = max(start + 1, int(np.searchsorted(offsets, offsets[start] + chunk_residues, side='right')) - 1)
+        end = min(end, len(lengths))
+        ids = amino_acid_ids[offsets[start]:offsets[end]].astype(np.int64)
+        ids[ids == UNKNOWN_AMINO_ACID] = num_amino_acids  # count unknown letters in an extra bin that is dropped
+        sequence_index = np.repeat(np.arange(end - start), lengths[start:end])
+        counts[start:end] = np.bincount(sequence_index * (num_amino_acids + 1) + ids,
+                                        minlength=(end - start) * (num_amino_acids + 1)).reshape(end - start, -1)
+        start = end
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (counts[:, :num_amino_acids] / lengths[:, None]).astype(np.float32)
@@ -1,11 +1,12 @@
 import random
-from typing import List, Tuple
+import warnings
+from typing import List, Optional, Tuple, Union
 import numpy as np
 import torch
 from torch.nn.utils.rnn import pad_sequence
 import matplotlib.pyplot as plt
 plt.rcParams['figure.dpi'] = 300
-from models import *  # imports all classes in the models directory
+from utils.metadata import collate_metadata
 
 SOLUBILITY = ['0', '1']
 
@@ -50,6 +51,131 @@ def seed_all(seed):
     #torch.backends.cudnn.deterministic = True
     #torch.backends.cudnn.benchmark = False
 
+def as_tensor(embedding: Union[np.ndarray, torch.Tensor]) -> torch.Tensor:
+    """
+    Wrap a numpy array as tensor without copying it and without changing its dtype. Memory mapped embeddings are read
+    only, which torch warns about, but they are only ever read from.
+    """
+    if isinstance(embedding, torch.Tensor):
+        return embedding
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        return torch.from_numpy(np.asarray(embedding))
+
+
+def min_input_length(model: torch.nn.Module) -> int:
+    """
+    Shortest padded length that every one dimensional convolution of the model accepts, a convolution without
+    padding fails on batches that are shorter than its kernel. This includes the quantized convolutions. Models
+    without convolution modules, like the runtimes of exported models, can declare it with a min_input_length
+    attribute.
+    """
+    length = getattr(model, 'min_input_length', 1)
+    for module in model.modules():
+        kernel_size = getattr(module, 'kernel_size', None)
+        padding = getattr(module, 'padding', (0,))
+        if isinstance(kernel_size, tuple) and len(kernel_size) == 1 and not isinstance(padding, str):
+            dilation = getattr(module, 'dilation', (1,))
+            length = max(length, dilation[0] * (kernel_size[0] - 1) + 1 - 2 * padding[0])
+    return length
+
+
+class PaddedCollate():
+    """
+    Collate function that copies every embedding exactly once, directly into a zero padded batch tensor in the layout
+    that the model declares with its input_layout attribute: 'BDL' for [batchsize, embeddings_dim, length] or 'BLD'
+    for [batchsize, length, embeddings_dim]. The conversion to dtype happens during that copy, so the dataset can
+    return the embeddings in their on-disk dtype. Without a dtype the batch keeps the dtype of the embeddings, so half
+    precision embeddings stay half precision until the batch is cast on the device. Reduced embeddings without a length dimension are stacked into
+    [batchsize, embeddings_dim]. Batches are padded to at least min_length, so a batch of short proteins still fits
+    the kernels of the convolutions of the model.
+
+    In the main process the batch tensors are taken from num_buffers preallocated buffers in turn, which are
+    optionally pinned and only grow when a batch does not fit. Batches created in DataLoader workers are shared with
+    the main process, so there every batch gets a new tensor and pinning is left to the DataLoader.
+    """
+
+    def __init__(self, layout: str = 'BDL', dtype: Optional[torch.dtype] = torch.float32, pin_memory: bool = False,
+                 labelled: bool = True, num_buffers: int = 2, min_length: int = 1):
+        """
+
+        Args:
+            layout: 'BDL' or 'BLD' layout of the padded batch
+            dtype: dtype of the padded batch, None for the dtype of the embeddings
+            pin_memory: allocate the reused buffers in pinned memory if cuda is available
+            labelled: whether the samples are (embedding, solubility, metadata) or (embedding, metadata) tuples
+            num_buffers: number of buffers that are used in turn, a batch stays valid until num_buffers more batches
+                were collated
+            min_length: shortest padded length of a batch, see min_input_length
+        """
+        if layout not in ['BDL', 'BLD']:
+            raise ValueError('layout {} not supported'.format(layout))
+        self.layout = layout
+        self.dtype = dtype
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.labelled = labelled
+        self.min_length = min_length
+        self.buffers = [None] * num_buffers
+        self.next_buffer = 0
+        self.bytes_copied = 0  # bytes written into batch tensors, including the zero padding
+        self.batches = 0
+
+    def __call__(self, batch: list) -> tuple:
+        embeddings = [as_tensor(item[0]) for item in batch]
+        dtype = embeddings[0].dtype if self.dtype is None else self.dtype
+        if embeddings[0].dim() == 1:
+            padded = self.allocate((len(batch), embeddings[0].shape[0]), dtype)
+            for i, embedding in enumerate(embeddings):
+                padded[i].copy_(embedding)
+        else:
+            max_length = max(self.min_length, max(embedding.shape[0] for embedding in embeddings))
+            embeddings_dim = embeddings[0].shape[-1]
+            if self.layout == 'BLD':
+                padded = self.allocate((len(batch), max_length, embeddings_dim), dtype)
+            else:
+                padded = self.allocate((len(batch), embeddings_dim, max_length), dtype)
+            for i, embedding in enumerate(embeddings):
+                length = embedding.shape[0]
+                if self.layout == 'BLD':
+                    padded[i, :length].copy_(embedding)
+                    padded[i, length:].zero_()
+                else:
+                    padded[i, :, :length].copy_(embedding.T)
+                    padded[i, :, length:].zero_()
+        self.bytes_copied += padded.numel() * padded.element_size()
+        self.batches += 1
+        metadata = collate_metadata([item[-1] for item in batch])
+        if embeddings[0].dim() > 1:  # cropped embeddings and windows are shorter than the sequence in the metadata
+            metadata['length'] = torch.tensor([embedding.shape[0] for embedding in embeddings])
+        if self.labelled:
+            return padded, torch.tensor([item[1] for item in batch]), metadata
+        return padded, metadata
+
+    def allocate(self, shape: tuple, dtype: torch.dtype) -> torch.Tensor:
+        numel = int(np.prod(shape))
+        if torch.utils.data.get_worker_info() is not None:
+            return torch.empty(shape, dtype=dtype)
+        index = self.next_buffer
+        self.next_buffer = (index + 1) % len(self.buffers)
+        buffer = self.buffers[index]
+        if buffer is None or buffer.numel() < numel or buffer.dtype != dtype:
+            self.buffers[index] = torch.empty(numel, dtype=dtype, pin_memory=self.pin_memory)
+        return self.buffers[index][:numel].view(shape)
+
+
+def padding_mask(embedding: torch.Tensor, lengths: torch.Tensor, layout: str = 'BDL') -> torch.Tensor:
+    """
+    [batchsize, padded_length] mask of a batch of PaddedCollate that is True for the residues and False for the zero
+    padding. The mask has the width of the padded batch, which is longer than the longest protein if the batch was
+    padded to min_length. Reduced embeddings have no length dimension and get a mask as wide as the longest protein.
+    """
+    if embedding.dim() < 3:
+        width = int(lengths.max())
+    else:
+        width = embedding.shape[1 if layout == 'BLD' else 2]
+    return torch.arange(width)[None, :] < lengths[:, None]
+
+
 def padded_permuted_collate(batch: List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor, dict]]) -> Tuple[
     torch.Tensor, torch.Tensor, torch.Tensor, dict]:
     """
@@ -58,14 +184,14 @@ def padded_permuted_collate(batch: List[Tuple[torch.Tensor, torch.Tensor, torch.
         batch: list of tuples with embeddings and the corresponding label
 
     Returns: tuple of tensor of embeddings with [batchsize, length_of_longest_sequence, embeddings_dim]
-    and tensor of labels [batchsize, labels_dim] and metadate collated according to default collate
+    and tensor of labels [batchsize, labels_dim] and metadata collated with collate_metadata
 
     """
     embeddings = [item[0] for item in batch]
     # localization = torch.tensor([item[1] for item in batch])
     solubility = torch.tensor([item[1] for item in batch])
     metadata = [item[2] for item in batch]
-    metadata = torch.utils.data.dataloader.default_collate(metadata)
+    metadata = collate_metadata(metadata)
     embeddings = pad_sequence(embeddings, batch_first=True)
     return embeddings.permute(0, 2, 1), solubility, metadata
 
@@ -77,13 +203,13 @@ def predict_padded_permuted_collate(batch: List[Tuple[torch.Tensor, torch.Tensor
         batch: list of tuples with embeddings and the corresponding label
 
     Returns: tuple of tensor of embeddings with [batchsize, length_of_longest_sequence, embeddings_dim]
-    and tensor of labels [batchsize, labels_dim] and metadate collated according to default collate
+    and tensor of labels [batchsize, labels_dim] and metadata collated with collate_metadata
 
     """
     embeddings = [item[0] for item in batch]
     # localization = torch.tensor([item[1] for item in batch])
     metadata = [item[1] for item in batch]
-    metadata = torch.utils.data.dataloader.default_collate(metadata)
+    metadata = collate_metadata(metadata)
     embeddings = pad_sequence(embeddings, batch_first=True)
     return embeddings.permute(0, 2, 1), metadata
 
@@ -102,7 +228,7 @@ def numpy_collate_to_reduced(batch: List[Tuple[np.array, np.array, np.array, dic
     localization = [np.array(item[1]) for item in batch]
     solubility = [item[2] for item in batch]
     metadata = [item[3] for item in batch]
-    metadata = torch.utils.data.dataloader.default_collate(metadata)
+    metadata = collate_metadata(metadata)
     return embeddings, localization, solubility, metadata
 
 
@@ -120,7 +246,7 @@ def numpy_collate_for_reduced(batch: List[Tuple[np.array, np.array, np.array, di
     localization = [np.array(item[1]) for item in batch]
     solubility = [item[2] for item in batch]
     metadata = [item[3] for item in batch]
-    metadata = torch.utils.data.dataloader.default_collate(metadata)
+    metadata = collate_metadata(metadata)
     return embeddings, localization, solubility, metadata
 
 
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+
+STORAGE_DTYPES = ['float32', 'float16', 'bfloat16']
+COMPRESSIONS = ['none', 'lzf', 'gzip']
+# file attribute with the storage dtype, bfloat16 has no numpy or HDF5 type and is stored as the upper 16 bits of the
+# float32 values in uint16 datasets that the readers decode
+STORAGE_DTYPE_ATTRIBUTE = 'storage_dtype'
+# file attribute with the paths, relative to the h5 file, of the shard files that its virtual datasets map
+VIRTUAL_SOURCES_ATTRIBUTE = 'virtual_sources'
+
+
+def encode_embedding(embedding: np.ndarray, storage_dtype: str = 'float32') -> np.ndarray:
+    """embedding in the storage dtype, bfloat16 is rounded to nearest even and returned as uint16"""
+    if storage_dtype not in STORAGE_DTYPES:
+        raise ValueError('storage dtype {} not supported, use one of {}'.format(storage_dtype, STORAGE_DTYPES))
+    if storage_dtype != 'bfloat16':
+        return np.asarray(embedding).astype(storage_dtype, copy=False)
+    bits = np.ascontiguousarray(embedding, dtype=np.float32).view(np.uint32)
+    rounded = bits + 0x7FFF + ((bits >> 16) & 1)
+    return (rounded >> 16).astype(np.uint16)
+
+
+def decode_bfloat16(embedding: np.ndarray) -> np.ndarray:
+    """float32 values of bfloat16 embeddings that are stored as uint16"""
+    return (np.asarray(embedding).astype(np.uint32) << 16).view(np.float32)
+
+
+def dataset_options(shape: tuple, chunk_residues: int = 0, compression: str = 'none', compression_level: int = 4,
+                    shuffle: bool = False) -> dict:
+    """
+    Keyword arguments of h5py create_dataset for the [length, embeddings_dim] embedding of a protein
+    Args:
+        shape: shape of the embedding
+        chunk_residues: number of residues per chunk, 0 stores the embedding contiguously unless it is compressed,
+            then h5py chooses the chunks
+        compression: 'none', 'lzf' or 'gzip'
+        compression_level: gzip level from 0 to 9
+        shuffle: whether to apply the byte shuffle filter before the compression, it groups the bytes of the values
+            by significance, which usually compresses floats better
+
+    Returns: dict of the chunks, compression, compression_opts and shuffle arguments
+
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError('compression {} not supported, use one of {}'.format(compression, COMPRESSIONS))
+    options = {}
+    if chunk_residues > 0:
+        options['chunks'] = (min(chunk_residues, shape[0]),) + tuple(shape[1:])
+    if compression != 'none':
+        options['compression'] = compression
+        if compression == 'gzip':
+            options['compression_opts'] = compression_level
+    if shuffle:
+        options['shuffle'] = True
+    return options
+
+
+def check_virtual_sources(f):
+    """
+    Raise a FileNotFoundError if a shard file that the virtual datasets of the open h5 file map is missing, HDF5
+    would read their embeddings as zeros without an error
+    """
+    directory = os.path.dirname(os.path.abspath(f.filename))
+    missing = [str(source) for source in f.attrs.get(VIRTUAL_SOURCES_ATTRIBUTE, [])
+               if not os.path.exists(os.path.join(directory, str(source)))]
+    if missing:
+        raise FileNotFoundError('{} has virtual datasets that read from the missing shard files {}, restore them or '
+                                'generate the embeddings again with --merge copy'.format(f.filename, missing))
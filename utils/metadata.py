@@ -0,0 +1,106 @@
+from collections.abc import Mapping
+from typing import Iterator, List, Sequence
+
+import numpy as np
+import torch
+
+
+class SequenceMetadata():
+    """
+    Columnar metadata of the sequences of a dataset. Instead of one dict with a sequence string and a frequencies
+    tensor per protein, the ids, lengths, solubility labels and [N, 25] amino acid frequencies are NumPy arrays and
+    the sequences are slices of one concatenated uint8 buffer.
+    """
+
+    def __init__(self, ids: Sequence[str], residues: np.ndarray, starts: np.ndarray, lengths: np.ndarray,
+                 frequencies: np.ndarray, solubility: Sequence[str] = None):
+        """
+
+        Args:
+            ids: keys of the proteins in the embeddings file
+            residues: uint8 buffer with the ascii codes of the sequences
+            starts: start of every sequence in residues
+            lengths: length of every sequence
+            frequencies: [N, 25] float32 amino acid frequencies of every sequence
+            solubility: solubility label of every protein ['0', '1', 'U'] or None if the labels are unknown
+        """
+        self.ids = np.array([id.encode() for id in ids], dtype=np.bytes_)
+        self.residues = residues
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.frequencies = np.ascontiguousarray(frequencies, dtype=np.float32)
+        self.solubility = None if solubility is None else np.array(solubility, dtype='U1')
+
+    def id(self, index: int) -> str:
+        return self.ids[index].decode()
+
+    def sequence(self, index: int) -> str:
+        return self.residues[self.starts[index]:self.starts[index] + self.lengths[index]].tobytes().decode()
+
+    def gather(self, indices: Sequence[int]) -> dict:
+        """
+        Metadata of a batch in the format of default_collate, the numerical columns are gathered with fancy indexing
+        Args:
+            indices: indices of the samples in the batch
+
+        Returns: dict with 'id' and 'sequence' lists, a [batch_size] 'length' tensor, a [batch_size, 25] 'frequencies'
+        tensor and a [batch_size] 'solubility_known' tensor if the labels are known
+
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        batch = {'id': [id.decode() for id in self.ids[indices]],
+                 'sequence': [self.sequence(index) for index in indices],
+                 'length': torch.from_numpy(self.lengths[indices]),
+                 'frequencies': torch.from_numpy(self.frequencies[indices])}
+        if self.solubility is not None:
+            batch['solubility_known'] = torch.from_numpy(self.solubility[indices] != 'U')
+        return batch
+
+    def __getitem__(self, index: int) -> 'MetadataRow':
+        return MetadataRow(self, index)
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+
+class MetadataRow(Mapping):
+    """
+    Read only view of the metadata of one sample that behaves like the dict the datasets used to return, so
+    dataset[i][-1]['length'] keeps working while collate_metadata can gather a whole batch at once.
+    """
+
+    def __init__(self, table: SequenceMetadata, index: int):
+        self.table = table
+        self.index = index
+
+    def keys(self) -> List[str]:
+        keys = ['id', 'sequence', 'length', 'frequencies']
+        if self.table.solubility is not None:
+            keys.append('solubility_known')
+        return keys
+
+    def __getitem__(self, key: str):
+        if key == 'id':
+            return self.table.id(self.index)
+        elif key == 'sequence':
+            return self.table.sequence(self.index)
+        elif key == 'length':
+            return int(self.table.lengths[self.index])
+        elif key == 'frequencies':
+            return torch.from_numpy(self.table.frequencies[self.index])
+        elif key == 'solubility_known' and self.table.solubility is not None:
+            return bool(self.table.solubility[self.index] != 'U')
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+
+def collate_metadata(metadata: list) -> dict:
+    """Collate the metadata of a batch, with fancy indexing if all samples come from the same SequenceMetadata"""
+    if isinstance(metadata[0], MetadataRow) and all(row.table is metadata[0].table for row in metadata):
+        return metadata[0].table.gather([row.index for row in metadata])
+    return torch.utils.data.dataloader.default_collate(metadata)
@@ -0,0 +1,111 @@
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Sequence
+
+import numpy as np
+
+
+class MicroBatcher():
+    """
+    Coalesces the samples of concurrent requests into length bucketed batches for a single prediction thread. The
+    first sample that arrives opens a window of batch_window seconds, all samples that arrive until the window closes
+    or bucket_batches * max_batch_size samples are waiting are sorted by length and predicted in batches of at most
+    max_batch_size samples, so a batch pads its samples to a similar length.
+
+    The latencies of the last latency_window requests and the number of waiting samples are kept for stats.
+    """
+
+    def __init__(self, predict: Callable[[list], np.ndarray], length: Callable[[object], int],
+                 batch_window: float = 0.005, max_batch_size: int = 16, bucket_batches: int = 4,
+                 latency_window: int = 10000):
+        """
+
+        Args:
+            predict: predicts a list of samples, returns an array with one row per sample
+            length: length of a sample, used to sort the waiting samples
+            batch_window: seconds that the first sample waits for more samples
+            max_batch_size: maximum number of samples of a batch
+            bucket_batches: number of batches whose samples are sorted by length together, the window closes early
+                when they are complete
+            latency_window: number of recent requests the latency percentiles are computed from
+        """
+        self.predict = predict
+        self.length = length
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.max_pending = max_batch_size * bucket_batches
+        self.queue = queue.Queue()
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.samples = 0
+        self.batches = 0
+        self.in_flight = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, samples: Sequence) -> np.ndarray:
+        """
+        Predict the samples of a request together with the samples of concurrent requests, blocks until all of them
+        are predicted
+        Args:
+            samples: samples that predict accepts
+
+        Returns: predictions of the samples in their order
+
+        """
+        start = time.perf_counter()
+        futures = [Future() for _ in samples]
+        for sample, future in zip(samples, futures):
+            self.queue.put((sample, future))
+        predictions = np.stack([future.result() for future in futures]) if futures else np.zeros((0, 1))
+        with self.lock:
+            self.latencies.append(time.perf_counter() - start)
+            self.requests += 1
+        return predictions
+
+    def run(self):
+        while True:
+            pending = [self.queue.get()]
+            deadline = time.perf_counter() + self.batch_window
+            while len(pending) < self.max_pending:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.in_flight = len(pending)
+            pending.sort(key=lambda item: self.length(item[0]))
+            for start in range(0, len(pending), self.max_batch_size):
+                batch = pending[start:start + self.max_batch_size]
+                try:
+                    predictions = self.predict([sample for sample, _ in batch])
+                except Exception as e:  # fail the requests of the batch instead of the prediction thread
+                    for _, future in batch:
+                        future.set_exception(e)
+                else:
+                    for (_, future), prediction in zip(batch, predictions):
+                        future.set_result(prediction)
+                self.in_flight -= len(batch)
+                with self.lock:
+                    self.batches += 1
+                    self.samples += len(batch)
+
+    def stats(self) -> dict:
+        """latency percentiles in milliseconds, queue depth, throughput and mean batch size"""
+        with self.lock:
+            latencies = np.asarray(self.latencies) * 1000
+            stats = {'requests': self.requests, 'samples': self.samples, 'batches': self.batches,
+                     'mean_batch_size': self.samples / max(self.batches, 1),
+                     'samples_per_second': self.samples / (time.time() - self.started)}
+        stats['queue_depth'] = self.queue.qsize() + self.in_flight
+        for percentile in [50, 90, 99]:
+            stats['latency_p{}_ms'.format(percentile)] = float(np.percentile(latencies, percentile)) \
+                if len(latencies) else None
+        return stats
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import sqlite3
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+# arguments that change the predictions of a checkpoint, they are part of the fingerprint of the cached predictions
+PREDICTION_SETTINGS = ['model_type', 'model_parameters', 'embedding_mode', 'window_size', 'window_overlap',
+                       'window_aggregation', 'input_dtype', 'autocast', 'runtime', 'quantization',
+                       'calibration_samples']
+
+
+def sequence_hash(sequence: str) -> bytes:
+    return hashlib.sha256(sequence.encode()).digest()
+
+
+def file_hash(path: str, block_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def prediction_fingerprint(args, checkpoints: Sequence[str]) -> str:
+    """
+    Fingerprint of the weights of the checkpoints and the arguments in PREDICTION_SETTINGS, predictions are only
+    taken from the cache if they were made with the same fingerprint. The torchscript and onnxruntime runtimes run
+    the exported model instead of the checkpoint, so its path and the hash of its file are part of the fingerprint
+    Args:
+        args: inference arguments merged with the train arguments of the checkpoints
+        checkpoints: state dicts of the models whose predictions are cached together
+
+    Returns: hex digest of the fingerprint
+
+    """
+    fingerprint = {'checkpoints': [file_hash(checkpoint) for checkpoint in checkpoints],
+                   'settings': {key: getattr(args, key, None) for key in PREDICTION_SETTINGS}}
+    if getattr(args, 'runtime', 'torch') != 'torch':
+        fingerprint['settings']['exported_model'] = args.exported_model
+        fingerprint['exported_model'] = file_hash(args.exported_model)
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def cached_checkpoints(args, ensemble: bool = False) -> List[str]:
+    """
+    Files with the weights of the predictions that are cached together: the checkpoints_list of an ensemble, the
+    exported_model of the torchscript and onnxruntime runtimes, which holds the weights instead of a checkpoint, or
+    the checkpoint. The predictions can not be fingerprinted without weights, so a missing file raises a ValueError.
+    Args:
+        args: inference arguments merged with the train arguments of the checkpoints
+        ensemble: whether all checkpoints of checkpoints_list predict together
+
+    Returns: paths of the files that prediction_fingerprint and PredictionCache take as checkpoints
+
+    """
+    if ensemble:
+        checkpoints = list(args.checkpoints_list)
+    elif getattr(args, 'runtime', 'torch') != 'torch':
+        checkpoints = [getattr(args, 'exported_model', None)]
+    else:
+        checkpoints = [getattr(args, 'checkpoint', None)]
+    if not checkpoints or not all(checkpoints):
+        raise ValueError('the prediction cache fingerprints the weights of the model, set the checkpoint (or the '
+                         'exported_model of an exported runtime) or predict without a prediction_cache')
+    return checkpoints
+
+
+class PredictionCache():
+    """
+    SQLite file of predictions by the sha256 of the sequence and the fingerprint of the model that made them, so
+    proteins that were already scored by a previous run are neither embedded nor predicted again. The latest
+    fingerprint of every set of checkpoints is recorded, when the weights of the checkpoints change, the predictions
+    of the old fingerprint are deleted.
+    """
+
+    def __init__(self, path: str, checkpoints: Sequence[str], fingerprint: str):
+        """
+
+        Args:
+            path: SQLite file, it is created if it does not exist
+            checkpoints: paths of the state dicts of the models
+            fingerprint: fingerprint of the weights and settings, see prediction_fingerprint
+        """
+        self.path = path
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS models (checkpoints TEXT PRIMARY KEY, '
+                                'fingerprint TEXT NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS predictions (fingerprint TEXT NOT NULL, '
+                                'sequence_hash BLOB NOT NULL, prediction BLOB NOT NULL, '
+                                'PRIMARY KEY (fingerprint, sequence_hash)) WITHOUT ROWID')
+        key = json.dumps([os.path.abspath(checkpoint) for checkpoint in checkpoints])
+        row = self.connection.execute('SELECT fingerprint FROM models WHERE checkpoints = ?', (key,)).fetchone()
+        with self.connection:
+            if row is not None and row[0] != fingerprint:
+                # the weights or settings changed, the old predictions of these checkpoints are stale
+                self.connection.execute('DELETE FROM models WHERE checkpoints = ?', (key,))
+                if self.connection.execute('SELECT 1 FROM models WHERE fingerprint = ?', (row[0],)).fetchone() is None:
+                    self.connection.execute('DELETE FROM predictions WHERE fingerprint = ?', (row[0],))
+            self.connection.execute('INSERT OR REPLACE INTO models VALUES (?, ?)', (key, fingerprint))
+
+    def get_many(self, sequence_hashes: Sequence[bytes]) -> Dict[bytes, np.ndarray]:
+        """
+        Look up the predictions of sequences
+        Args:
+            sequence_hashes: sequence_hash of the sequences
+
+        Returns: dict of the float32 predictions of the sequences that are in the cache by their sequence_hash
+
+        """
+        found = {}
+        unique = list(set(sequence_hashes))
+        for start in range(0, len(unique), 500):  # stay below the limit of variables in a SQLite statement
+            chunk = unique[start:start + 500]
+            rows = self.connection.execute(
+                'SELECT sequence_hash, prediction FROM predictions WHERE fingerprint = ? AND sequence_hash IN '
+                '({})'.format(','.join('?' * len(chunk))), [self.fingerprint] + chunk)
+            found.update((sequence_hash, np.frombuffer(prediction, dtype=np.float32)) for sequence_hash, prediction
+                         in rows)
+        self.hits += sum(sequence_hash in found for sequence_hash in sequence_hashes)
+        self.misses += sum(sequence_hash not in found for sequence_hash in sequence_hashes)
+        return found
+
+    def put_many(self, sequence_hashes: Sequence[bytes], predictions: np.ndarray):
+        """
+        Add the predictions of sequences
+        Args:
+            sequence_hashes: sequence_hash of the sequences
+            predictions: [number of sequences, ...] predictions of the sequences
+
+        Returns:
+
+        """
+        predictions = np.asarray(predictions, dtype=np.float32).reshape(len(sequence_hashes), -1)
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)',
+                                        [(self.fingerprint, sequence_hash, prediction.tobytes()) for
+                                         sequence_hash, prediction in zip(sequence_hashes, predictions)])
+
+    def hit_rate(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def close(self):
+        self.connection.close()
+
@@ -0,0 +1,198 @@
+import json
+import os
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+
+OUTPUT_FORMATS = ['csv', 'parquet']
+
+
+class PredictionWriter():
+    """
+    Writes predictions to a csv or parquet file in chunks of chunk_size rows while they are produced, so the memory
+    does not grow with the number of predicted proteins. The csv file has the same layout as the DataFrame that
+    predict_evaluation used to write at once: an unnamed running index and the columns protein_ID, sequence and
+    predict_result, or one column per entry of prediction_columns. Writing parquet files needs pyarrow.
+
+    After every chunk of a csv file, the number of rows and the size of the file are recorded in <path>.progress.
+    An interrupted run can be resumed from there: the file is truncated to the recorded size, which drops a partly
+    written chunk, and rows_written tells the caller how many proteins are already done.
+    """
+
+    def __init__(self, path: str, output_format: str = 'csv', write_sequences: bool = True,
+                 chunk_size: int = 10000, prediction_columns: Sequence[str] = ('predict_result',),
+                 resume: bool = False, run_info: dict = None):
+        """
+
+        Args:
+            path: file to write the predictions to, an existing file is replaced unless the run is resumed
+            output_format: 'csv' or 'parquet'
+            write_sequences: whether to write the sequence column
+            chunk_size: number of rows that are buffered before they are written
+            prediction_columns: names of the columns of the predictions
+            resume: continue the file of an interrupted run from its progress file, if there is one
+            run_info: description of the input, a run is only resumed if it was written with the same run_info
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError('output format {} not supported, use one of {}'.format(output_format, OUTPUT_FORMATS))
+        if output_format == 'parquet':
+            if resume:
+                raise ValueError('resuming is only supported for csv files, parquet files are unreadable until '
+                                 'they are closed')
+            try:
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError('writing parquet files needs pyarrow, install it with "pip install pyarrow"')
+        self.path = path
+        self.progress_path = path + '.progress'
+        self.output_format = output_format
+        self.write_sequences = write_sequences
+        self.chunk_size = chunk_size
+        self.prediction_columns = list(prediction_columns)
+        self.columns = ['protein_ID'] + (['sequence'] if write_sequences else []) + self.prediction_columns
+        self.run_info = run_info or {}
+        self.chunks = []
+        self.buffered_rows = 0
+        self.rows_written = 0
+        self.file = None
+        self.parquet_writer = None
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        progress = None
+        if resume and os.path.exists(self.progress_path) and os.path.exists(path):
+            with open(self.progress_path) as f:
+                progress = json.load(f)
+        if progress is not None and progress['rows'] > 0:
+            if progress['columns'] != self.columns or progress['run_info'] != self.run_info:
+                raise ValueError('{} was written for other inputs or columns, remove it or do not resume'.format(
+                    self.progress_path))
+            with open(path, 'r+b') as f:
+                f.truncate(progress['bytes'])
+            self.rows_written = progress['rows']
+        else:
+            for file in [path, self.progress_path]:
+                if os.path.exists(file):
+                    os.remove(file)
+
+    def write(self, ids: Sequence[str], sequences: Sequence[str], predictions: np.ndarray):
+        """
+        Add the predictions of a batch of proteins
+        Args:
+            ids: protein ids
+            sequences: sequences of the proteins, ignored if write_sequences is False
+            predictions: [number of proteins, len(prediction_columns)] predictions
+
+        Returns:
+
+        """
+        predictions = np.asarray(predictions).reshape(len(ids), len(self.prediction_columns))
+        chunk = {'protein_ID': list(ids)}
+        chunk.update({column: predictions[:, i] for i, column in enumerate(self.prediction_columns)})
+        if self.write_sequences:
+            chunk['sequence'] = list(sequences)
+        self.chunks.append(pd.DataFrame(chunk, columns=self.columns))
+        self.buffered_rows += len(chunk['protein_ID'])
+        if self.buffered_rows >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """write the buffered rows to the file and record the progress"""
+        if not self.chunks:
+            return
+        frame = pd.concat(self.chunks, ignore_index=True)
+        if self.output_format == 'csv':
+            if self.file is None:
+                self.file = open(self.path, 'a', newline='')
+            frame.index += self.rows_written
+            frame.to_csv(self.file, header=self.rows_written == 0)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(self.path, table.schema)
+            self.parquet_writer.write_table(table)
+        self.rows_written += len(frame)
+        self.chunks = []
+        self.buffered_rows = 0
+        if self.output_format == 'csv':
+            self.write_progress(complete=False)
+
+    def write_progress(self, complete: bool):
+        """atomically replace the progress file, it only ever describes rows that are on disk"""
+        progress = {'rows': self.rows_written, 'bytes': os.fstat(self.file.fileno()).st_size, 'complete': complete,
+                    'columns': self.columns, 'run_info': self.run_info}
+        with open(self.progress_path + '.tmp', 'w') as f:
+            json.dump(progress, f, indent=2)
+        os.replace(self.progress_path + '.tmp', self.progress_path)
+
+    def close(self, complete: bool = True):
+        """
+        Write the buffered rows and close the file
+        Args:
+            complete: whether all predictions were written, an incomplete csv file can be resumed
+
+        Returns:
+
+        """
+        if complete and self.rows_written == 0 and not self.chunks:  # write the columns of an empty result
+            self.chunks.append(pd.DataFrame(columns=self.columns))
+        self.flush()
+        if self.file is not None:
+            self.write_progress(complete=complete)
+            self.file.close()
+            self.file = None
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+            self.parquet_writer = None
+
+    def __enter__(self) -> 'PredictionWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # keep the predictions of an interrupted run, they are resumed from the progress file
+        self.close(complete=exc_type is None)
+
+
+def prediction_path(output_files_name: str, output_format: str = 'csv') -> str:
+    """file that inference.py writes the predictions to for the output_files_name of the inference config"""
+    return '{}_prediction_result.{}'.format(output_files_name, output_format)
+
+
+def verify_predictions(path: str, ids: Sequence[str], output_format: str = 'csv', chunk_size: int = 100000) -> int:
+    """
+    Check that a predictions file has exactly one row per protein, in the order of ids, without missing or
+    duplicated rows. Only the protein_ID column is read, chunk by chunk.
+    Args:
+        path: predictions file written by PredictionWriter
+        ids: ids of all proteins in the order of the fasta file
+        output_format: 'csv' or 'parquet'
+        chunk_size: number of rows that are read at once
+
+    Returns: number of verified rows
+
+    """
+    if output_format == 'csv':
+        chunks = (chunk['protein_ID'].to_numpy(dtype=str) for chunk in
+                  pd.read_csv(path, usecols=['protein_ID'], dtype={'protein_ID': str}, keep_default_na=False,
+                              chunksize=chunk_size))
+    else:
+        import pyarrow.parquet as pq
+        chunks = (batch.column(0).to_numpy(zero_copy_only=False).astype(str) for batch in
+                  pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=['protein_ID']))
+    rows = 0
+    for chunk in chunks:
+        expected = np.asarray(ids[rows:rows + len(chunk)], dtype=str)
+        if len(expected) < len(chunk):
+            raise ValueError('{} has more rows than there are proteins ({})'.format(path, len(ids)))
+        mismatches = np.flatnonzero(chunk != expected)
+        if len(mismatches):
+            row = rows + int(mismatches[0])
+            raise ValueError('row {} of {} is {} instead of {}'.format(row, path, chunk[mismatches[0]], ids[row]))
+        rows += len(chunk)
+    if rows != len(ids):
+        raise ValueError('{} has {} rows but there are {} proteins'.format(path, rows, len(ids)))
+    return rows
@@ -0,0 +1,95 @@
+import copy
+from typing import Iterable, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import DeQuantStub, QuantStub
+
+# dynamic: int8 LSTM and Linear layers, weight_only: additionally int8 weights of the Conv1d layers that are
+# dequantized in every forward, static: additionally int8 Conv1d layers on activations with calibrated scales
+QUANTIZATION_MODES = ['dynamic', 'weight_only', 'static']
+
+
+class WeightOnlyInt8Conv1d(nn.Module):
+    """
+    Conv1d whose weights are stored as int8 with a symmetric scale per output channel, a quarter of the memory of
+    the float32 weights. The weights are dequantized in every forward, so the convolution itself runs in float.
+    """
+
+    def __init__(self, conv: nn.Conv1d):
+        super().__init__()
+        weight = conv.weight.detach().float()
+        scale = weight.abs().amax(dim=(1, 2), keepdim=True).clamp(min=1e-12) / 127
+        self.register_buffer('weight_int8', torch.round(weight / scale).to(torch.int8))
+        self.register_buffer('scale', scale)
+        self.register_buffer('bias', None if conv.bias is None else conv.bias.detach().clone())
+        self.kernel_size = conv.kernel_size
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+        self.groups = conv.groups
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        weight = self.weight_int8.to(x.dtype) * self.scale.to(x.dtype)
+        bias = None if self.bias is None else self.bias.to(x.dtype)
+        return F.conv1d(x, weight, bias, self.stride, self.padding, self.dilation, self.groups)
+
+
+class StaticQuantConv1d(nn.Module):
+    """Conv1d between a quantize and a dequantize step, converted to an int8 convolution after the calibration"""
+
+    def __init__(self, conv: nn.Conv1d):
+        super().__init__()
+        self.quant = QuantStub()
+        self.conv = conv
+        self.dequant = DeQuantStub()
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def replace_convolutions(model: nn.Module, wrapper) -> list:
+    """replace every Conv1d of the model by wrapper(conv) and return the wrappers"""
+    wrappers = []
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.Conv1d):
+                wrappers.append(wrapper(child))
+                setattr(module, name, wrappers[-1])
+    return wrappers
+
+
+def quantize_model(model: nn.Module, mode: str,
+                   calibration_batches: Iterable[Tuple[torch.Tensor, torch.Tensor]] = None) -> nn.Module:
+    """
+    Quantized copy of a model for inference on the cpu. The LSTM and Linear layers are dynamically quantized to int8,
+    their activations are quantized on the fly. The Conv1d layers keep float32 weights in the dynamic mode, get int8
+    weights in the weight_only mode and run on int8 activations in the static mode, where the scales of the
+    activations are calibrated by running the calibration batches through the model.
+    Args:
+        model: float32 model with the weights of a checkpoint
+        mode: one of QUANTIZATION_MODES
+        calibration_batches: (padded embeddings, mask) batches in the input_layout of the model, needed for the static
+            mode
+
+    Returns: the quantized model in eval mode
+
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError('quantization mode {} not supported, use one of {}'.format(mode, QUANTIZATION_MODES))
+    model = copy.deepcopy(model).cpu().eval()
+    if mode == 'weight_only':
+        replace_convolutions(model, WeightOnlyInt8Conv1d)
+    elif mode == 'static':
+        if calibration_batches is None:
+            raise ValueError('static quantization needs calibration batches')
+        qconfig = torch.ao.quantization.get_default_qconfig(torch.backends.quantized.engine)
+        for wrapper in replace_convolutions(model, StaticQuantConv1d):
+            wrapper.qconfig = qconfig
+        torch.ao.quantization.prepare(model, inplace=True)
+        with torch.no_grad():
+            for embedding, mask in calibration_batches:
+                model(embedding, mask=mask)
+        torch.ao.quantization.convert(model, inplace=True)
+    return torch.ao.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)